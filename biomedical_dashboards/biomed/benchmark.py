@@ -0,0 +1,271 @@
+from contextlib import redirect_stdout
+from typing import Dict, Iterable, List, Optional
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from biomedical_dashboards.biomed.config import Config, Context, Partner
+from biomedical_dashboards.biomed.main import run_workflow
+from biomedical_dashboards.biomed.preflight import format_bytes
+from biomedical_dashboards.biomed.retry import QuotaGuard, RetryPolicy
+
+PARTNER_COUNTS = (1, 10, 100, 500)
+
+
+class BenchmarkResult:
+    """The cost of orchestrating one run of the workflow against the simulated backend
+
+    :param partners: The number of partners in the run
+    :param engine: The engine that ran the tasks. See Context.engine
+    :param wall_seconds: The wall-clock time of the run
+    :param peak_threads: The most threads that were alive at once
+    :param peak_memory: The most memory allocated by Python at once, in bytes
+    :param api_calls: The number of API calls made, by method
+    :param tasks: The number of tasks in the run
+    :param failed_tasks: The number of tasks that failed
+    :param retries: The number of BigQuery calls and jobs that were retried
+    :param throttled_seconds: The total seconds that calls waited for the rate limits or backed off before retrying
+    """
+
+    def __init__(
+        self,
+        *,
+        partners: int,
+        engine: str,
+        wall_seconds: float,
+        peak_threads: int,
+        peak_memory: int,
+        api_calls: Dict[str, int],
+        tasks: int,
+        failed_tasks: int,
+        retries: int = 0,
+        throttled_seconds: float = 0.0,
+    ):
+        self.partners = partners
+        self.engine = engine
+        self.wall_seconds = wall_seconds
+        self.peak_threads = peak_threads
+        self.peak_memory = peak_memory
+        self.api_calls = api_calls
+        self.tasks = tasks
+        self.failed_tasks = failed_tasks
+        self.retries = retries
+        self.throttled_seconds = throttled_seconds
+
+    def to_dict(self) -> dict:
+        return dict(
+            partners=self.partners,
+            engine=self.engine,
+            wall_seconds=self.wall_seconds,
+            peak_threads=self.peak_threads,
+            peak_memory=self.peak_memory,
+            api_calls=self.api_calls,
+            tasks=self.tasks,
+            failed_tasks=self.failed_tasks,
+            retries=self.retries,
+            throttled_seconds=self.throttled_seconds,
+        )
+
+
+class ThreadMonitor:
+    """Samples the number of live threads in the background and keeps the highest
+
+    :param interval: The number of seconds between samples
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "ThreadMonitor":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            # The monitor's own thread isn't counted
+            self.peak = max(self.peak, threading.active_count() - 1)
+
+
+def synthetic_config(
+    num_partners: int,
+    output_dir: str,
+    *,
+    engine: str = "threads",
+    max_concurrent_jobs: int = 20,
+    job_poll_interval: float = 0.01,
+    simulation: Optional[dict] = None,
+    api_calls_per_second: Optional[float] = None,
+    jobs_per_second: Optional[float] = None,
+) -> Config:
+    """Creates the config of a run with any number of made-up partners, run against the simulated backend
+
+    :param num_partners: The number of partners
+    :param output_dir: The output directory of the run
+    :param engine: The engine to run the tasks with. See Context.engine
+    :param max_concurrent_jobs: The maximum number of tasks to run at once
+    :param job_poll_interval: The initial number of seconds between polls of a job with the asyncio engine. Should be
+    well below the simulated job latency
+    :param simulation: The settings of the simulated backend. See SimulatedBigQuery
+    :param api_calls_per_second: The most API calls to make per second. Unlimited if None
+    :param jobs_per_second: The most jobs to submit per second. Unlimited if None
+    :return: The config
+    """
+    context = Context(
+        dryrun=False,
+        project="simulated-project",
+        keyfile=None,
+        output_dir=output_dir,
+        run_version="20250101",
+        doi_version="20241201",
+        max_concurrent_jobs=max_concurrent_jobs,
+        engine=engine,
+        job_poll_interval=job_poll_interval,
+        backend="simulated",
+        simulation=simulation,
+    )
+    # Back off on the scale of the simulated latencies rather than BigQuery's, so that retries don't dominate the run
+    context.quota = QuotaGuard(
+        retry=RetryPolicy(initial_delay=0.01, max_delay=0.1),
+        api_calls_per_second=api_calls_per_second,
+        jobs_per_second=jobs_per_second,
+    )
+    partners = [
+        Partner(
+            institution_id=f"partner{i:04d}",
+            dois_table_name="dois_20250101",
+            trials_aact_table_name="trials_aact_20250101",
+            oddpub_table_name="oddpub_20250101",
+            year_cutoff=2000 + i % 20,
+        )
+        for i in range(num_partners)
+    ]
+    return Config(context=context, partners=partners)
+
+
+def benchmark_workflow(
+    num_partners: int,
+    *,
+    engine: str = "threads",
+    max_concurrent_jobs: int = 20,
+    simulation: Optional[dict] = None,
+    api_calls_per_second: Optional[float] = None,
+    jobs_per_second: Optional[float] = None,
+) -> BenchmarkResult:
+    """Runs the full workflow for a synthetic config against the simulated backend and measures it. The workflow's
+    output is discarded, and its files are written to a temporary directory.
+
+    Peak memory is measured with tracemalloc, which slows the run down. Compare wall times between benchmark runs
+    rather than with real runs.
+
+    :param num_partners: The number of partners
+    :param engine: The engine to run the tasks with. See Context.engine
+    :param max_concurrent_jobs: The maximum number of tasks to run at once
+    :param simulation: The settings of the simulated backend. See SimulatedBigQuery
+    :param api_calls_per_second: The most API calls to make per second. Unlimited if None
+    :param jobs_per_second: The most jobs to submit per second. Unlimited if None
+    :return: The measurements of the run
+    """
+    with tempfile.TemporaryDirectory() as output_dir:
+        config = synthetic_config(
+            num_partners,
+            output_dir,
+            engine=engine,
+            max_concurrent_jobs=max_concurrent_jobs,
+            simulation=simulation,
+            api_calls_per_second=api_calls_per_second,
+            jobs_per_second=jobs_per_second,
+        )
+        # The bigquery library is imported on first use. Import it now so that it isn't counted in the first run
+        import google.cloud.bigquery
+
+        tracemalloc.start()
+        start = time.monotonic()
+        try:
+            with ThreadMonitor() as threads, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                graph = run_workflow(config)
+            wall_seconds = time.monotonic() - start
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return BenchmarkResult(
+        partners=num_partners,
+        engine=engine,
+        wall_seconds=wall_seconds,
+        peak_threads=threads.peak,
+        peak_memory=peak_memory,
+        api_calls=dict(config.context.simulation.api_calls),
+        tasks=len(graph.tasks),
+        failed_tasks=len(graph.errors()),
+        retries=sum(config.context.quota.retries.values()),
+        throttled_seconds=config.context.quota.throttled_seconds,
+    )
+
+
+def run_benchmarks(
+    partner_counts: Iterable[int] = PARTNER_COUNTS,
+    engines: Iterable[str] = ("threads",),
+    *,
+    max_concurrent_jobs: int = 20,
+    simulation: Optional[dict] = None,
+    api_calls_per_second: Optional[float] = None,
+    jobs_per_second: Optional[float] = None,
+    output: Optional[str] = None,
+) -> List[BenchmarkResult]:
+    """Benchmarks the workflow for every combination of partner count and engine, prints a table of the results and
+    optionally writes them to a JSON file
+
+    :param partner_counts: The numbers of partners to benchmark
+    :param engines: The engines to benchmark
+    :param max_concurrent_jobs: The maximum number of tasks to run at once
+    :param simulation: The settings of the simulated backend. See SimulatedBigQuery
+    :param api_calls_per_second: The most API calls to make per second. Unlimited if None
+    :param jobs_per_second: The most jobs to submit per second. Unlimited if None
+    :param output: The file to write the results to. Optional
+    :return: The results
+    """
+    results = []
+    for engine in engines:
+        for n in partner_counts:
+            result = benchmark_workflow(
+                n,
+                engine=engine,
+                max_concurrent_jobs=max_concurrent_jobs,
+                simulation=simulation,
+                api_calls_per_second=api_calls_per_second,
+                jobs_per_second=jobs_per_second,
+            )
+            print(format_benchmark_results([result], header=not results))
+            results.append(result)
+    if output:
+        with open(output, "w") as f:
+            json.dump(dict(simulation=simulation or {}, results=[r.to_dict() for r in results]), f, indent=2)
+    return results
+
+
+def format_benchmark_results(results: List[BenchmarkResult], header: bool = True) -> str:
+    """Formats the results as a table, one row per run"""
+    lines = []
+    if header:
+        lines.append(
+            f"{'engine':<8}  {'partners':>8}  {'tasks':>6}  {'failed':>6}  {'wall':>9}  {'threads':>7}  "
+            f"{'peak mem':>10}  {'api calls':>9}  {'per partner':>11}  {'retries':>7}  {'throttled':>9}"
+        )
+    for r in results:
+        calls = sum(r.api_calls.values())
+        lines.append(
+            f"{r.engine:<8}  {r.partners:>8}  {r.tasks:>6}  {r.failed_tasks:>6}  {r.wall_seconds:>8.2f}s  "
+            f"{r.peak_threads:>7}  {format_bytes(r.peak_memory):>10}  {calls:>9}  {calls / r.partners:>11.1f}  "
+            f"{r.retries:>7}  {r.throttled_seconds:>8.2f}s"
+        )
+    return "\n".join(lines)
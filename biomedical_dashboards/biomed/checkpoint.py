@@ -0,0 +1,88 @@
+from datetime import datetime, timezone
+from typing import Dict
+import json
+import os
+import threading
+
+
+class CheckpointStore:
+    """A record of the workflow tasks that have completed in a run, so that a failed run can be resumed without
+    repeating the work that already succeeded.
+
+    The store is a JSON lines file per run version. The first line holds the workflow hash, and each completed task is
+    appended as a line of its own, so recording a task takes the same time however many tasks there are. A store
+    written by a different version of the workflow is not resumed from.
+
+    :param path: The location of the checkpoint file. Created on the first completed task.
+    :param workflow_hash: The hash of the workflow version doing the run
+    :param resume: Whether to load the completed tasks of a previous attempt at this run. If False, the run starts
+    from scratch and any existing checkpoint file is overwritten.
+    """
+
+    def __init__(self, path: str, workflow_hash: str, resume: bool = False):
+        self.path = path
+        self.workflow_hash = workflow_hash
+        self.completed: Dict[str, str] = {}
+        self.resumed: Dict[str, str] = {}
+        self._started = False  # Whether this attempt has written to the file yet
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+
+    def is_complete(self, task_name: str) -> bool:
+        """Whether the task was completed by a previous attempt at this run"""
+        with self._lock:
+            return task_name in self.completed
+
+    def complete(self, task_name: str) -> None:
+        """Records that a task has completed and saves the store"""
+        with self._lock:
+            self.completed[task_name] = datetime.now(timezone.utc).isoformat()
+            self._append(dict(task=task_name, completed=self.completed[task_name]))
+
+    def resume(self, task_name: str) -> None:
+        """Records that a completed task was skipped this attempt, as its output was confirmed to exist"""
+        with self._lock:
+            self.resumed[task_name] = self.completed[task_name]
+
+    def report(self) -> str:
+        """A human-readable report of the tasks that were resumed from the checkpoint"""
+        with self._lock:
+            resumed = sorted(self.resumed)
+        lines = [f"Resumed {len(resumed)} completed task(s) from checkpoint: {self.path}"]
+        for name in resumed:
+            lines.append(f"\t{name}")
+        return "\n".join(lines)
+
+    def _load(self) -> None:
+        """Loads the completed tasks of a previous attempt, unless it was made by a different workflow version.
+        Lines that can't be read (e.g. one cut short by a crash) are skipped"""
+        if not os.path.exists(self.path):
+            print(f"No checkpoint found at {self.path}, starting from the beginning")
+            return
+        with open(self.path) as f:
+            lines = []
+            for line in f:
+                try:
+                    lines.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        workflow_hash = lines[0].get("workflow_hash") if lines else None
+        if workflow_hash != self.workflow_hash:
+            print(
+                f"Checkpoint {self.path} was written by workflow version {workflow_hash}, "
+                f"not {self.workflow_hash}. Starting from the beginning"
+            )
+            return
+        self.completed = {line["task"]: line["completed"] for line in lines[1:] if "task" in line}
+        self._started = True
+
+    def _append(self, line: dict) -> None:
+        """Appends a line to the checkpoint file. The first line of an attempt that isn't resuming replaces the file
+        of any earlier attempt, and is preceded by the workflow hash"""
+        if not self._started:
+            with open(self.path, "w") as f:
+                f.write(json.dumps(dict(workflow_hash=self.workflow_hash)) + "\n")
+            self._started = True
+        with open(self.path, "a") as f:
+            f.write(json.dumps(line) + "\n")
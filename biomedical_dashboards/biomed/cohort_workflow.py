@@ -0,0 +1,228 @@
+from functools import partial
+from typing import Iterable, List, Optional, Tuple
+import os
+
+from biomedical_dashboards.biomed.config import Config, Context, Partner
+from biomedical_dashboards.biomed.gcp import bq_copy_table
+from biomedical_dashboards.biomed.logs import sharedprint
+from biomedical_dashboards.biomed.manifest import query_fingerprint
+from biomedical_dashboards.biomed.partner_workflow import run_recorded_query, save_query, tables_exist
+from biomedical_dashboards.biomed.queries import COHORT_QUERIES, fingerprint_context, render_cohort_queries
+from biomedical_dashboards.biomed.scheduler import Task
+
+# The static tables of each partner that each cohort query reads, as Partner attributes
+COHORT_STATIC_TABLES = dict(
+    trials=["trials_aact_table_name", "dois_table_name"],
+    pubs=["dois_table_name", "oddpub_table_name"],
+)
+
+# The shared tables that each cohort query reads. See SHARED_QUERIES
+COHORT_SHARED_TABLES = dict(trials=["trial_index"], pubs=["alltrials", "enriched_dois"])
+
+
+def cohort_tasks(config: Config, deps: Iterable[str] = ()) -> List[Task]:
+    """Creates the tasks that run the trials and pubs queries once for every partner of the run (or shard) together,
+    for the cohort execution mode. Does the following:
+    - Generates the cohort queries and writes them to file
+    - Once every partner's static tables have been checked, runs the cohort trials and pubs queries, unless their
+      tables exist from a run with the same queries and inputs. See reuse_cohort_output
+
+    Each partner's trials and pubs tasks then fill the partner's tables with its rows of the cohort's tables. The
+    cohort's queries read the shared tables once for the whole cohort rather than once per partner, but a problem with
+    any partner's static tables stops every partner's trials and pubs.
+
+    If context.dryrun setting is enabled, will only create and output the queries.
+
+    :param config: The workflow configuration
+    :param deps: The names of the tasks outside of the cohort that must finish before running the cohort queries
+    :return: The cohort tasks
+    """
+    context = config.context
+    tasks = [
+        Task(
+            name="cohort:generate_queries",
+            func=partial(generate_cohort_queries, config.partners, context),
+            verify=partial(cohort_query_files_current, config.partners, context),
+        )
+    ]
+    if context.dryrun:
+        return tasks
+
+    static_deps = [f"{p.institution_id}:check_static_tables" for p in config.partners]
+    for query_name in COHORT_QUERIES:
+        tasks.append(
+            Task(
+                name=f"cohort:{query_name}",
+                func=partial(run_cohort_query, config.partners, context, query_name),
+                verify=partial(tables_exist, context, context.shared_dataset, [cohort_table_name(context, query_name)]),
+                deps=["cohort:generate_queries", *static_deps, *deps],
+            )
+        )
+    return tasks
+
+
+def cohort_id(context: Context) -> str:
+    """The id that the cohort's queries are recorded under in the manifest and telemetry, in place of a partner's
+    institution_id. Each shard of a sharded run has its own cohort"""
+    return f"cohort{context.shard_suffix}"
+
+
+def cohort_table_name(context: Context, query_name: str) -> str:
+    """The name of the cohort's table made by a cohort query. One of COHORT_QUERIES"""
+    return getattr(context, f"cohort_{query_name}_name")
+
+
+def cohort_query_path(context: Context, query_name: str) -> str:
+    """The path of a cohort query's file"""
+    return os.path.join(context.output_dir, getattr(context, f"cohort_{query_name}_query_fname"))
+
+
+def generate_cohort_queries(partners: List[Partner], context: Context) -> None:
+    """Generates the cohort queries and saves them to file"""
+    for query_name, query in render_cohort_queries(partners, context).items():
+        path = cohort_query_path(context, query_name)
+        if save_query(query, path):
+            sharedprint(f"Query written to file: {path}")
+        else:
+            sharedprint(f"Query unchanged, not rewritten: {path}")
+
+
+def cohort_query_files_current(partners: List[Partner], context: Context) -> bool:
+    """Whether the cohort query files exist and match the queries rendered from the current config"""
+    for query_name, query in render_cohort_queries(partners, context).items():
+        path = cohort_query_path(context, query_name)
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            if f.read() != query:
+                return False
+    return True
+
+
+def run_cohort_query(partners: List[Partner], context: Context, query_name: str) -> None:
+    """Runs a cohort query, unless its output from a previous run can be reused
+
+    :param partners: The partners of the cohort
+    :param context: The workflow context
+    :param query_name: The name of the query. One of COHORT_QUERIES
+    """
+    prepared = prepare_cohort_query(partners=partners, context=context, query_name=query_name)
+    if not prepared:
+        return
+    query, fingerprint = prepared
+    table_name = cohort_table_name(context, query_name)
+    run_recorded_query(
+        context=context,
+        query=query,
+        institution_id=cohort_id(context),
+        template=query_name,
+        output_dataset=context.shared_dataset,
+        output_table_name=table_name,
+    )
+    if not context.metadata.table_exists(context.project, context.shared_dataset, table_name):
+        raise RuntimeError(f"Expected table missing after cohort query: {context.shared_dataset}.{table_name}")
+    context.manifest.record(
+        institution_id=cohort_id(context),
+        query_name=query_name,
+        fingerprint=fingerprint,
+        run_version=context.run_version,
+        table_name=table_name,
+    )
+
+
+def prepare_cohort_query(partners: List[Partner], context: Context, query_name: str) -> Optional[Tuple[str, str]]:
+    """Reads a cohort query from file and decides whether it needs to run. See reuse_cohort_output
+
+    :return: The query and its fingerprint if it needs to run. None if its output was reused
+    """
+    path = cohort_query_path(context, query_name)
+    with open(path) as f:
+        query = f.read()
+    fingerprint = cohort_query_fingerprint(partners=partners, context=context, query_name=query_name)
+    if reuse_cohort_output(context=context, query_name=query_name, fingerprint=fingerprint):
+        return None
+    sharedprint(f"Running query: {path}")
+    return query, fingerprint
+
+
+def cohort_query_dependencies(partners: List[Partner], context: Context, query_name: str) -> List[str]:
+    """The full table ids of the tables that a cohort query reads: the static tables of every partner and the shared
+    tables. See COHORT_STATIC_TABLES and COHORT_SHARED_TABLES"""
+    tables = [
+        f"{context.project}.{p.static_dataset}.{getattr(p, attr)}"
+        for p in partners
+        for attr in COHORT_STATIC_TABLES[query_name]
+    ]
+    tables += [
+        f"{context.project}.{context.shared_dataset}.{getattr(context, f'shared_{q}_name')}"
+        for q in COHORT_SHARED_TABLES[query_name]
+    ]
+    return tables
+
+
+def cohort_query_fingerprint(partners: List[Partner], context: Context, query_name: str) -> str:
+    """Creates the fingerprint of a cohort query from its SQL rendered for fingerprinting (see fingerprint_context), the
+    workflow hash and the metadata of the tables it reads. See query_fingerprint"""
+    inputs = {}
+    for table_id in cohort_query_dependencies(partners=partners, context=context, query_name=query_name):
+        project, dataset, table_name = table_id.split(".")
+        inputs[table_id] = context.metadata.table_metadata(project, dataset, table_name)
+    query = render_cohort_queries(partners=partners, context=fingerprint_context(context))[query_name]
+    return query_fingerprint(query=query, workflow_hash=context.workflow_hash, inputs=inputs, upstream=[])
+
+
+def reuse_cohort_output(context: Context, query_name: str, fingerprint: str) -> bool:
+    """Decides whether a cohort query needs to be run, as reuse_query_output does for a partner's query. If the output
+    of a previous run with the same fingerprint exists, it is reused: left as it is under the same run version, or
+    copied to this run's table under another.
+
+    :return: True if the output was reused and the query does not need to run. False otherwise.
+    """
+    id = cohort_id(context)
+    table_name = cohort_table_name(context, query_name)
+    previous = context.manifest.get(id, query_name)
+
+    if context.force:
+        reason = "forced"
+    elif not previous:
+        reason = "no previous run recorded"
+    elif previous["fingerprint"] != fingerprint:
+        reason = "query or inputs changed since the last run"
+    elif not context.metadata.table_exists(context.project, context.shared_dataset, previous["table_name"]):
+        reason = f"previous output missing: {context.shared_dataset}.{previous['table_name']}"
+    elif previous["table_name"] == table_name:
+        context.manifest.decide(
+            institution_id=id, query_name=query_name, action="skip", reason="unchanged and output already exists"
+        )
+        sharedprint(f"Skipping unchanged cohort query: {query_name}")
+        return True
+    else:
+        bq_copy_table(
+            project=context.project,
+            src_dataset=context.shared_dataset,
+            src_table_name=previous["table_name"],
+            dest_dataset=context.shared_dataset,
+            dest_table_name=table_name,
+            overwrite=True,
+            client=context.client,
+            check_source=False,
+        )
+        context.metadata.written(context.project, context.shared_dataset, table_name)
+        context.manifest.record(
+            institution_id=id,
+            query_name=query_name,
+            fingerprint=fingerprint,
+            run_version=context.run_version,
+            table_name=table_name,
+        )
+        context.manifest.decide(
+            institution_id=id,
+            query_name=query_name,
+            action="copy",
+            reason=f"unchanged, copied from {previous['table_name']}",
+        )
+        sharedprint(f"Copied unchanged cohort output {previous['table_name']} to {table_name}")
+        return True
+
+    context.manifest.decide(institution_id=id, query_name=query_name, action="run", reason=reason)
+    return False
@@ -1,8 +1,41 @@
+import inspect
 import os
+import re
 from datetime import datetime
-from typing import List, Union
+from typing import Dict, List, Optional, Union
 
-from git import Repo
+from biomedical_dashboards.biomed.gcp import BQClientPool
+from biomedical_dashboards.biomed.manifest import RunManifest
+from biomedical_dashboards.biomed.metadata import MetadataCache
+from biomedical_dashboards.biomed.retry import QuotaGuard, RetryPolicy
+from biomedical_dashboards.biomed.telemetry import Telemetry
+from biomedical_dashboards.biomed.version import workflow_hash
+
+ENGINES = ("threads", "asyncio")
+BACKENDS = ("bigquery", "simulated")
+PUBLISH_MODES = ("copy", "clone", "view")
+EXECUTION_MODES = ("jobs", "script", "cohort")
+PARTITION_TYPES = ("DAY", "MONTH", "YEAR", "RANGE")
+PARTITIONED_TABLES = ("trials", "pubs")  # The output tables that can be partitioned and clustered
+COHORT_CLUSTER_COLUMN = "var_institution_id"  # The column that the cohort tables are clustered by first
+BYTE_UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4, "PB": 1024**5}
+
+
+def parse_bytes(value: Union[int, str]) -> int:
+    """Parses a number of bytes from an int or a string with a unit, e.g. 500, "500 GB" or "1.5TB"
+
+    Raises ValueError if the value can't be parsed
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        number, unit = value, "B"
+    else:
+        match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGTP]?B)?\s*", str(value), flags=re.IGNORECASE)
+        if not match:
+            raise ValueError(f"must be a number of bytes, optionally with a unit (e.g. 500 GB), got {value}")
+        number, unit = float(match.group(1)), (match.group(2) or "B").upper()
+    if number < 0:
+        raise ValueError(f"must not be negative, got {value}")
+    return int(number * BYTE_UNITS[unit])
 
 
 class Partner:
@@ -13,6 +46,8 @@ class Partner:
     :param dois_table_name: The name of the partner input doi table.
     :param oddpub_table_name: The name of the partner input oddpub table.
     :param year_cutoff: The cutoff publication year for this partner.
+    :param shard_weight: The relative cost of running this partner, used to balance partners across shards when the
+    run is sharded. E.g. the bytes billed for the partner in the last run's telemetry summary. See sharding.py
     """
 
     def __init__(
@@ -23,12 +58,14 @@ class Partner:
         trials_aact_table_name: str,
         oddpub_table_name: str,
         year_cutoff: Union[int, str],
+        shard_weight: float = 1.0,
     ):
         self.institution_id = institution_id
         self.dois_table_name = dois_table_name
         self.trials_aact_table_name = trials_aact_table_name
         self.oddpub_table_name = oddpub_table_name
         self.year_cutoff = year_cutoff
+        self.shard_weight = shard_weight
 
     @property
     def output_dataset(self):
@@ -60,6 +97,11 @@ class Partner:
         """File name of the pubs query file"""
         return f"{self.institution_id}_pubs.sql"
 
+    @property
+    def script_query_fname(self):
+        """File name of the partner script file, which runs all of the queries in one job"""
+        return f"{self.institution_id}_script.sql"
+
     @staticmethod
     def from_dict(partner: dict):
         """Constructs a partner object from a dictionary. Checks that it is valid"""
@@ -74,6 +116,13 @@ class Partner:
             errors.append("Partner construction missing attribute: trials_aact_table_name")
         if not partner.get("oddpub_table_name"):
             errors.append("Partner construction missing attribute: oddpub_table_name")
+        try:
+            int(partner.get("year_cutoff", 1))
+        except (TypeError, ValueError):
+            errors.append(f"Partner year_cutoff must be an integer year, got {partner.get('year_cutoff')}")
+        shard_weight = partner.get("shard_weight", 1.0)
+        if not isinstance(shard_weight, (int, float)) or isinstance(shard_weight, bool) or shard_weight <= 0:
+            errors.append(f"Partner shard_weight must be a positive number, got {shard_weight}")
 
         if errors:
             msg: str = "\n".join(errors) + f"\nSupplied dict: {partner}"
@@ -84,6 +133,7 @@ class Partner:
             trials_aact_table_name=partner["trials_aact_table_name"],
             oddpub_table_name=partner["oddpub_table_name"],
             year_cutoff=partner.get("year_cutoff", 1),  # Default to 1 if not provided (all years)
+            shard_weight=shard_weight,
         )
 
     def to_dict(self) -> dict:
@@ -93,22 +143,158 @@ class Partner:
             trials_aact_table_name=self.trials_aact_table_name,
             oddpub_table_name=self.oddpub_table_name,
             year_cutoff=self.year_cutoff,
+            shard_weight=self.shard_weight,
+        )
+
+
+class TableOptions:
+    """The partitioning and clustering of one of the workflow's output tables. Applied by the query that creates the
+    table and kept when the table is published to the 'latest' dataset.
+
+    :param partition_by: The column to partition the table by. Optional
+    :param partition_type: How to partition the column. One of DAY, MONTH, YEAR for DATE columns, or RANGE for integer
+    columns (e.g. published_year), which are bucketed by range_start, range_end and range_interval
+    :param range_start: The start of the integer range to partition by, inclusive
+    :param range_end: The end of the integer range to partition by, exclusive
+    :param range_interval: The width of each partition of the integer range
+    :param cluster_by: The columns to cluster the table by, in order. Up to 4
+    """
+
+    def __init__(
+        self,
+        *,
+        partition_by: Optional[str] = None,
+        partition_type: str = "YEAR",
+        range_start: int = 1900,
+        range_end: int = 2100,
+        range_interval: int = 1,
+        cluster_by: List[str] = (),
+    ):
+        self.partition_by = partition_by
+        self.partition_type = partition_type
+        self.range_start = range_start
+        self.range_end = range_end
+        self.range_interval = range_interval
+        self.cluster_by = list(cluster_by)
+
+    def ddl(self, cluster_first: Optional[str] = None) -> str:
+        """The PARTITION BY and CLUSTER BY clauses to put between CREATE TABLE and AS. Empty if there are neither
+
+        :param cluster_first: A column to cluster by before the table's own clustering columns, e.g. the partner of
+        each row of a cohort table
+        """
+        clauses = []
+        cluster_by = ([cluster_first] if cluster_first else []) + self.cluster_by
+        if self.partition_by and self.partition_type == "RANGE":
+            clauses.append(
+                f"PARTITION BY RANGE_BUCKET({self.partition_by}, "
+                f"GENERATE_ARRAY({self.range_start}, {self.range_end}, {self.range_interval}))"
+            )
+        elif self.partition_by:
+            clauses.append(f"PARTITION BY DATE_TRUNC({self.partition_by}, {self.partition_type})")
+        if cluster_by:
+            clauses.append(f"CLUSTER BY {', '.join(cluster_by)}")
+        return "\n".join(clauses)
+
+    @staticmethod
+    def from_dict(options: dict):
+        """Constructs the table options from a dictionary. Checks that they are valid"""
+
+        errors: List[str] = []
+
+        partition_type = str(options.get("partition_type", "YEAR")).upper()
+        if partition_type not in PARTITION_TYPES:
+            errors.append(f"'partition_type' must be one of {', '.join(PARTITION_TYPES)}, got {partition_type}")
+        for key in ["range_start", "range_end", "range_interval"]:
+            if key in options and (not isinstance(options[key], int) or isinstance(options[key], bool)):
+                errors.append(f"'{key}' must be an integer, got {options[key]}")
+        cluster_by = options.get("cluster_by", [])
+        if isinstance(cluster_by, str):
+            cluster_by = [cluster_by]
+        if len(cluster_by) > 4:
+            errors.append(f"'cluster_by' may have at most 4 columns, got {len(cluster_by)}")
+
+        if errors:
+            msg: str = "\n".join(errors) + f"\nSupplied dict: {options}"
+            raise RuntimeError(f"Encountered error(s) in table options construction: {msg}")
+        return TableOptions(
+            partition_by=options.get("partition_by"),
+            partition_type=partition_type,
+            range_start=options.get("range_start", 1900),
+            range_end=options.get("range_end", 2100),
+            range_interval=options.get("range_interval", 1),
+            cluster_by=cluster_by,
         )
 
 
 class Context:
     """Contains the contextual information of the workflow configuration
 
-    :param dryrun: Whether to execute the created queries or not
+    :param dryrun: Whether to execute the created queries or not. If "estimate", the queries are not executed but are
+    submitted as BigQuery dry run jobs to estimate their cost
     :param project: The GCP project to work in
     :param keyfile: The location of the keyfile credentials file
     :param output_dir: The output directory location
     :param run_version: The version to use as a table shard
     :param doi_version: The version of the DOI table to use
+    :param previous_doi_version: The version of the DOI table that the last run used. If set, the shared alltrials
+    extract is built incrementally from that version's extract, re-extracting only the DOIs that have changed. See
+    shared_workflow.alltrials_lineage
+    :param shared_dataset: The dataset to write the extracts shared by all partners to
+    :param max_concurrent_jobs: The maximum number of workflow tasks (mostly BigQuery jobs) to run at once
+    :param force: Whether to run every query, even those whose query and inputs are unchanged since the last run
+    :param max_bytes_per_query: The most bytes that a single query may process. Enforced before and during execution
+    :param max_bytes_per_run: The most bytes that all queries together may process. Enforced before execution
+    :param engine: How to run the workflow tasks. "threads" runs each task in a worker thread. "asyncio" runs them from
+    a single event loop that submits jobs and polls them, so many more jobs can be in flight than there are threads
+    :param max_threads: The number of worker threads for blocking API calls when the engine is "asyncio"
+    :param job_poll_interval: The initial number of seconds between polls of a running job when the engine is
+    "asyncio". Backs off to 30 seconds
+    :param table_options: The partitioning and clustering of each output table, keyed by table ("trials" or "pubs").
+    Tables without options are neither partitioned nor clustered
+    :param publish_mode: How to publish this run's tables to the 'latest' dataset. "copy" copies each table. "clone"
+    makes each latest table a table clone, which copies no data. "view" makes each latest table a view of this run's
+    table. clone and view switch every table in a single script job
+    :param execution_mode: How to run each partner's queries. "jobs" runs the alltrials, trials and pubs queries as
+    separate jobs. "script" runs them as one multi-statement script, in a single job. "cohort" runs the trials and pubs
+    queries once for every partner together, into tables clustered by partner, then fills each partner's tables from
+    them. See cohort_workflow.py
+    :param backend: Where to run the workflow. "bigquery" runs it in BigQuery. "simulated" runs it against an in-memory
+    stand-in, for measuring the workflow's orchestration without cost. See simulated.py
+    :param simulation: The settings of the simulated backend. See SimulatedBigQuery
+    :param max_retries: The most times to retry a BigQuery call or job that fails with a transient error, e.g. rate
+    limiting or a backend error. See retry.py
+    :param api_calls_per_second: The most BigQuery API calls that don't start a job (e.g. getting a table or polling a
+    job) to make per second, across the whole workflow. Unlimited if None
+    :param jobs_per_second: The most BigQuery jobs to submit per second, across the whole workflow. Unlimited if None
     """
 
     def __init__(
-        self, *, dryrun: bool, project: str, keyfile: str, output_dir: str, run_version: str, doi_version: str
+        self,
+        *,
+        dryrun: Union[bool, str],
+        project: str,
+        keyfile: str,
+        output_dir: str,
+        run_version: str,
+        doi_version: str,
+        previous_doi_version: Optional[str] = None,
+        shared_dataset: str = "biomed_shared",
+        max_concurrent_jobs: int = 20,
+        force: bool = False,
+        max_bytes_per_query: Optional[int] = None,
+        max_bytes_per_run: Optional[int] = None,
+        engine: str = "threads",
+        max_threads: int = 8,
+        job_poll_interval: float = 1.0,
+        table_options: Optional[Dict[str, TableOptions]] = None,
+        publish_mode: str = "copy",
+        execution_mode: str = "jobs",
+        backend: str = "bigquery",
+        simulation: Optional[dict] = None,
+        max_retries: int = 5,
+        api_calls_per_second: Optional[float] = 50,
+        jobs_per_second: Optional[float] = 10,
     ):
         self.dryrun = dryrun
         self.project = project
@@ -116,9 +302,60 @@ class Context:
         self.output_dir = output_dir
         self.run_version = run_version
         self.doi_version = doi_version
-        self.workflow_hash = Repo(search_parent_directories=True).head.object.hexsha
+        self.previous_doi_version = previous_doi_version
+        self.shared_dataset = shared_dataset
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.backend = backend
+        self.simulation = None
+        if backend == "simulated":
+            # Imported here, as the simulated backend loads the google libraries, which are slow to import
+            from biomedical_dashboards.biomed.simulated import SimulatedBigQuery
+
+            self.simulation = SimulatedBigQuery(**(simulation or {}))
+        self.clients = BQClientPool(
+            pool_size=max_concurrent_jobs, client_factory=self.simulation.client if self.simulation else None
+        )
+        self.metadata = MetadataCache(clients=self.clients)
+        self.quota = QuotaGuard(
+            retry=RetryPolicy(max_attempts=max_retries + 1),
+            api_calls_per_second=api_calls_per_second,
+            jobs_per_second=jobs_per_second,
+        )
+        self.force = force
+        self.resume = False  # Set from the command line. Whether to resume from the run's checkpoint
+        # Set from the command line when the partners are split across processes. See sharding.py
+        self.shard_index: Optional[int] = None
+        self.shard_count: Optional[int] = None
+        self.max_bytes_per_query = max_bytes_per_query
+        self.max_bytes_per_run = max_bytes_per_run
+        self.engine = engine
+        self.max_threads = max_threads
+        self.job_poll_interval = job_poll_interval
+        self.table_options = {t: TableOptions() for t in PARTITIONED_TABLES}
+        self.table_options.update(table_options or {})
+        self.publish_mode = publish_mode
+        self.execution_mode = execution_mode
+        self.shared_year_cutoff = 1  # Set by the Config to the minimum year cutoff of all partners
+        self.workflow_hash = workflow_hash()
 
         os.makedirs(self.output_dir, exist_ok=True)
+        self.manifest = RunManifest(os.path.join(self.output_dir, "manifest.jsonl"))
+        self.telemetry = Telemetry(os.path.join(self.output_dir, "telemetry.jsonl"))
+
+    @property
+    def estimate(self):
+        """Whether to estimate the cost of the queries without executing them"""
+        return self.dryrun == "estimate"
+
+    @property
+    def budgeted(self):
+        """Whether the queries have a bytes processed budget"""
+        return self.max_bytes_per_query is not None or self.max_bytes_per_run is not None
+
+    @property
+    def client(self):
+        """The bigquery client for the project, shared by the whole workflow"""
+        return self.clients.get(self.project)
 
     @property
     def generated_alltrials_name(self):
@@ -135,6 +372,119 @@ class Context:
         """Name of the pubs table resulting from our query"""
         return f"pubs{self.run_version}"
 
+    @property
+    def cohort_trials_name(self):
+        """Name of the trials table of every partner in the run (or shard), in the shared dataset. With the cohort
+        execution mode, each partner's trials table is filled from it"""
+        return f"cohort_trials{self.run_version}{self.shard_suffix}"
+
+    @property
+    def cohort_trials_query_fname(self):
+        """File name of the cohort trials query file"""
+        return f"cohort_trials_{self.run_version}{self.shard_suffix}.sql"
+
+    @property
+    def cohort_pubs_name(self):
+        """Name of the pubs table of every partner in the run (or shard), in the shared dataset. With the cohort
+        execution mode, each partner's pubs table is filled from it"""
+        return f"cohort_pubs{self.run_version}{self.shard_suffix}"
+
+    @property
+    def cohort_pubs_query_fname(self):
+        """File name of the cohort pubs query file"""
+        return f"cohort_pubs_{self.run_version}{self.shard_suffix}.sql"
+
+    @property
+    def doi_table(self):
+        """Full id of the Academic Observatory DOI table of the doi_version"""
+        return f"academic-observatory.observatory.doi{self.doi_version}"
+
+    @property
+    def unpaywall_table(self):
+        """Full id of the Unpaywall table"""
+        return "academic-observatory.unpaywall.unpaywall"
+
+    @property
+    def sharded(self) -> bool:
+        """Whether this process runs one shard of the partners"""
+        return self.shard_count is not None
+
+    @property
+    def shard_suffix(self) -> str:
+        """Suffix of the run's file names, so that shards sharing an output directory don't overwrite each other's
+        files. Empty if the run isn't sharded"""
+        return f"_shard{self.shard_index}of{self.shard_count}" if self.sharded else ""
+
+    @property
+    def incremental_report_fname(self):
+        """File name of the report of the queries that were run or skipped in this run"""
+        return f"incremental_report_{self.run_version}{self.shard_suffix}.json"
+
+    @property
+    def cost_estimate_fname(self):
+        """File name of the pre-flight cost estimates of this run"""
+        return f"cost_estimate_{self.run_version}{self.shard_suffix}.json"
+
+    @property
+    def telemetry_summary_fname(self):
+        """File name of the summary of the job telemetry of this run"""
+        return f"telemetry_summary_{self.run_version}{self.shard_suffix}.json"
+
+    @property
+    def checkpoint_fname(self):
+        """File name of the checkpoint of the tasks completed in this run"""
+        return f"checkpoint_{self.run_version}{self.shard_suffix}.jsonl"
+
+    @property
+    def run_report_fname(self):
+        """File name of the report of a sharded run, merged from every shard's result"""
+        return f"run_report_{self.run_version}.json"
+
+    @property
+    def shared_alltrials_name(self):
+        """Name of the alltrials extract shared by all partners. Versioned by the DOI table and year cutoff"""
+        return f"alltrials_from{self.shared_year_cutoff}_{self.doi_version}"
+
+    @property
+    def shared_alltrials_query_fname(self):
+        """File name of the shared alltrials query file"""
+        return f"shared_alltrials_{self.doi_version}.sql"
+
+    @property
+    def previous_alltrials_name(self):
+        """Name of the alltrials extract of the previous DOI table version, at this run's year cutoff. None if there
+        is no previous version"""
+        if not self.previous_doi_version:
+            return None
+        return f"alltrials_from{self.shared_year_cutoff}_{self.previous_doi_version}"
+
+    @property
+    def shared_alltrials_delta_query_fname(self):
+        """File name of the shared alltrials query file that builds the extract from the previous version's"""
+        return f"shared_alltrials_{self.doi_version}_from_{self.previous_doi_version}.sql"
+
+    @property
+    def shared_trial_index_name(self):
+        """Name of the index of the DOIs that mention each Trial-ID in the alltrials extract, shared by all partners.
+        Versioned like the extract it is made from"""
+        return f"nct_doi_index_from{self.shared_year_cutoff}_{self.doi_version}"
+
+    @property
+    def shared_trial_index_query_fname(self):
+        """File name of the shared Trial-ID index query file"""
+        return f"shared_trial_index_{self.doi_version}.sql"
+
+    @property
+    def shared_enriched_dois_name(self):
+        """Name of the Academic Observatory DOIs joined to Unpaywall, shared by all partners. Versioned by the DOI
+        table"""
+        return f"enriched_dois_{self.doi_version}"
+
+    @property
+    def shared_enriched_dois_query_fname(self):
+        """File name of the shared enriched DOIs query file"""
+        return f"shared_enriched_dois_{self.doi_version}.sql"
+
     @staticmethod
     def from_dict(cfg: dict):
         """Checks that the config is valid then constructs the Config object from the dictionary"""
@@ -142,10 +492,24 @@ class Context:
         errors: List[str] = []
 
         # Type checking
-        if not isinstance(cfg.get("dryrun"), bool):
-            errors.append(f"'dryrun' must be either True, or False, got {cfg.get('dryrun')}")
-
-        if cfg.get("dryrun") == False:
+        if not isinstance(cfg.get("dryrun"), bool) and cfg.get("dryrun") != "estimate":
+            errors.append(f"'dryrun' must be either True, False or estimate, got {cfg.get('dryrun')}")
+
+        if cfg.get("backend", "bigquery") not in BACKENDS:
+            errors.append(f"'backend' must be one of {', '.join(BACKENDS)}, got {cfg.get('backend')}")
+        if cfg.get("simulation") is not None:
+            if cfg.get("backend") != "simulated":
+                errors.append("'simulation' settings are only used with backend: simulated")
+            elif not isinstance(cfg["simulation"], dict):
+                errors.append(f"'simulation' must be a mapping of settings, got {cfg['simulation']}")
+            else:
+                from biomedical_dashboards.biomed.simulated import SimulatedBigQuery
+
+                unknown = set(cfg["simulation"]) - set(inspect.signature(SimulatedBigQuery).parameters)
+                if unknown:
+                    errors.append(f"Unknown 'simulation' setting(s): {', '.join(sorted(unknown))}")
+
+        if cfg.get("dryrun") != True and cfg.get("backend", "bigquery") == "bigquery":
             if not cfg.get("keyfile"):
                 errors.append("No keyfile provided.")
             elif not os.path.exists(cfg.get("keyfile")):
@@ -172,6 +536,77 @@ class Context:
             except Exception as e:
                 errors.append(e.__str__())
 
+        if cfg.get("previous_doi_version"):
+            try:
+                datetime.strptime(str(cfg["previous_doi_version"]), "%Y%m%d").date()
+            except Exception as e:
+                errors.append(e.__str__())
+            else:
+                if cfg.get("doi_version") and str(cfg["previous_doi_version"]) >= str(cfg["doi_version"]):
+                    errors.append(
+                        f"'previous_doi_version' must be before doi_version ({cfg['doi_version']}), "
+                        f"got {cfg['previous_doi_version']}"
+                    )
+
+        max_concurrent_jobs = cfg.get("max_concurrent_jobs", 20)
+        if not isinstance(max_concurrent_jobs, int) or isinstance(max_concurrent_jobs, bool) or max_concurrent_jobs < 1:
+            errors.append(f"'max_concurrent_jobs' must be a positive integer, got {max_concurrent_jobs}")
+
+        if cfg.get("engine", "threads") not in ENGINES:
+            errors.append(f"'engine' must be one of {', '.join(ENGINES)}, got {cfg.get('engine')}")
+        max_threads = cfg.get("max_threads", 8)
+        if not isinstance(max_threads, int) or isinstance(max_threads, bool) or max_threads < 1:
+            errors.append(f"'max_threads' must be a positive integer, got {max_threads}")
+
+        if cfg.get("publish_mode", "copy") not in PUBLISH_MODES:
+            errors.append(f"'publish_mode' must be one of {', '.join(PUBLISH_MODES)}, got {cfg.get('publish_mode')}")
+        if cfg.get("execution_mode", "jobs") not in EXECUTION_MODES:
+            errors.append(
+                f"'execution_mode' must be one of {', '.join(EXECUTION_MODES)}, got {cfg.get('execution_mode')}"
+            )
+
+        table_options = {}
+        for table, options in (cfg.get("table_options") or {}).items():
+            if table not in PARTITIONED_TABLES:
+                errors.append(f"'table_options' must be for one of {', '.join(PARTITIONED_TABLES)}, got {table}")
+                continue
+            try:
+                table_options[table] = TableOptions.from_dict(options or {})
+            except RuntimeError as e:
+                errors.append(f"'table_options.{table}' {e}")
+                continue
+            if cfg.get("execution_mode") == "cohort" and len(table_options[table].cluster_by) > 3:
+                errors.append(
+                    f"'table_options.{table}.cluster_by' may have at most 3 columns with execution_mode: cohort, as "
+                    f"the cohort tables are clustered by {COHORT_CLUSTER_COLUMN} first"
+                )
+
+        job_poll_interval = cfg.get("job_poll_interval", 1.0)
+        if (
+            not isinstance(job_poll_interval, (int, float))
+            or isinstance(job_poll_interval, bool)
+            or job_poll_interval <= 0
+        ):
+            errors.append(f"'job_poll_interval' must be a positive number of seconds, got {job_poll_interval}")
+
+        max_retries = cfg.get("max_retries", 5)
+        if not isinstance(max_retries, int) or isinstance(max_retries, bool) or max_retries < 0:
+            errors.append(f"'max_retries' must be a non-negative integer, got {max_retries}")
+        rates = {}
+        for key, default in [("api_calls_per_second", 50), ("jobs_per_second", 10)]:
+            rates[key] = cfg.get(key, default)
+            if rates[key] is not None and (
+                not isinstance(rates[key], (int, float)) or isinstance(rates[key], bool) or rates[key] <= 0
+            ):
+                errors.append(f"'{key}' must be a positive number or null for unlimited, got {rates[key]}")
+
+        max_bytes = {}
+        for key in ["max_bytes_per_query", "max_bytes_per_run"]:
+            try:
+                max_bytes[key] = parse_bytes(cfg[key]) if cfg.get(key) is not None else None
+            except ValueError as e:
+                errors.append(f"'{key}' {e}")
+
         if errors:
             msg = "\n".join(errors)
             raise RuntimeError(f"Encountered error(s) in config construction: {msg}")
@@ -183,6 +618,22 @@ class Context:
             output_dir=cfg["output_dir"],
             run_version=cfg["run_version"],
             doi_version=cfg["doi_version"],
+            previous_doi_version=cfg.get("previous_doi_version"),
+            shared_dataset=cfg.get("shared_dataset", "biomed_shared"),
+            max_concurrent_jobs=max_concurrent_jobs,
+            max_bytes_per_query=max_bytes["max_bytes_per_query"],
+            max_bytes_per_run=max_bytes["max_bytes_per_run"],
+            engine=cfg.get("engine", "threads"),
+            max_threads=max_threads,
+            job_poll_interval=job_poll_interval,
+            table_options=table_options,
+            publish_mode=cfg.get("publish_mode", "copy"),
+            execution_mode=cfg.get("execution_mode", "jobs"),
+            backend=cfg.get("backend", "bigquery"),
+            simulation=cfg.get("simulation"),
+            max_retries=max_retries,
+            api_calls_per_second=rates["api_calls_per_second"],
+            jobs_per_second=rates["jobs_per_second"],
         )
 
     def to_dict(self) -> dict:
@@ -193,7 +644,19 @@ class Context:
             output_dir=self.output_dir,
             run_version=self.run_version,
             doi_version=self.doi_version,
+            previous_doi_version=self.previous_doi_version,
             workflow_hash=self.workflow_hash,
+            shared_dataset=self.shared_dataset,
+            shared_year_cutoff=self.shared_year_cutoff,
+            shared_alltrials_name=self.shared_alltrials_name,
+            previous_alltrials_name=self.previous_alltrials_name,
+            shared_enriched_dois_name=self.shared_enriched_dois_name,
+            shared_trial_index_name=self.shared_trial_index_name,
+            cohort_trials_name=self.cohort_trials_name,
+            cohort_pubs_name=self.cohort_pubs_name,
+            doi_table=self.doi_table,
+            unpaywall_table=self.unpaywall_table,
+            table_options={t: o.ddl() for t, o in self.table_options.items()},
         )
 
 
@@ -203,6 +666,17 @@ class Config:
     def __init__(self, *, context: Context, partners: List[Partner]):
         self.context = context
         self.partners = partners
+        self.context.shared_year_cutoff = self.min_year_cutoff
+        if self.context.simulation:
+            # The simulated backend starts with the partners' input tables and Unpaywall, as if they had been uploaded
+            self.context.simulation.add_inputs(
+                self.context.project, self.partners, shared_inputs=[self.context.unpaywall_table]
+            )
+
+    @property
+    def min_year_cutoff(self) -> int:
+        """The lowest year cutoff of all partners. The shared extracts must cover every partner's years"""
+        return min((int(p.year_cutoff) for p in self.partners), default=1)
 
     @staticmethod
     def from_dict(cfg: dict):
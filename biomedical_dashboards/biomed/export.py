@@ -0,0 +1,393 @@
+from typing import Iterator, List, Optional, Tuple
+import os
+import queue
+import re
+import threading
+import time
+
+from biomedical_dashboards.biomed.config import Config, Partner
+from biomedical_dashboards.biomed.gcp import bq_read_table_streams, bq_storage_client
+from biomedical_dashboards.biomed.logs import bioprint
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError as e:
+    raise RuntimeError(
+        "biomed export needs pyarrow and google-cloud-bigquery-storage. Install them with: "
+        "pip install 'biomedical-dashboards[export]'"
+    ) from e
+
+# The formats that tables can be exported to, and their file extensions
+EXPORT_FORMATS = {"parquet": "parquet", "csv": "csv"}
+
+# The tables of the partner's 'latest' dataset that can be exported
+EXPORT_TABLES = ("trials", "pubs")
+
+# The most record batches that the streams of a table can have read but not yet written. With the row group buffer
+# of the parquet writer, this bounds the memory an export uses, however large the table
+MAX_QUEUED_BATCHES = 8
+
+# The number of rows in each row group of an exported parquet file
+ROW_GROUP_ROWS = 128 * 1024
+
+# The table that a published view reads. See dashboard_publish_latest.sql.jinja2
+VIEW_SOURCE = re.compile(r"FROM\s+`([^`]+)`", flags=re.IGNORECASE)
+
+
+class StorageReadSource:
+    """Reads tables through the BigQuery Storage Read API. See gcp.bq_read_table_streams
+
+    :param project: The project that the read sessions are billed to
+    """
+
+    def __init__(self, *, project: str):
+        self.project = project
+        self._client = None
+        self._lock = threading.Lock()
+
+    def read_streams(
+        self, project: str, dataset: str, table_name: str, columns: Optional[List[str]], max_streams: int
+    ) -> Tuple[pyarrow.Schema, List[Iterator[pyarrow.RecordBatch]]]:
+        """Opens a table's rows as up to max_streams streams of record batches
+
+        :return: The schema of the rows and the iterator of each stream
+        """
+        with self._lock:
+            if self._client is None:
+                self._client = bq_storage_client()
+        return bq_read_table_streams(
+            project, dataset, table_name, columns=columns, max_streams=max_streams, client=self._client
+        )
+
+
+class LocalArrowSource:
+    """Reads tables from parquet files in a local directory, in place of the Storage Read API, e.g. to test an export
+    or to benchmark it without BigQuery. The table project.dataset.table is read from the file
+    project.dataset.table.parquet. The row groups of the file are dealt out between the streams, and are read one at
+    a time, so a stream holds no more than one row group in memory.
+
+    :param path: The directory of the files
+    """
+
+    def __init__(self, *, path: str):
+        self.path = path
+
+    def read_streams(
+        self, project: str, dataset: str, table_name: str, columns: Optional[List[str]], max_streams: int
+    ) -> Tuple[pyarrow.Schema, List[Iterator[pyarrow.RecordBatch]]]:
+        """Opens a table's rows as up to max_streams streams of record batches. See StorageReadSource.read_streams"""
+        path = os.path.join(self.path, f"{project}.{dataset}.{table_name}.parquet")
+        if not os.path.exists(path):
+            raise RuntimeError(f"Table not found: {project}.{dataset}.{table_name} (no file {path})")
+        metadata = pyarrow.parquet.ParquetFile(path).metadata
+        schema = metadata.schema.to_arrow_schema()
+        if columns:
+            missing = [c for c in columns if c not in schema.names]
+            if missing:
+                raise RuntimeError(f"Column(s) not found in {project}.{dataset}.{table_name}: {', '.join(missing)}")
+            schema = pyarrow.schema([schema.field(c) for c in columns])
+        row_groups = list(range(metadata.num_row_groups))
+        num_streams = max(1, min(max_streams, len(row_groups)))
+
+        def _read(groups: List[int]) -> Iterator[pyarrow.RecordBatch]:
+            # Each stream opens the file itself, as a ParquetFile can't be read from several threads at once
+            file = pyarrow.parquet.ParquetFile(path)
+            for i in groups:
+                yield from file.read_row_group(i, columns=columns).to_batches()
+
+        return schema, [_read(row_groups[i::num_streams]) for i in range(num_streams)]
+
+
+class ExportWriter:
+    """Writes record batches to a file as they arrive. The file is written under a temporary name and only renamed to
+    its path when closed, so a failed export never leaves a file that looks complete.
+
+    :param path: The file to write
+    :param schema: The schema of the record batches
+    :param format: The format of the file. One of EXPORT_FORMATS
+    """
+
+    def __init__(self, *, path: str, schema: pyarrow.Schema, format: str):
+        if format == "csv":
+            nested = [f.name for f in schema if pyarrow.types.is_nested(f.type)]
+            if nested:
+                raise RuntimeError(
+                    f"CSV can't hold the nested column(s): {', '.join(nested)}. Export to parquet, or leave them out "
+                    f"with --columns"
+                )
+        self.path = path
+        self.format = format
+        self.rows = 0
+        self._tmp_path = f"{path}.tmp"
+        self._buffer: List[pyarrow.RecordBatch] = []
+        self._buffered_rows = 0
+        if format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(self._tmp_path, schema)
+        else:
+            self._writer = pyarrow.csv.CSVWriter(self._tmp_path, schema)
+
+    def write(self, batch: pyarrow.RecordBatch) -> None:
+        """Writes a record batch. For parquet, batches are buffered until there are enough rows for a row group"""
+        self.rows += batch.num_rows
+        if self.format == "csv":
+            self._writer.write_batch(batch)
+            return
+        self._buffer.append(batch)
+        self._buffered_rows += batch.num_rows
+        if self._buffered_rows >= ROW_GROUP_ROWS:
+            self._flush()
+
+    def close(self) -> None:
+        """Writes any buffered rows and moves the file to its path"""
+        self._flush()
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self) -> None:
+        """Closes and removes the unfinished file"""
+        self._writer.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._writer.write_table(pyarrow.Table.from_batches(self._buffer), row_group_size=ROW_GROUP_ROWS)
+            self._buffer = []
+            self._buffered_rows = 0
+
+
+class ExportResult:
+    """The export of one table
+
+    :param institution_id: The partner whose table was exported
+    :param table: The name of the table, e.g. "trials"
+    :param source: The full id of the table that was read
+    :param path: The file written
+    :param format: The format of the file. One of EXPORT_FORMATS
+    :param rows: The number of rows exported
+    :param file_bytes: The size of the file
+    :param streams: The number of streams that the rows were read from in parallel
+    :param seconds: The wall time of the export
+    """
+
+    def __init__(
+        self,
+        *,
+        institution_id: str,
+        table: str,
+        source: str,
+        path: str,
+        format: str,
+        rows: int,
+        file_bytes: int,
+        streams: int,
+        seconds: float,
+    ):
+        self.institution_id = institution_id
+        self.table = table
+        self.source = source
+        self.path = path
+        self.format = format
+        self.rows = rows
+        self.file_bytes = file_bytes
+        self.streams = streams
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return dict(
+            institution_id=self.institution_id,
+            table=self.table,
+            source=self.source,
+            path=self.path,
+            format=self.format,
+            rows=self.rows,
+            file_bytes=self.file_bytes,
+            streams=self.streams,
+            seconds=self.seconds,
+            rows_per_second=self.rows_per_second,
+        )
+
+
+def export_table(
+    source,
+    *,
+    project: str,
+    dataset: str,
+    table_name: str,
+    path: str,
+    format: str = "parquet",
+    columns: Optional[List[str]] = None,
+    max_streams: int = 4,
+) -> Tuple[int, int]:
+    """Exports a table to a file. The table's streams are read in parallel, one thread each, and their batches are
+    written by this thread as they arrive, in no particular order. At most MAX_QUEUED_BATCHES batches wait to be
+    written at once, so a stream that gets ahead waits for the writer rather than filling memory.
+
+    :param source: Where to read the table from. A StorageReadSource or LocalArrowSource
+    :param project: The project of the table
+    :param dataset: The dataset of the table
+    :param table_name: The name of the table
+    :param path: The file to write
+    :param format: The format of the file. One of EXPORT_FORMATS
+    :param columns: The columns to export. Defaults to every column
+    :param max_streams: The most streams to read in parallel
+    :return: The number of rows written and the number of streams they were read from
+    """
+    schema, streams = source.read_streams(project, dataset, table_name, columns, max_streams)
+    writer = ExportWriter(path=path, schema=schema, format=format)
+    batches = queue.Queue(maxsize=MAX_QUEUED_BATCHES)
+    stop = threading.Event()
+    done = object()  # Put on the queue by each stream when it finishes
+
+    def _put(item) -> None:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _read(stream: Iterator[pyarrow.RecordBatch]) -> None:
+        try:
+            for batch in stream:
+                if stop.is_set():
+                    return
+                _put(batch)
+        except Exception as e:
+            _put(e)
+            return
+        _put(done)
+
+    threads = [threading.Thread(target=_read, args=(s,), daemon=True) for s in streams]
+    for t in threads:
+        t.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            item = batches.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                writer.write(item)
+        writer.close()
+    except BaseException:
+        stop.set()
+        writer.abort()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+    return writer.rows, len(streams)
+
+
+def export_source(config: Config, partner: Partner, table: str) -> Tuple[str, str, str]:
+    """The table to read for a partner's latest table. A table is read as it is. A view (see the view publish mode)
+    can't be read by the Storage Read API, so the run's table that it selects from is read instead
+
+    :return: The project, dataset and name of the table to read
+    """
+    context = config.context
+    latest = context.metadata.get_table(context.project, partner.latest_dataset, table)
+    if latest is None:
+        raise RuntimeError(f"Table not found: {context.project}.{partner.latest_dataset}.{table}")
+    if latest.table_type != "VIEW":
+        return context.project, partner.latest_dataset, table
+    match = VIEW_SOURCE.search(latest.view_query or "")
+    if not match or match.group(1).count(".") != 2:
+        raise RuntimeError(f"Could not find the table that the view reads: {context.project}.{partner.latest_dataset}")
+    project, dataset, table_name = match.group(1).split(".")
+    return project, dataset, table_name
+
+
+def export_latest_tables(
+    config: Config,
+    *,
+    source=None,
+    tables: Tuple[str, ...] = EXPORT_TABLES,
+    format: str = "parquet",
+    columns: Optional[List[str]] = None,
+    max_streams: int = 4,
+    dest: Optional[str] = None,
+) -> List[ExportResult]:
+    """Exports each partner's latest tables to local files, one table at a time, each read with parallel streams.
+    Files are named INSTITUTION_ID_TABLE.FORMAT. A table that fails to export doesn't stop the others. Prints the
+    results, then raises a RuntimeError listing every table that failed.
+
+    :param config: The workflow configuration. Every partner in it is exported
+    :param source: Where to read the tables from. Defaults to the Storage Read API. See LocalArrowSource
+    :param tables: The tables to export. Any of EXPORT_TABLES
+    :param format: The format of the files. One of EXPORT_FORMATS
+    :param columns: The columns to export. Defaults to every column
+    :param max_streams: The most streams to read each table with
+    :param dest: The directory to write the files to. Defaults to the export directory in the output directory
+    :return: The result of every table exported
+    """
+    context = config.context
+    source = source or StorageReadSource(project=context.project)
+    dest = dest or os.path.join(context.output_dir, "export")
+    os.makedirs(dest, exist_ok=True)
+    results = []
+    errors = []
+    for partner in config.partners:
+        for table in tables:
+            path = os.path.join(dest, f"{partner.institution_id}_{table}.{EXPORT_FORMATS[format]}")
+            start = time.monotonic()
+            try:
+                if isinstance(source, StorageReadSource):
+                    project, dataset, table_name = export_source(config, partner, table)
+                else:
+                    # A local source has no views, so its latest tables are read as they are
+                    project, dataset, table_name = context.project, partner.latest_dataset, table
+                rows, streams = export_table(
+                    source,
+                    project=project,
+                    dataset=dataset,
+                    table_name=table_name,
+                    path=path,
+                    format=format,
+                    columns=columns,
+                    max_streams=max_streams,
+                )
+            except Exception as e:
+                errors.append(f"{partner.institution_id}.{table}: {e}")
+                continue
+            result = ExportResult(
+                institution_id=partner.institution_id,
+                table=table,
+                source=f"{project}.{dataset}.{table_name}",
+                path=path,
+                format=format,
+                rows=rows,
+                file_bytes=os.path.getsize(path),
+                streams=streams,
+                seconds=time.monotonic() - start,
+            )
+            bioprint(partner, f"Exported {result.rows} rows of {result.source} to {path}")
+            results.append(result)
+
+    print(format_export_results(results))
+    if errors:
+        msg = "\n\t".join(errors)
+        raise RuntimeError(f"Encountered error(s) exporting the tables:\n\t{msg}")
+    return results
+
+
+def format_export_results(results: List[ExportResult]) -> str:
+    """Formats the results as a table for printing"""
+    lines = [
+        f"{'partner':<20} {'table':<8} {'rows':>12} {'streams':>8} {'seconds':>9} {'rows/s':>12} {'file MB':>9}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r.institution_id:<20} {r.table:<8} {r.rows:>12} {r.streams:>8} {r.seconds:>8.2f}s "
+            f"{r.rows_per_second:>12.0f} {r.file_bytes / 1024**2:>9.2f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,195 @@
+from typing import List, Optional
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import pyarrow
+import pyarrow.parquet
+
+from biomedical_dashboards.biomed.export import EXPORT_FORMATS, LocalArrowSource, export_table
+
+# The number of rows in the fixture table that exports are timed with
+EXPORT_FIXTURE_ROWS = 5_000_000
+
+# The number of rows in each row group of the fixture, which the local source deals out between its streams
+FIXTURE_ROW_GROUP_ROWS = 100_000
+
+# The table that the fixture stands in for
+FIXTURE_TABLE = ("export-benchmark", "fixture_data_latest", "trials")
+
+
+class ExportBenchmarkResult:
+    """The time and memory taken by the export of the fixture table, in a fresh process
+
+    :param format: The format exported to. One of EXPORT_FORMATS
+    :param streams: The number of streams read in parallel
+    :param rows: The number of rows exported
+    :param seconds: The wall time of the export
+    :param baseline_rss: The resident memory of the process before the export, in bytes
+    :param peak_rss: The peak resident memory of the process, in bytes
+    :param file_bytes: The size of the exported file
+    """
+
+    def __init__(
+        self,
+        *,
+        format: str,
+        streams: int,
+        rows: int,
+        seconds: float,
+        baseline_rss: int,
+        peak_rss: int,
+        file_bytes: int,
+    ):
+        self.format = format
+        self.streams = streams
+        self.rows = rows
+        self.seconds = seconds
+        self.baseline_rss = baseline_rss
+        self.peak_rss = peak_rss
+        self.file_bytes = file_bytes
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return dict(
+            format=self.format,
+            streams=self.streams,
+            rows=self.rows,
+            seconds=self.seconds,
+            rows_per_second=self.rows_per_second,
+            baseline_rss=self.baseline_rss,
+            peak_rss=self.peak_rss,
+            file_bytes=self.file_bytes,
+        )
+
+
+def write_fixture(path: str, num_rows: int) -> None:
+    """Writes a parquet file of made-up rows with the kinds of columns of a trials table. The rows are made and written
+    one row group at a time, so the fixture can be much larger than memory
+
+    :param path: The file to write
+    :param num_rows: The number of rows
+    """
+    schema = pyarrow.schema(
+        [
+            ("nct_id", pyarrow.string()),
+            ("registration_date", pyarrow.date32()),
+            ("is_prospective", pyarrow.bool_()),
+            ("summary_results_reporting", pyarrow.string()),
+            ("completion_year", pyarrow.int64()),
+            ("doi", pyarrow.string()),
+        ]
+    )
+    reporting = ["results_timely", "results_due_late", "results_due_missing", "results_not_due"]
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for start in range(0, num_rows, FIXTURE_ROW_GROUP_ROWS):
+            ids = range(start, min(start + FIXTURE_ROW_GROUP_ROWS, num_rows))
+            batch = pyarrow.record_batch(
+                [
+                    pyarrow.array([f"NCT{i:08d}" for i in ids]),
+                    pyarrow.array([i % 9000 + 10000 for i in ids], pyarrow.int32()).cast(pyarrow.date32()),
+                    pyarrow.array([i % 3 == 0 for i in ids]),
+                    pyarrow.array([reporting[i % 4] for i in ids]),
+                    pyarrow.array([2000 + i % 25 for i in ids]),
+                    pyarrow.array([f"10.1000/fixture.{i}" for i in ids]),
+                ],
+                schema=schema,
+            )
+            writer.write_batch(batch)
+
+
+def max_rss() -> int:
+    """The peak resident memory of this process so far, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss() -> int:
+    """The resident memory of this process now, in bytes. The peak so far where it can't be read"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return max_rss()
+
+
+def timed_export(fixture_dir: str, format: str, streams: int, path: str) -> ExportBenchmarkResult:
+    """Exports the fixture and measures it. Run in its own process, so that the peak memory is the export's alone"""
+    project, dataset, table_name = FIXTURE_TABLE
+    baseline_rss = current_rss()
+    start = time.monotonic()
+    rows, num_streams = export_table(
+        LocalArrowSource(path=fixture_dir),
+        project=project,
+        dataset=dataset,
+        table_name=table_name,
+        path=path,
+        format=format,
+        max_streams=streams,
+    )
+    return ExportBenchmarkResult(
+        format=format,
+        streams=num_streams,
+        rows=rows,
+        seconds=time.monotonic() - start,
+        baseline_rss=baseline_rss,
+        peak_rss=max_rss(),
+        file_bytes=os.path.getsize(path),
+    )
+
+
+def benchmark_export(
+    num_rows: int = EXPORT_FIXTURE_ROWS,
+    *,
+    formats: List[str] = ("parquet", "csv"),
+    stream_counts: List[int] = (1, 4),
+    output: Optional[str] = None,
+) -> List[ExportBenchmarkResult]:
+    """Exports a fixture table of num_rows rows from a local Arrow source, with every combination of format and
+    stream count, prints the rows per second and peak memory of each, and optionally writes them to a JSON file.
+    Each export runs in a fresh process. Nothing connects to GCP.
+
+    :param num_rows: The number of rows in the fixture
+    :param formats: The formats to export to. Any of EXPORT_FORMATS
+    :param stream_counts: The numbers of streams to read with
+    :param output: The file to write the results to. Optional
+    :return: The results
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"Writing a fixture of {num_rows} rows")
+        write_fixture(os.path.join(tmp, ".".join(FIXTURE_TABLE) + ".parquet"), num_rows)
+        with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+            for format in formats:
+                for streams in stream_counts:
+                    path = os.path.join(tmp, f"export_{streams}.{EXPORT_FORMATS[format]}")
+                    results.append(pool.apply(timed_export, (tmp, format, streams, path)))
+                    os.remove(path)
+
+    print(format_export_benchmark_results(results))
+    if output:
+        with open(output, "w") as f:
+            json.dump([r.to_dict() for r in results], f, indent=2)
+    return results
+
+
+def format_export_benchmark_results(results: List[ExportBenchmarkResult]) -> str:
+    """Formats the results as a table for printing"""
+    lines = [
+        f"{'format':<8} {'streams':>8} {'rows':>10} {'seconds':>9} {'rows/s':>12} {'base RSS':>10} {'peak RSS':>10} "
+        f"{'file MB':>9}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r.format:<8} {r.streams:>8} {r.rows:>10} {r.seconds:>8.2f}s {r.rows_per_second:>12.0f} "
+            f"{r.baseline_rss / 1024**2:>7.1f} MB {r.peak_rss / 1024**2:>7.1f} MB {r.file_bytes / 1024**2:>9.1f}"
+        )
+    return "\n".join(lines)
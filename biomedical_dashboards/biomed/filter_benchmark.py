@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import json
+import os
+
+from biomedical_dashboards.biomed.config import Config, Context, Partner
+from biomedical_dashboards.biomed.gcp import bq_run_query_job
+from biomedical_dashboards.biomed.preflight import format_bytes
+
+# Queries like those the dashboards run on every page view, keyed by name. Each is a (table, filter) pair where the
+# table is "trials" or "pubs". The filtered values don't need to exist: the bytes scanned only depend on how much of the
+# table the filter lets BigQuery skip.
+DASHBOARD_FILTERS = {
+    "pubs_recent_years": ("pubs", "published_year >= EXTRACT(YEAR FROM CURRENT_DATE()) - 3"),
+    "pubs_single_year": ("pubs", "published_year = 2020"),
+    "pubs_doi_lookup": ("pubs", 'doi = "10.1000/biomed.benchmark"'),
+    "trials_nct_lookup": ("trials", 'nct_id = "NCT00000000"'),
+    "trials_registered_since": ("trials", 'registration_date >= "2020-01-01"'),
+}
+
+
+class FilterResult:
+    """The bytes scanned by one dashboard filter against the same partner table before and after a layout change
+
+    :param institution_id: The partner whose table was queried
+    :param filter_name: The name of the filter. See DASHBOARD_FILTERS
+    :param bytes_before: The bytes scanned from the baseline table. None if it could not be measured
+    :param bytes_after: The bytes scanned from this run's table. None if it could not be measured
+    :param note: Any explanation of the result
+    """
+
+    def __init__(
+        self,
+        *,
+        institution_id: str,
+        filter_name: str,
+        bytes_before: Optional[int],
+        bytes_after: Optional[int],
+        note: str = "",
+    ):
+        self.institution_id = institution_id
+        self.filter_name = filter_name
+        self.bytes_before = bytes_before
+        self.bytes_after = bytes_after
+        self.note = note
+
+    @property
+    def reduction(self) -> Optional[float]:
+        """The fraction of bytes no longer scanned, e.g. 0.9 if the filter scans a tenth of what it did"""
+        if not self.bytes_before or self.bytes_after is None:
+            return None
+        return 1 - self.bytes_after / self.bytes_before
+
+    def to_dict(self) -> dict:
+        return dict(
+            institution_id=self.institution_id,
+            filter_name=self.filter_name,
+            bytes_before=self.bytes_before,
+            bytes_after=self.bytes_after,
+            reduction=self.reduction,
+            note=self.note,
+        )
+
+
+def benchmark_filters(config: Config, baseline_run_version: str) -> List[FilterResult]:
+    """Runs every dashboard filter against each partner's trials and pubs tables from a baseline run and from this
+    run, prints a table of the bytes scanned and writes the results to file.
+
+    The queries are run for real with the query cache disabled. Dry runs can't be used, as they don't account for the
+    blocks skipped by clustering. Each query processes at most the size of the table it reads.
+
+    :param config: The workflow configuration
+    :param baseline_run_version: The run version of the tables to compare against, e.g. a run before the tables were
+    partitioned or clustered
+    :return: The results
+    """
+    context = config.context
+    jobs = [(p, f) for p in config.partners for f in DASHBOARD_FILTERS]
+    with ThreadPoolExecutor(max_workers=context.max_concurrent_jobs) as executor:
+        results = list(executor.map(lambda j: benchmark_filter(j[0], context, j[1], baseline_run_version), jobs))
+
+    print(format_filter_results(results))
+    path = os.path.join(context.output_dir, f"filter_benchmark_{baseline_run_version}_{context.run_version}.json")
+    with open(path, "w") as f:
+        json.dump([r.to_dict() for r in results], f, indent=2)
+    return results
+
+
+def benchmark_filter(partner: Partner, context: Context, filter_name: str, baseline_run_version: str) -> FilterResult:
+    """Measures the bytes scanned by one dashboard filter against the partner's baseline and current tables"""
+    table, condition = DASHBOARD_FILTERS[filter_name]
+    scanned = {}
+    for run_version in [baseline_run_version, context.run_version]:
+        table_name = f"{table}{run_version}"
+        if not context.metadata.table_exists(context.project, partner.output_dataset, table_name):
+            return FilterResult(
+                institution_id=partner.institution_id,
+                filter_name=filter_name,
+                bytes_before=None,
+                bytes_after=None,
+                note=f"table missing: {partner.output_dataset}.{table_name}",
+            )
+        query = f"SELECT * FROM `{context.project}.{partner.output_dataset}.{table_name}` WHERE {condition}"
+        job = bq_run_query_job(
+            context.project,
+            query,
+            maximum_bytes_billed=context.max_bytes_per_query,
+            client=context.client,
+            use_query_cache=False,
+        )
+        scanned[run_version] = job.total_bytes_processed
+    return FilterResult(
+        institution_id=partner.institution_id,
+        filter_name=filter_name,
+        bytes_before=scanned[baseline_run_version],
+        bytes_after=scanned[context.run_version],
+    )
+
+
+def format_filter_results(results: List[FilterResult]) -> str:
+    """Formats the results as a table, one row per partner and filter"""
+    width = max([len(r.institution_id) for r in results] + [len("institution_id")])
+    fwidth = max(len(f) for f in DASHBOARD_FILTERS)
+    lines = [f"{'institution_id':<{width}}  {'filter':<{fwidth}}  {'before':>12}  {'after':>12}  {'saved':>6}  note"]
+    for r in results:
+        before = format_bytes(r.bytes_before) if r.bytes_before is not None else "unknown"
+        after = format_bytes(r.bytes_after) if r.bytes_after is not None else "unknown"
+        saved = f"{r.reduction:.0%}" if r.reduction is not None else ""
+        lines.append(
+            f"{r.institution_id:<{width}}  {r.filter_name:<{fwidth}}  {before:>12}  {after:>12}  {saved:>6}  {r.note}"
+        )
+    before = sum(r.bytes_before or 0 for r in results if r.bytes_after is not None)
+    after = sum(r.bytes_after or 0 for r in results if r.bytes_before is not None)
+    lines.append(f"Total scanned: {format_bytes(before)} before, {format_bytes(after)} after")
+    return "\n".join(lines)
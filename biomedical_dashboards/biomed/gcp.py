@@ -1,11 +1,28 @@
+from __future__ import annotations
+
+import asyncio
 import os
-from typing import Optional
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from biomedical_dashboards.biomed.retry import is_retryable, quota_guard
+
+# The google libraries take most of the CLI's startup time, so they are imported by the functions that use them. A
+# dryrun never imports them
+if TYPE_CHECKING:
+    import pyarrow
+    from google.auth.credentials import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud.bigquery.client import Client
+    from google.cloud.bigquery.dataset import Dataset
+    from google.cloud.bigquery.job import QueryJob, QueryPlanEntry
+    from google.cloud.bigquery.table import RowIterator, Table
+    from google.cloud.bigquery_storage_v1 import BigQueryReadClient
 
-from google.cloud import bigquery
-from google.cloud.bigquery.client import Client
-from google.cloud.bigquery.table import RowIterator, Table
-from google.cloud.bigquery.dataset import Dataset
-from google.api_core.exceptions import NotFound
+T = TypeVar("T")
+
+# The number of tables fetched per page when listing a dataset. 1000 is the most that the API returns
+LIST_PAGE_SIZE = 1000
 
 
 def gcp_set_auth(keyfile: str) -> None:
@@ -15,17 +32,241 @@ def gcp_set_auth(keyfile: str) -> None:
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = keyfile
 
 
-def bq_run_query(project: str, query: str, client: Optional[Client] = None) -> RowIterator:
+def bq_client(project: str) -> Client:
+    """Creates a bigquery client with the default credentials and connection pool"""
+    from google.cloud.bigquery.client import Client
+
+    return Client(project=project)
+
+
+def bq_pooled_client(project: str, pool_size: int) -> Client:
+    """Creates a bigquery client whose HTTP connection pool can hold pool_size connections.
+
+    The default pool holds 10 connections, so with more concurrent tasks than that, connections would be
+    discarded and re-opened rather than reused. The client library has no setting for the pool size, so the client is
+    given its session with the _http constructor argument. It is the only way to supply a session, and the client uses
+    it as given. The client's _http attribute is never read or replaced afterwards.
+
+    :param project: The project to create the client for
+    :param pool_size: The maximum number of connections to keep open
+    :return: The bigquery client
+    """
+    import google.auth
+    from google.cloud.bigquery.client import Client
+
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    return Client(project=project, credentials=credentials, _http=bq_pooled_session(credentials, pool_size))
+
+
+def bq_pooled_session(credentials: Credentials, pool_size: int) -> AuthorizedSession:
+    """Creates an authorized HTTP session whose connection pool can hold pool_size connections. See bq_pooled_client
+
+    :param credentials: The credentials to authorize requests with
+    :param pool_size: The maximum number of connections to keep open
+    :return: The session
+    """
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return session
+
+
+class BQClientPool:
+    """Hands out one shared bigquery client per project, so that credentials are discovered and connections are
+    opened once per run rather than once per call. Clients are created on first use, so nothing is created in dryrun.
+
+    :param pool_size: The size of each client's HTTP connection pool. Should match the number of concurrent tasks.
+    :param client_factory: Creates a client from a project and pool size. This is the execution backend of the
+    workflow: every BigQuery call goes through the clients it creates. Defaults to bq_pooled_client, which connects to
+    BigQuery. SimulatedBigQuery.client (see simulated.py) runs the workflow against an in-memory stand-in instead.
+    """
+
+    def __init__(self, *, pool_size: int = 10, client_factory: Optional[Callable[[str, int], Client]] = None):
+        self.pool_size = pool_size
+        self.client_factory = client_factory if client_factory else bq_pooled_client
+        self.clients_created = 0
+        self.clients_reused = 0
+        self._clients: Dict[str, Client] = {}
+        self._lock = threading.Lock()
+
+    def get(self, project: str) -> Client:
+        """Gets the client for the project, creating it if this is the first time it has been asked for"""
+        with self._lock:
+            if project in self._clients:
+                self.clients_reused += 1
+                return self._clients[project]
+            client = self.client_factory(project, self.pool_size)
+            self._clients[project] = client
+            self.clients_created += 1
+            return client
+
+    def close(self) -> None:
+        """Closes every client and their connections. Clients can be created again afterwards if needed"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+    def stats(self) -> dict:
+        """The client counters. Connections reused is the number of times a client (and its connections) was reused"""
+        return dict(clients_created=self.clients_created, connections_reused=self.clients_reused)
+
+
+def bq_run_query(
+    project: str, query: str, maximum_bytes_billed: Optional[int] = None, client: Optional[Client] = None
+) -> RowIterator:
     """Runs a query in bigquery.
 
     :param project: The name of the project to run the query under.
     :param query: The query to run
+    :param maximum_bytes_billed: If supplied, the query will fail rather than bill more than this many bytes
     :param client: The bigquery client. Created if not supplied.
     :return: The query result as a RowIterator
     """
+    job = bq_run_query_job(project, query, maximum_bytes_billed=maximum_bytes_billed, client=client)
+    return job.result()
+
+
+def bq_run_query_job(
+    project: str,
+    query: str,
+    maximum_bytes_billed: Optional[int] = None,
+    client: Optional[Client] = None,
+    use_query_cache: bool = True,
+) -> QueryJob:
+    """Runs a query in bigquery and waits for it to finish. Unlike bq_run_query, returns the job itself, which holds
+    the job's timings and statistics. Errors submitting the query, and transient failures of the job itself, are
+    retried by submitting the query again. Errors while waiting are retried by polling the same job. See bq_poll_job
+
+    :param project: The name of the project to run the query under.
+    :param query: The query to run
+    :param maximum_bytes_billed: If supplied, the query will fail rather than bill more than this many bytes
+    :param client: The bigquery client. Created if not supplied.
+    :param use_query_cache: Whether the results of an identical earlier query may be reused. Disable to measure the
+    bytes that the query really processes
+    :return: The finished query job
+    """
+    from google.cloud import bigquery
+
+    if not client:
+        client = bq_client(project)
+    config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed, use_query_cache=use_query_cache)
+
+    def _run() -> QueryJob:
+        job = client.query(query, job_config=config)
+        bq_poll_job(job, job.result)
+        return job
+
+    return quota_guard().call("jobs", _run)
+
+
+class JobFailed(Exception):
+    """A job that finished with an error, as opposed to an error while polling it. Carries the job's error out of the
+    retries of the poll. See bq_poll_job"""
+
+    def __init__(self, error: Exception):
+        super().__init__(str(error))
+        self.error = error
+
+
+def bq_poll_job(job, poll: Callable[[], T]) -> T:
+    """Polls a job that has been submitted, e.g. with job.done or job.result. Each poll is a metadata call, so is rate
+    limited and retried by the quota guard, by polling the same job again. A transient error while polling therefore
+    never submits a second, billed copy of a job that is still running.
+
+    Raises the job's own error if it failed (job.error_result is set), which the caller's retry of the job may submit
+    again, as BigQuery recommends for jobs that fail with a transient error. Raises a RuntimeError, which isn't
+    retried, if the job still can't be polled after every attempt.
+
+    :param job: The bigquery job
+    :param poll: The call that polls the job
+    :return: The result of the poll
+    """
+
+    def _poll() -> T:
+        try:
+            return poll()
+        except Exception as e:
+            if getattr(job, "error_result", None):
+                raise JobFailed(e) from e
+            raise
+
+    try:
+        return quota_guard().call("metadata", _poll)
+    except JobFailed as e:
+        raise e.error
+    except Exception as e:
+        if is_retryable(e):
+            raise RuntimeError(f"Gave up polling job {job.job_id}, which may still be running: {e}") from e
+        raise
+
+
+def bq_get_query_plan(project: str, job_id: str, client: Optional[Client] = None) -> dict:
+    """Gets the SQL and the query plan of a finished query job. A script has no plan of its own: each of its statements
+    runs as a child job, so the plan is made up of the plans of its children, in the order that they ran.
+
+    :param project: The project that the job was run under.
+    :param job_id: The id of the job.
+    :param client: The bigquery client. Created if not supplied.
+    :return: dict(job_id, query, query_plan), where query_plan is the list of the plan's stages, as returned by the
+    BigQuery REST API (ExplainQueryStage), each with the index of the statement that it belongs to as "statement"
+    """
+    if not client:
+        client = bq_client(project)
+    job = quota_guard().call("metadata", client.get_job, job_id)
+    statements = [job]
+    if job.num_child_jobs:
+        children = quota_guard().call("metadata", lambda: list(client.list_jobs(parent_job=job)))
+        # The listing holds the children's summaries, so each one is fetched in full for its plan
+        statements = [
+            quota_guard().call("metadata", client.get_job, child.job_id, location=child.location)
+            for child in sorted(children, key=lambda c: c.created)
+        ]
+    query_plan = []
+    for i, statement in enumerate(statements):
+        query_plan += [dict(query_plan_stage(entry), statement=i) for entry in (statement.query_plan or [])]
+    return dict(job_id=job.job_id, query=job.query, query_plan=query_plan)
+
+
+def query_plan_stage(entry: QueryPlanEntry) -> dict:
+    """A stage of a job's query plan (job.query_plan) as returned by the BigQuery REST API (ExplainQueryStage), with
+    the fields that the profile reads. See profile.STAGE_METRICS"""
+    return dict(
+        id=entry.entry_id,
+        name=entry.name,
+        inputStages=[str(i) for i in entry.input_stages],
+        completedParallelInputs=entry.completed_parallel_inputs,
+        slotMs=entry.slot_ms,
+        waitMsAvg=entry.wait_ms_avg,
+        readMsAvg=entry.read_ms_avg,
+        computeMsAvg=entry.compute_ms_avg,
+        writeMsAvg=entry.write_ms_avg,
+        shuffleOutputBytes=entry.shuffle_output_bytes,
+        shuffleOutputBytesSpilled=entry.shuffle_output_bytes_spilled,
+        recordsRead=entry.records_read,
+        recordsWritten=entry.records_written,
+        steps=[dict(kind=step.kind, substeps=list(step.substeps)) for step in entry.steps],
+    )
+
+
+def bq_estimate_query_bytes(project: str, query: str, client: Optional[Client] = None) -> int:
+    """Estimates the number of bytes a query would process by submitting it as a dry run job. Nothing is billed.
+
+    :param project: The name of the project to run the dry run job under.
+    :param query: The query to estimate
+    :param client: The bigquery client. Created if not supplied.
+    :return: The estimated number of bytes processed
+    """
+    from google.cloud import bigquery
+
     if not client:
-        client = Client(project=project)
-    return client.query_and_wait(query)
+        client = bq_client(project)
+    config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    # Dry runs don't start a job, so are limited as metadata calls
+    job = quota_guard().call("metadata", client.query, query, job_config=config)
+    return job.total_bytes_processed
 
 
 def bq_create_dataset(project: str, dataset: str, exists_ok: bool = True, client: Optional[Client] = None) -> Dataset:
@@ -38,8 +279,8 @@ def bq_create_dataset(project: str, dataset: str, exists_ok: bool = True, client
     :return: The dataset object that was created
     """
     if not client:
-        client = Client(project=project)
-    return client.create_dataset(dataset, exists_ok=exists_ok)
+        client = bq_client(project)
+    return quota_guard().call("metadata", client.create_dataset, dataset, exists_ok=exists_ok)
 
 
 def bq_check_table_exists(project: str, dataset: str, table_name: str, client: Client = None) -> bool:
@@ -51,16 +292,114 @@ def bq_check_table_exists(project: str, dataset: str, table_name: str, client: C
     :param client: The bigquery client. Created if not supplied.
     :return: True if table exists, false otherwise
     """
+    from google.api_core.exceptions import NotFound
+
     if not client:
-        client = Client(project=project)
+        client = bq_client(project)
     table_id = f"{project}.{dataset}.{table_name}"
     try:
-        client.get_table(table_id)
+        quota_guard().call("metadata", client.get_table, table_id)
+    except NotFound:
+        return False
+    return True
+
+
+def bq_check_dataset_exists(project: str, dataset: str, client: Client = None) -> bool:
+    """Checks if a dataset exists in bigquery
+
+    :param project: The project that the dataset is stored in.
+    :param dataset: The name of the dataset.
+    :param client: The bigquery client. Created if not supplied.
+    :return: True if dataset exists, false otherwise
+    """
+    from google.api_core.exceptions import NotFound
+
+    if not client:
+        client = bq_client(project)
+    try:
+        quota_guard().call("metadata", client.get_dataset, f"{project}.{dataset}")
     except NotFound:
         return False
     return True
 
 
+def bq_get_table_metadata(
+    project: str, dataset: str, table_name: str, client: Optional[Client] = None
+) -> Optional[dict]:
+    """Gets the metadata of a table that shows whether its content has changed
+
+    :param project: The project that the table is stored in.
+    :param dataset: The dataset that the table is stored in.
+    :param table_name: The name of the table.
+    :param client: The bigquery client. Created if not supplied.
+    :return: The table's last modified time and number of rows. None if the table doesn't exist.
+    """
+    table = bq_get_table(project, dataset, table_name, client=client)
+    return table_metadata(table) if table is not None else None
+
+
+def bq_get_table(project: str, dataset: str, table_name: str, client: Optional[Client] = None) -> Optional[Table]:
+    """Gets a table's full metadata, e.g. its schema and number of rows
+
+    :param project: The project that the table is stored in.
+    :param dataset: The dataset that the table is stored in.
+    :param table_name: The name of the table.
+    :param client: The bigquery client. Created if not supplied.
+    :return: The table. None if the table doesn't exist.
+    """
+    from google.api_core.exceptions import NotFound
+
+    if not client:
+        client = bq_client(project)
+    try:
+        return quota_guard().call("metadata", client.get_table, f"{project}.{dataset}.{table_name}")
+    except NotFound:
+        return None
+
+
+def bq_list_tables(project: str, dataset: str, client: Optional[Client] = None) -> Optional[List[str]]:
+    """Lists the tables (and views) in a dataset. Every page of the listing is fetched in one retried call, so a
+    transient error part of the way through starts the listing again rather than returning part of it.
+
+    :param project: The project that the dataset is stored in.
+    :param dataset: The name of the dataset.
+    :param client: The bigquery client. Created if not supplied.
+    :return: The names of the tables. None if the dataset doesn't exist.
+    """
+    from google.api_core.exceptions import NotFound
+
+    if not client:
+        client = bq_client(project)
+
+    def _list() -> List[str]:
+        return [t.table_id for t in client.list_tables(f"{project}.{dataset}", page_size=LIST_PAGE_SIZE)]
+
+    try:
+        return quota_guard().call("metadata", _list)
+    except NotFound:
+        return None
+
+
+def table_metadata(table: Table) -> dict:
+    """The metadata of a table that shows whether its content has changed: its last modified time and number of rows"""
+    return dict(
+        last_modified=table.modified.isoformat() if table.modified else None,
+        num_rows=table.num_rows,
+    )
+
+
+def table_layout(table: Table) -> Dict[str, object]:
+    """The type (e.g. TABLE or VIEW), time partitioning, range partitioning and clustering fields of a table"""
+    time_partitioning = getattr(table, "time_partitioning", None)
+    range_partitioning = getattr(table, "range_partitioning", None)
+    return dict(
+        table_type=getattr(table, "table_type", None),
+        time_partitioning=time_partitioning.to_api_repr() if time_partitioning else None,
+        range_partitioning=range_partitioning._properties if range_partitioning else None,
+        clustering_fields=getattr(table, "clustering_fields", None),
+    )
+
+
 def bq_copy_table(
     project: str,
     src_dataset: str,
@@ -69,6 +408,7 @@ def bq_copy_table(
     dest_table_name: str,
     overwrite: bool = False,
     client: Optional[Client] = None,
+    check_source: bool = True,
 ):
     """Copies a bigquery table to another destination within the same project
 
@@ -79,18 +419,28 @@ def bq_copy_table(
     :param dest_table_name: The table name to copy the source table to
     :param overwrite: If true, will overwrite any existing table
     :client: The bigquery client. Created if not supplied
+    :param check_source: Whether to check that the source table exists first, with a metadata call. Callers that
+    already know it exists (e.g. from the run's MetadataCache) can skip the check. The copy fails either way
     """
+    from google.cloud import bigquery
+
     if not client:
-        client = Client(project=project)
+        client = bq_client(project)
     src_table_id = f"{project}.{src_dataset}.{src_table_name}"
     dest_table_id = f"{project}.{dest_dataset}.{dest_table_name}"
-    if not bq_check_table_exists(project=project, dataset=src_dataset, table_name=src_table_name, client=client):
+    if check_source and not bq_check_table_exists(
+        project=project, dataset=src_dataset, table_name=src_table_name, client=client
+    ):
         raise RuntimeError(f"Table not found: {src_table_id}")
 
     config = bigquery.CopyJobConfig()
     config.write_disposition = "WRITE_TRUNCATE" if overwrite else "WRITE_EMPTY"
-    job = client.copy_table(sources=src_table_id, destination=dest_table_id, job_config=config)
-    job.result()
+
+    def _copy() -> None:
+        job = client.copy_table(sources=src_table_id, destination=dest_table_id, job_config=config)
+        bq_poll_job(job, job.result)
+
+    quota_guard().call("jobs", _copy)
 
 
 def bq_delete_table(
@@ -105,9 +455,45 @@ def bq_delete_table(
     :param not_found_ok: If true, will not raise an error if the table is not found
     """
     if not client:
-        client = Client(project=project)
-    table = client.get_table(f"{project}.{dataset}.{table_name}")
-    client.delete_table(table, not_found_ok=not_found_ok)
+        client = bq_client(project)
+    table_id = f"{project}.{dataset}.{table_name}"
+    quota_guard().call("metadata", client.delete_table, table_id, not_found_ok=not_found_ok)
+
+
+def bq_set_table_description(
+    project: str, dataset: str, table_name: str, description: str, client: Optional[Client] = None
+) -> None:
+    """Sets the description of a table, leaving the rest of its metadata as it is
+
+    :param project: The project that the table is stored in.
+    :param dataset: The dataset that the table is stored in.
+    :param table_name: The name of the table.
+    :param description: The description.
+    :param client: The bigquery client. Created if not supplied.
+    """
+    from google.cloud.bigquery import Table
+
+    if not client:
+        client = bq_client(project)
+    table = Table(f"{project}.{dataset}.{table_name}")
+    table.description = description
+    quota_guard().call("metadata", client.update_table, table, ["description"])
+
+
+def bq_get_table_layout(
+    project: str, dataset: str, table_name: str, client: Optional[Client] = None
+) -> Optional[Dict[str, object]]:
+    """Gets the partitioning and clustering of a table, for comparing the layouts of two tables
+
+    :param project: The project that the table is stored in.
+    :param dataset: The dataset that the table is stored in.
+    :param table_name: The name of the table.
+    :param client: The bigquery client. Created if not supplied.
+    :return: The table's type (e.g. TABLE or VIEW), time partitioning, range partitioning and clustering fields.
+    None if the table does not exist
+    """
+    table = bq_get_table(project, dataset, table_name, client=client)
+    return table_layout(table) if table is not None else None
 
 
 def bq_get_view_content(project: str, dataset: str, view_name: str, client: Optional[Client] = None) -> str:
@@ -123,9 +509,9 @@ def bq_get_view_content(project: str, dataset: str, view_name: str, client: Opti
     :return: The content of the view
     """
     if not client:
-        client = Client(project=project)
+        client = bq_client(project)
     view_id = f"{project}.{dataset}.{view_name}"
-    view = client.get_table(view_id)  # Can raise NotFound if not exists.
+    view = quota_guard().call("metadata", client.get_table, view_id)  # Can raise NotFound if not exists.
     if view.view_query:
         return view.view_query
     else:
@@ -145,12 +531,165 @@ def bq_create_view(
     :param view_content: The content of the view.
     :param client: The bigquery client. Created if not supplied.
     """
+    from google.cloud.bigquery.table import Table
+
     if not client:
-        client = Client(project=project)
+        client = bq_client(project)
     view_id = f"{project}.{dataset}.{view_name}"
     if bq_check_table_exists(project=project, dataset=dataset, table_name=view_name, client=client):
         raise RuntimeError(f"Attempted to create view that already exists: {view_id}")
 
     table = Table(view_id)
     table.view_query = view_content
-    client.create_table(table)
+    quota_guard().call("metadata", client.create_table, table)
+
+
+def bq_storage_client() -> BigQueryReadClient:
+    """Creates a client of the BigQuery Storage Read API, with the default credentials. Needs the export extra:
+    pip install 'biomedical-dashboards[export]'"""
+    try:
+        from google.cloud.bigquery_storage_v1 import BigQueryReadClient
+    except ImportError as e:
+        raise RuntimeError(
+            "Reading tables with the Storage Read API needs google-cloud-bigquery-storage and pyarrow. Install them "
+            "with: pip install 'biomedical-dashboards[export]'"
+        ) from e
+    return BigQueryReadClient()
+
+
+def bq_read_table_streams(
+    project: str,
+    dataset: str,
+    table_name: str,
+    columns: Optional[List[str]] = None,
+    max_streams: int = 1,
+    client: Optional[BigQueryReadClient] = None,
+) -> Tuple[pyarrow.Schema, List[Iterator[pyarrow.RecordBatch]]]:
+    """Opens a Storage Read API session on a table, which splits the table's rows between up to max_streams streams
+    that can be read in parallel. Rows are read as Arrow record batches, without running a query or paging through
+    the REST API. The session is billed to the table's project. Views can't be read, only tables.
+
+    Creating the session is retried by the quota guard. A stream that is interrupted by a transient error resumes
+    from the last row it read.
+
+    :param project: The project that the table is stored in.
+    :param dataset: The dataset that the table is stored in.
+    :param table_name: The name of the table.
+    :param columns: The columns to read. Only these columns are read from storage. Defaults to every column.
+    :param max_streams: The most streams to split the rows between. BigQuery may create fewer, e.g. for a small table
+    :param client: The Storage Read API client. Created if not supplied.
+    :return: The schema of the rows, and an iterator of the record batches of each stream
+    """
+    import pyarrow.ipc
+    from google.cloud.bigquery_storage_v1 import types
+
+    if not client:
+        client = bq_storage_client()
+    read_session = types.ReadSession(
+        table=f"projects/{project}/datasets/{dataset}/tables/{table_name}",
+        data_format=types.DataFormat.ARROW,
+        read_options=types.ReadSession.TableReadOptions(selected_fields=columns or []),
+    )
+    session = quota_guard().call(
+        "metadata",
+        client.create_read_session,
+        parent=f"projects/{project}",
+        read_session=read_session,
+        max_stream_count=max_streams,
+    )
+    schema = pyarrow.ipc.read_schema(pyarrow.py_buffer(session.arrow_schema.serialized_schema))
+
+    def _read(stream_name: str) -> Iterator[pyarrow.RecordBatch]:
+        for page in client.read_rows(stream_name).rows(session).pages:
+            yield page.to_arrow()
+
+    return schema, [_read(stream.name) for stream in session.streams]
+
+
+async def bq_wait_for_job_async(job, poll_interval: float = 1.0, max_poll_interval: float = 30.0) -> None:
+    """Waits for a bigquery job to finish by polling it, without holding a thread while waiting.
+    The time between polls backs off exponentially from poll_interval to max_poll_interval.
+
+    Raises the job's error if it failed. Each poll is a metadata call, so is rate limited and retried by the quota
+    guard without submitting the job again. See bq_poll_job
+
+    :param job: The bigquery job to wait for
+    :param poll_interval: The initial number of seconds between polls
+    :param max_poll_interval: The maximum number of seconds between polls
+    """
+    delay = poll_interval
+    while not await asyncio.to_thread(bq_poll_job, job, job.done):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_poll_interval)
+    await asyncio.to_thread(bq_poll_job, job, job.result)
+
+
+async def bq_run_query_job_async(
+    project: str,
+    query: str,
+    maximum_bytes_billed: Optional[int] = None,
+    client: Optional[Client] = None,
+    poll_interval: float = 1.0,
+    max_poll_interval: float = 30.0,
+) -> QueryJob:
+    """Awaitable version of bq_run_query_job. Submits the query as a job and polls it until it finishes.
+
+    :param project: The name of the project to run the query under.
+    :param query: The query to run
+    :param maximum_bytes_billed: If supplied, the query will fail rather than bill more than this many bytes
+    :param client: The bigquery client. Created if not supplied.
+    :param poll_interval: The initial number of seconds between polls of the job
+    :param max_poll_interval: The maximum number of seconds between polls of the job
+    :return: The finished query job
+    """
+    from google.cloud import bigquery
+
+    if not client:
+        client = bq_client(project)
+    config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed)
+
+    async def _run() -> QueryJob:
+        job = await asyncio.to_thread(client.query, query, job_config=config)
+        await bq_wait_for_job_async(job, poll_interval=poll_interval, max_poll_interval=max_poll_interval)
+        return job
+
+    return await quota_guard().call_async("jobs", _run)
+
+
+async def bq_check_table_exists_async(project: str, dataset: str, table_name: str, client: Client = None) -> bool:
+    """Awaitable version of bq_check_table_exists"""
+    return await asyncio.to_thread(bq_check_table_exists, project, dataset, table_name, client=client)
+
+
+async def bq_copy_table_async(
+    project: str,
+    src_dataset: str,
+    src_table_name: str,
+    dest_dataset: str,
+    dest_table_name: str,
+    overwrite: bool = False,
+    client: Optional[Client] = None,
+    poll_interval: float = 1.0,
+    max_poll_interval: float = 30.0,
+    check_source: bool = True,
+) -> None:
+    """Awaitable version of bq_copy_table. Submits the copy job and polls it until it finishes."""
+    from google.cloud import bigquery
+
+    if not client:
+        client = bq_client(project)
+    src_table_id = f"{project}.{src_dataset}.{src_table_name}"
+    dest_table_id = f"{project}.{dest_dataset}.{dest_table_name}"
+    if check_source and not await bq_check_table_exists_async(project, src_dataset, src_table_name, client=client):
+        raise RuntimeError(f"Table not found: {src_table_id}")
+
+    config = bigquery.CopyJobConfig()
+    config.write_disposition = "WRITE_TRUNCATE" if overwrite else "WRITE_EMPTY"
+
+    async def _copy() -> None:
+        job = await asyncio.to_thread(
+            client.copy_table, sources=src_table_id, destination=dest_table_id, job_config=config
+        )
+        await bq_wait_for_job_async(job, poll_interval=poll_interval, max_poll_interval=max_poll_interval)
+
+    await quota_guard().call_async("jobs", _copy)
@@ -4,3 +4,13 @@ from biomedical_dashboards.biomed.config import Partner
 def bioprint(partner: Partner, log: str):
     """Basic logging"""
     print(f"{partner.institution_id} :: {log}")
+
+
+def sharedprint(log: str):
+    """Basic logging for the stages shared by all partners"""
+    print(f"shared :: {log}")
+
+
+def watchprint(log: str):
+    """Basic logging for the watch mode"""
+    print(f"watch :: {log}")
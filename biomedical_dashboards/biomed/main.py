@@ -1,32 +1,76 @@
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import json
 import os
-import traceback
+import sys
 import yaml
 
+from biomedical_dashboards.biomed.checkpoint import CheckpointStore
+from biomedical_dashboards.biomed.cohort_workflow import cohort_tasks
 from biomedical_dashboards.biomed.config import Config
+from biomedical_dashboards.biomed.filter_benchmark import benchmark_filters
 from biomedical_dashboards.biomed.gcp import gcp_set_auth
-from biomedical_dashboards.biomed.partner_workflow import partner_workflow
+from biomedical_dashboards.biomed.partner_workflow import partner_tasks
+from biomedical_dashboards.biomed.preflight import preflight
+from biomedical_dashboards.biomed.profile import profile_run
+from biomedical_dashboards.biomed.retry import set_quota_guard
+from biomedical_dashboards.biomed.scheduler import TaskGraph
+from biomedical_dashboards.biomed.shared_workflow import prepared_shared_tasks, shared_tasks
+from biomedical_dashboards.biomed.sharding import merge_shards, shard_config, write_shard_result
+from biomedical_dashboards.biomed.verify import (
+    ALLTRIALS_SAMPLE_PERCENT,
+    verify_alltrials_delta,
+    verify_cohort,
+    verify_pubs,
+)
+from biomedical_dashboards.biomed.watch import MAX_DELAY, POLL_INTERVAL, QUIET_PERIOD, Watcher
 
+# The stages of the workflow that a process can run. "all" runs everything. A sharded run is split into "shared",
+# which is run once by biomed prepare, then "partners" for each shard of the partners
+STAGES = ("all", "shared", "partners")
 
-def workflow(config: Config):
-    """Does all of the things."""
 
-    if config.context.dryrun == False:
-        gcp_set_auth(config.context.keyfile)
+@contextmanager
+def backend_session(
+    config: Config, uses: Optional[str] = None, connect: bool = True, report: bool = True
+) -> Iterator[None]:
+    """Connects to the config's backend for the commands in the with block. Authenticates with GCP on the bigquery
+    backend only (the simulated backend needs no credentials), and afterwards closes the BigQuery clients and prints
+    the quota report, whether or not the block raised.
+
+    :param config: The workflow configuration
+    :param uses: What the command does with BigQuery, e.g. "The pubs verification runs queries". The command can't be
+    used with dryrun: True if given. None if it works in dryrun, in which case nothing is authenticated
+    :param connect: Whether the command reads from the backend at all. If not, the block is run as it is
+    :param report: Whether to print the quota report afterwards
+    """
+    context = config.context
+    if not connect:
+        yield
+        return
+    if context.dryrun == True:
+        if uses:
+            raise RuntimeError(f"{uses}, so can't be used with dryrun: True")
+    elif context.backend == "bigquery":
+        gcp_set_auth(context.keyfile)
         print("Set authentication with GCP")
+    try:
+        yield
+    finally:
+        context.clients.close()
+        if report:
+            print(context.quota.report())
 
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        futures = {}
-        for partner in config.partners:
-            futures[partner.institution_id] = executor.submit(partner_workflow, partner, config.context)
 
-    errors = {}
-    for id, f in futures.items():
-        try:
-            f.result()
-        except Exception:
-            errors[id] = traceback.format_exc()
+def workflow(config: Config, stages: str = "all"):
+    """Does all of the things. Raises a RuntimeError listing every task that failed. If the run is sharded, writes
+    the shard's result for biomed merge first"""
+
+    graph = run_workflow(config, stages=stages)
+    if config.context.sharded:
+        print(f"Shard result written to file: {write_shard_result(config, graph)}")
+    errors = graph.errors()
 
     if errors:
         msg = ""
@@ -40,20 +84,437 @@ def workflow(config: Config):
     print("Biomed workflow completed successfuly!")
 
 
-def main():
+def build_graph(config: Config, stages: str = "all", checkpoint: Optional[CheckpointStore] = None) -> TaskGraph:
+    """Builds the graph of every task of the workflow. Shared stages must finish before any partner runs its queries,
+    and with the cohort execution mode, the cohort's queries before any partner's trials and pubs
+
+    :param config: The workflow configuration
+    :param stages: The stages to run. One of STAGES
+    :param checkpoint: The run's checkpoint, if any. See TaskGraph
+    :return: The graph
+    """
+    graph = TaskGraph(checkpoint=checkpoint)
+    if stages == "partners":
+        shared = [graph.add(t) for t in prepared_shared_tasks(config)]
+    else:
+        shared = [graph.add(t) for t in shared_tasks(config)]
+    if stages != "shared":
+        for partner in config.partners:
+            for t in partner_tasks(partner, config.context, deps=[t.name for t in shared]):
+                graph.add(t)
+        if config.context.execution_mode == "cohort":
+            for t in cohort_tasks(config, deps=[t.name for t in shared]):
+                graph.add(t)
+    return graph
+
+
+def run_workflow(config: Config, stages: str = "all") -> TaskGraph:
+    """Runs every task of the workflow and prints the run's reports. Tasks that fail are recorded in the returned graph
+    rather than raised. See workflow
+
+    :param config: The workflow configuration
+    :param stages: The stages to run. One of STAGES. With "partners", the shared stages must have been run already
+    """
+
+    set_quota_guard(config.context.quota)
+    # The quota report is printed with the run's other reports below
+    with backend_session(config, report=False):
+        # Estimate the cost of every query before spending any money. Raises if over budget
+        if config.context.estimate or (config.context.budgeted and not config.context.dryrun):
+            preflight(config)
+
+        checkpoint = None
+        if not config.context.dryrun:
+            checkpoint = CheckpointStore(
+                os.path.join(config.context.output_dir, config.context.checkpoint_fname),
+                workflow_hash=config.context.workflow_hash,
+                resume=config.context.resume,
+            )
+        graph = build_graph(config, stages=stages, checkpoint=checkpoint)
+        if config.context.engine == "asyncio":
+            graph.run_async(max_concurrent=config.context.max_concurrent_jobs, max_threads=config.context.max_threads)
+        else:
+            graph.run(max_workers=config.context.max_concurrent_jobs)
+    print(graph.critical_path_report())
+    print(f"BigQuery clients: {config.context.clients.stats()}")
+    print(f"Metadata cache: {config.context.metadata.stats()}")
+    print(config.context.quota.report())
+    if checkpoint and config.context.resume:
+        print(checkpoint.report())
+    if not config.context.dryrun:
+        print(config.context.manifest.report())
+        config.context.manifest.save_report(
+            os.path.join(config.context.output_dir, config.context.incremental_report_fname)
+        )
+        print(config.context.telemetry.summary_report())
+        with open(os.path.join(config.context.output_dir, config.context.telemetry_summary_fname), "w") as f:
+            json.dump(config.context.telemetry.summary(), f, indent=2)
+    return graph
+
+
+COMMANDS = (
+    "run",
+    "prepare",
+    "merge",
+    "export",
+    "benchmark-filters",
+    "benchmark",
+    "benchmark-startup",
+    "benchmark-export",
+    "verify-pubs",
+    "verify-alltrials-delta",
+    "verify-cohort",
+    "profile",
+    "watch",
+)
+
+
+def load_config(path: str) -> Config:
+    """Loads and validates the workflow configuration from a yaml file"""
+    with open(path, "r") as f:
+        yaml_cfg = yaml.safe_load(f)
+    return Config.from_dict(yaml_cfg)
+
+
+def main(argv: Optional[List[str]] = None):
     parser = argparse.ArgumentParser(
         description="Biomedical dashboard workflow. Creates and optionally runs the dashboard queries."
     )
-    parser.add_argument(
-        "config",
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    config_help = "The config file containing the run information. See example_config.yaml for an example of the config expectations."
+
+    run_parser = subparsers.add_parser("run", help="Run the workflow. The default if no command is given.")
+    run_parser.add_argument("config", type=str, help=config_help)
+    run_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run every query, even those whose query and inputs are unchanged since the last run.",
+    )
+    run_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume a failed run of the same run version. Stages that completed are not repeated once their outputs are confirmed to exist.",
+    )
+    run_parser.add_argument(
+        "--shard-index",
+        type=int,
+        help="Run only this shard of the partners, from 0. The shared stages must have been run with biomed prepare.",
+    )
+    run_parser.add_argument("--shard-count", type=int, help="The number of shards that the partners are split into.")
+
+    prepare_parser = subparsers.add_parser(
+        "prepare", help="Run the shared stages of a sharded run, once, before starting the shards."
+    )
+    prepare_parser.add_argument("config", type=str, help=config_help)
+    prepare_parser.add_argument(
+        "--resume", action="store_true", help="Resume a failed prepare of the same run version."
+    )
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="Combine the results of every shard of a sharded run into one run report."
+    )
+    merge_parser.add_argument("config", type=str, help=config_help)
+    merge_parser.add_argument("--shard-count", type=int, required=True, help="The number of shards in the run.")
+    merge_parser.add_argument(
+        "--results",
         type=str,
-        help="The config file containing the run information. See example_config.yaml for an example of the config expectations.",
+        nargs="+",
+        help="Directories holding the shards' results, e.g. each machine's output directory. Defaults to the output directory.",
     )
-    args = parser.parse_args()
-    with open(args.config, "r") as f:
-        yaml_cfg = yaml.safe_load(f)
-    config: Config = Config.from_dict(yaml_cfg)
-    workflow(config)
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Download each partner's latest tables to local Parquet or CSV files, through the BigQuery Storage Read API.",
+    )
+    export_parser.add_argument("config", type=str, help=config_help)
+    export_parser.add_argument(
+        "--tables", nargs="+", default=["trials", "pubs"], choices=["trials", "pubs"], help="Tables to export."
+    )
+    export_parser.add_argument("--format", default="parquet", choices=["parquet", "csv"], help="Format of the files.")
+    export_parser.add_argument("--columns", nargs="+", help="Columns to export. Defaults to every column.")
+    export_parser.add_argument(
+        "--partners", nargs="+", help="The institution_ids of the partners to export. Defaults to every partner."
+    )
+    export_parser.add_argument("--max-streams", type=int, default=4, help="Streams to read each table with at once.")
+    export_parser.add_argument(
+        "--dest",
+        type=str,
+        help="Directory to write the files to. Defaults to the export directory of the output directory.",
+    )
+    export_parser.add_argument(
+        "--local-source",
+        type=str,
+        help="Read the tables from the parquet files PROJECT.DATASET.TABLE.parquet in this directory instead of BigQuery.",
+    )
+
+    bench_parser = subparsers.add_parser(
+        "benchmark-filters",
+        help="Report the bytes scanned by typical dashboard filters on this run's tables and on a baseline run's tables.",
+    )
+    bench_parser.add_argument("config", type=str, help=config_help)
+    bench_parser.add_argument(
+        "--baseline", type=str, required=True, help="The run version of the tables to compare against."
+    )
+
+    verify_parser = subparsers.add_parser(
+        "verify-pubs",
+        help="Run the legacy and the current pubs query for each partner and check that their outputs are the same.",
+    )
+    verify_parser.add_argument("config", type=str, help=config_help)
+    verify_parser.add_argument(
+        "--fixtures",
+        type=str,
+        help="A dataset of small fixture tables (doi, unpaywall, alltrials) to read instead of the Academic Observatory.",
+    )
+    verify_parser.add_argument("--keep", action="store_true", help="Keep the output tables of both queries.")
+
+    delta_parser = subparsers.add_parser(
+        "verify-alltrials-delta",
+        help="Check that the incrementally built shared alltrials extract is the same as a full extraction, for a "
+        "sample of DOIs.",
+    )
+    delta_parser.add_argument("config", type=str, help=config_help)
+    delta_parser.add_argument(
+        "--sample-percent",
+        type=int,
+        default=ALLTRIALS_SAMPLE_PERCENT,
+        help="The percentage of DOIs to compare.",
+    )
+    delta_parser.add_argument("--keep", action="store_true", help="Keep the sampled tables.")
+
+    cohort_parser = subparsers.add_parser(
+        "verify-cohort",
+        help="Check that each partner's trials and pubs tables from a cohort run are the same as the partner's own "
+        "queries make.",
+    )
+    cohort_parser.add_argument("config", type=str, help=config_help)
+    cohort_parser.add_argument("--keep", action="store_true", help="Keep the output tables of the partners' queries.")
+
+    profile_parser = subparsers.add_parser(
+        "profile",
+        help="Attribute the slot time, shuffle and records of a run's query jobs to the sections of their templates, "
+        "and compare them to a baseline run's.",
+    )
+    profile_parser.add_argument("config", type=str, help=config_help)
+    profile_parser.add_argument(
+        "--run-version", type=str, help="The run version to profile. Defaults to the config's run_version."
+    )
+    profile_parser.add_argument("--templates", nargs="+", help="The templates to profile, e.g. pubs. Defaults to all.")
+    profile_parser.add_argument(
+        "--partners",
+        nargs="+",
+        help="The institution_ids of the partners to profile, or 'shared' for the shared queries. Defaults to all.",
+    )
+    profile_parser.add_argument(
+        "--baseline", type=str, help="A previously profiled run version to compare against. Fails on regressions."
+    )
+    profile_parser.add_argument(
+        "--plans",
+        nargs="+",
+        help="Recorded query plan files, or directories of them, to profile instead of fetching the jobs from BigQuery.",
+    )
+    profile_parser.add_argument("--top", type=int, default=5, help="The costliest sections of each job to print.")
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Poll the partners' static datasets and the DOI table for new inputs, and rebuild the partners they affect.",
+    )
+    watch_parser.add_argument("config", type=str, help=config_help)
+    watch_parser.add_argument(
+        "--poll-interval", type=float, default=POLL_INTERVAL, help="Seconds between polls of the inputs."
+    )
+    watch_parser.add_argument(
+        "--quiet-period",
+        type=float,
+        default=QUIET_PERIOD,
+        help="Seconds that the inputs must go unchanged before rebuilding, so that a burst of uploads is rebuilt once.",
+    )
+    watch_parser.add_argument(
+        "--max-delay",
+        type=float,
+        default=MAX_DELAY,
+        help="The longest that a rebuild waits for the inputs to go quiet, in seconds from the first change seen.",
+    )
+    watch_parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Poll once, rebuild straight away if any inputs have changed, then exit. E.g. to run from a scheduler.",
+    )
+
+    sim_parser = subparsers.add_parser(
+        "benchmark",
+        help="Measure the workflow's orchestration overhead by running synthetic configs against a simulated BigQuery.",
+    )
+    sim_parser.add_argument("--partners", type=int, nargs="+", default=[1, 10, 100, 500], help="Partner counts to run.")
+    sim_parser.add_argument(
+        "--engine", nargs="+", default=["threads"], choices=["threads", "asyncio"], help="Engines to run."
+    )
+    sim_parser.add_argument("--max-concurrent-jobs", type=int, default=20, help="Tasks to run at once.")
+    sim_parser.add_argument("--job-latency", type=float, default=0.05, help="Seconds each simulated job runs for.")
+    sim_parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds each simulated API call takes.")
+    sim_parser.add_argument(
+        "--quota-concurrent-jobs", type=int, default=100, help="Jobs the simulated BigQuery runs at once."
+    )
+    sim_parser.add_argument(
+        "--transient-error-rate", type=float, default=0.0, help="Probability of each API call or job failing."
+    )
+    sim_parser.add_argument(
+        "--api-calls-per-second", type=float, help="Rate limit of API calls. Unlimited if not given."
+    )
+    sim_parser.add_argument(
+        "--jobs-per-second", type=float, help="Rate limit of job submissions. Unlimited if not given."
+    )
+    sim_parser.add_argument("--output", type=str, help="JSON file to write the results to.")
+
+    startup_parser = subparsers.add_parser(
+        "benchmark-startup",
+        help="Time a dryrun of a synthetic config in a fresh process. Fails if it is over budget or loads the Google Cloud libraries.",
+    )
+    startup_parser.add_argument("--partners", type=int, default=100, help="Partners in the synthetic config.")
+    startup_parser.add_argument("--budget", type=float, default=3.0, help="The most seconds that the dryrun may take.")
+    startup_parser.add_argument(
+        "--repeats", type=int, default=3, help="Timed runs. The fastest is compared to the budget."
+    )
+    startup_parser.add_argument("--output", type=str, help="JSON file to write the result to.")
+
+    export_bench_parser = subparsers.add_parser(
+        "benchmark-export",
+        help="Measure the rows per second and peak memory of exporting a large fixture table from a local Arrow source.",
+    )
+    export_bench_parser.add_argument("--rows", type=int, default=5_000_000, help="Rows in the fixture table.")
+    export_bench_parser.add_argument(
+        "--format", nargs="+", default=["parquet", "csv"], choices=["parquet", "csv"], help="Formats to export to."
+    )
+    export_bench_parser.add_argument(
+        "--streams", type=int, nargs="+", default=[1, 4], help="Stream counts to read with."
+    )
+    export_bench_parser.add_argument("--output", type=str, help="JSON file to write the results to.")
+
+    # 'biomed CONFIG' is short for 'biomed run CONFIG'
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] not in COMMANDS and argv[0] not in ("-h", "--help"):
+        argv = ["run", *argv]
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark":
+        # Imported here, as the benchmark runs the workflow from this module
+        from biomedical_dashboards.biomed.benchmark import run_benchmarks
+
+        simulation = dict(
+            job_latency=args.job_latency,
+            api_latency=args.api_latency,
+            max_concurrent_jobs=args.quota_concurrent_jobs,
+            transient_error_rate=args.transient_error_rate,
+        )
+        run_benchmarks(
+            args.partners,
+            args.engine,
+            max_concurrent_jobs=args.max_concurrent_jobs,
+            simulation=simulation,
+            api_calls_per_second=args.api_calls_per_second,
+            jobs_per_second=args.jobs_per_second,
+            output=args.output,
+        )
+        return
+
+    if args.command == "benchmark-startup":
+        from biomedical_dashboards.biomed.startup_benchmark import benchmark_startup
+
+        result = benchmark_startup(args.partners, budget=args.budget, repeats=args.repeats, output=args.output)
+        if not result.passed:
+            raise RuntimeError("The dryrun startup regressed. See the result above")
+        return
+
+    if args.command == "benchmark-export":
+        # Imported here, as the export needs the optional export dependencies
+        from biomedical_dashboards.biomed.export_benchmark import benchmark_export
+
+        benchmark_export(args.rows, formats=args.format, stream_counts=args.streams, output=args.output)
+        return
+
+    config = load_config(args.config)
+    set_quota_guard(config.context.quota)
+    if args.command == "run":
+        config.context.force = args.force
+        config.context.resume = args.resume
+        if (args.shard_index is None) != (args.shard_count is None):
+            raise RuntimeError("--shard-index and --shard-count must be given together")
+        if args.shard_count is not None:
+            workflow(shard_config(config, args.shard_index, args.shard_count), stages="partners")
+        else:
+            workflow(config)
+    elif args.command == "prepare":
+        config.context.resume = args.resume
+        workflow(config, stages="shared")
+    elif args.command == "merge":
+        merge_shards(config, args.shard_count, dirs=args.results)
+    elif args.command == "export":
+        from biomedical_dashboards.biomed.export import LocalArrowSource, export_latest_tables
+
+        if args.partners:
+            unknown = sorted(set(args.partners) - {p.institution_id for p in config.partners})
+            if unknown:
+                raise RuntimeError(f"Partner(s) not in the config: {', '.join(unknown)}")
+            config.partners = [p for p in config.partners if p.institution_id in args.partners]
+        source = LocalArrowSource(path=args.local_source) if args.local_source else None
+        if source is None and config.context.dryrun != True and config.context.backend != "bigquery":
+            raise RuntimeError(f"The {config.context.backend} backend has no rows to export, use --local-source")
+        with backend_session(config, uses="The export reads from BigQuery", connect=source is None):
+            export_latest_tables(
+                config,
+                source=source,
+                tables=tuple(args.tables),
+                format=args.format,
+                columns=args.columns,
+                max_streams=args.max_streams,
+                dest=args.dest,
+            )
+    elif args.command == "benchmark-filters":
+        with backend_session(config, uses="The filter benchmark runs queries"):
+            benchmark_filters(config, baseline_run_version=args.baseline)
+    elif args.command == "verify-pubs":
+        with backend_session(config, uses="The pubs verification runs queries"):
+            results = verify_pubs(config, fixture_dataset=args.fixtures, keep=args.keep)
+        different = [r.name for r in results if not r.equal]
+        if different:
+            raise RuntimeError(f"The pubs queries' outputs differ for: {', '.join(different)}")
+    elif args.command == "verify-alltrials-delta":
+        with backend_session(config, uses="The alltrials verification runs queries"):
+            result = verify_alltrials_delta(config, sample_percent=args.sample_percent, keep=args.keep)
+        if not result.equal:
+            raise RuntimeError("The incremental alltrials extract differs from a full extraction")
+    elif args.command == "verify-cohort":
+        with backend_session(config, uses="The cohort verification runs queries"):
+            results = verify_cohort(config, keep=args.keep)
+        different = [r.name for r in results if not r.equal]
+        if different:
+            raise RuntimeError(f"The cohort's tables differ from the partners' own queries for: {', '.join(different)}")
+    elif args.command == "profile":
+        if not args.plans and config.context.dryrun != True and config.context.backend != "bigquery":
+            raise RuntimeError(f"The {config.context.backend} backend's jobs have no query plans, use --plans")
+        with backend_session(config, uses="The profile fetches the query plans from BigQuery", connect=not args.plans):
+            changes = profile_run(
+                config,
+                run_version=args.run_version,
+                templates=args.templates,
+                partners=args.partners,
+                plans=args.plans,
+                baseline=args.baseline,
+                top=args.top,
+            )[1]
+        regressions = [f"{c.institution_id}.{c.template}: {c.section}" for c in changes if c.regressed]
+        if regressions:
+            raise RuntimeError(f"The slot time of these sections regressed: {', '.join(regressions)}")
+    elif args.command == "watch":
+        with backend_session(config, uses="The watch mode runs queries", report=False):
+            watcher = Watcher(
+                config=config,
+                run_workflow=run_workflow,
+                poll_interval=args.poll_interval,
+                quiet_period=0 if args.once else args.quiet_period,
+                max_delay=args.max_delay,
+            )
+            watcher.run(max_polls=1 if args.once else None)
 
 
 if __name__ == "__main__":
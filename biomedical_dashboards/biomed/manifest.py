@@ -0,0 +1,137 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import hashlib
+import json
+import os
+import threading
+
+
+class RunManifest:
+    """A record of the fingerprint of each partner query's output, kept between runs so that queries whose rendered
+    SQL and inputs have not changed can be skipped. Also keeps a report of what was run or skipped in this run, and why.
+
+    The manifest is stored as a JSON lines file with one record per line. Each record is appended as it is made, so
+    saving takes the same time however many partners there are. Later records replace earlier records of the same
+    partner and query when loaded, and the file is compacted on load once it has built up superseded records.
+
+    :param path: The location of the manifest file. Created on the first save if it doesn't exist.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Dict[str, Dict[str, dict]] = {}
+        self.decisions: List[dict] = []
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+
+    def get(self, institution_id: str, query_name: str) -> Optional[dict]:
+        """Gets the record of the last successful run of a query for a partner. None if there is no record"""
+        with self._lock:
+            return self.records.get(institution_id, {}).get(query_name)
+
+    def record(
+        self, *, institution_id: str, query_name: str, fingerprint: str, run_version: str, table_name: str
+    ) -> None:
+        """Records a successful query and saves the manifest
+
+        :param institution_id: The partner's institution_id
+        :param query_name: The name of the query, e.g. "trials"
+        :param fingerprint: The query's fingerprint. See query_fingerprint
+        :param run_version: The run version that the output was written under
+        :param table_name: The name of the output table (with shard) in the partner's output dataset
+        """
+        with self._lock:
+            record = dict(
+                fingerprint=fingerprint,
+                run_version=str(run_version),
+                table_name=table_name,
+                recorded=datetime.now(timezone.utc).isoformat(),
+            )
+            self.records.setdefault(institution_id, {})[query_name] = record
+            self._append(dict(institution_id=institution_id, query_name=query_name, **record))
+
+    def decide(self, *, institution_id: str, query_name: str, action: str, reason: str) -> None:
+        """Adds a decision to the report of this run
+
+        :param institution_id: The partner's institution_id
+        :param query_name: The name of the query, e.g. "trials"
+        :param action: What was done. One of "run", "skip", "copy"
+        :param reason: Why it was done
+        """
+        with self._lock:
+            self.decisions.append(dict(institution_id=institution_id, query=query_name, action=action, reason=reason))
+
+    def new_run(self) -> None:
+        """Starts the report of a new run, e.g. for each run of a long-running process. The records are kept"""
+        with self._lock:
+            self.decisions = []
+
+    def report(self) -> str:
+        """A human-readable report of the decisions made this run"""
+        with self._lock:
+            decisions = sorted(self.decisions, key=lambda d: (d["institution_id"], d["query"]))
+        skipped = sum(1 for d in decisions if d["action"] != "run")
+        lines = [f"Incremental run: {skipped} of {len(decisions)} queries skipped or reused"]
+        for d in decisions:
+            lines.append(f"\t{d['institution_id']}.{d['query']}: {d['action']} - {d['reason']}")
+        return "\n".join(lines)
+
+    def save_report(self, path: str) -> None:
+        """Writes the decisions made this run to a JSON file"""
+        with self._lock:
+            with open(path, "w") as f:
+                json.dump(self.decisions, f, indent=2)
+
+    def _load(self) -> None:
+        """Replays the records in the manifest file. Lines that can't be read (e.g. one cut short by a crash) are
+        skipped. Compacts the file if more than half of its records have been superseded"""
+        lines = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                lines += 1
+                institution_id, query_name = record.pop("institution_id"), record.pop("query_name")
+                self.records.setdefault(institution_id, {})[query_name] = record
+        if lines > 2 * sum(len(r) for r in self.records.values()):
+            self._compact()
+
+    def _append(self, record: dict) -> None:
+        """Appends a record to the manifest file"""
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def _compact(self) -> None:
+        """Rewrites the manifest file with only the current records. Written to a temporary file first so that a
+        crash can't corrupt it"""
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            for institution_id, queries in sorted(self.records.items()):
+                for query_name, record in sorted(queries.items()):
+                    f.write(json.dumps(dict(institution_id=institution_id, query_name=query_name, **record)) + "\n")
+        os.replace(tmp, self.path)
+
+
+def query_fingerprint(
+    *, query: str, workflow_hash: str, inputs: Dict[str, Optional[dict]], upstream: List[str] = ()
+) -> str:
+    """Creates a fingerprint of a query and everything it reads. If the fingerprint is unchanged between runs, the
+    query would produce the same output.
+
+    :param query: The query, rendered with queries.FINGERPRINT_RUN_VERSION as its run version, as the run version only
+    names the output tables. See queries.fingerprint_context
+    :param workflow_hash: The workflow hash that the query was rendered with
+    :param inputs: The metadata (e.g. last modified time and number of rows) of each input table, keyed by table id
+    :param upstream: The fingerprints of the queries whose outputs this query reads
+    :return: The fingerprint as a hex string
+    """
+    content = dict(
+        query=hashlib.sha256(query.encode()).hexdigest(),
+        workflow_hash=workflow_hash,
+        inputs=inputs,
+        upstream=list(upstream),
+    )
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import threading
+
+from biomedical_dashboards.biomed.gcp import BQClientPool, bq_get_table, bq_list_tables, table_layout, table_metadata
+
+if TYPE_CHECKING:
+    from google.cloud.bigquery.table import Table
+
+# The column types that each partner input table must have, by the name of the Partner attribute naming the table.
+# Columns that the queries cast through STRING (see the function_cast_* functions) may be any of several types. The
+# first type of each column is the one that the partners are asked to upload
+INPUT_SCHEMAS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    "trials_aact_table_name": {
+        "nct_id": ("STRING",),
+        "registry_query_date": ("DATE", "STRING"),
+        "registration_date": ("DATE", "STRING"),
+        "start_date": ("DATE", "DATETIME", "TIMESTAMP", "STRING"),
+        "completion_date": ("DATE", "DATETIME", "TIMESTAMP", "STRING"),
+        "is_prospective": ("BOOLEAN", "STRING"),
+        "summary_results_reporting": ("STRING",),
+        "has_linked_reference": ("BOOLEAN", "STRING"),
+    },
+    "dois_table_name": {
+        "doi": ("STRING",),
+    },
+    "oddpub_table_name": {
+        "doi": ("STRING",),
+        "is_open_data": ("BOOLEAN",),
+        "is_open_code": ("BOOLEAN",),
+    },
+}
+
+# The standard SQL names of the legacy SQL types that the API may return
+TYPE_ALIASES = {"BOOL": "BOOLEAN", "INT64": "INTEGER", "FLOAT64": "FLOAT"}
+
+
+class MetadataCache:
+    """Serves the workflow's table and dataset metadata for a run. Each dataset is listed once, with a single API call,
+    and every existence check in it is answered from the listing. A table's full metadata (its row count, schema and
+    layout) is fetched the first time it is asked for and kept.
+
+    The workflow tells the cache about every table it creates or deletes (see written and deleted), so the cache stays
+    true to the tables that the run itself changes. Changes made by anything else during the run aren't seen.
+
+    :param clients: The client pool to make the metadata calls with. Tables may be in any project
+    """
+
+    def __init__(self, *, clients: BQClientPool):
+        self.clients = clients
+        self.calls = Counter()  # The metadata calls made, by kind
+        self.hits = 0  # The lookups answered without a call
+        # The names of the tables in each listed dataset, by dataset id. None if the dataset doesn't exist
+        self._listings: Dict[str, Optional[set]] = {}
+        self._tables: Dict[str, Table] = {}  # The full metadata of each table fetched, by table id
+        self._dataset_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def listing(self, project: str, dataset: str) -> Optional[set]:
+        """The names of the tables in a dataset, listing the dataset if it hasn't been listed yet. None if the dataset
+        doesn't exist. Concurrent lookups in the same dataset wait for a single listing"""
+        dataset_id = f"{project}.{dataset}"
+        with self._lock:
+            if dataset_id in self._listings:
+                self.hits += 1
+                return self._listings[dataset_id]
+            lock = self._dataset_locks.setdefault(dataset_id, threading.Lock())
+        with lock:
+            with self._lock:
+                if dataset_id in self._listings:
+                    self.hits += 1
+                    return self._listings[dataset_id]
+            names = bq_list_tables(project, dataset, client=self.clients.get(project))
+            with self._lock:
+                self.calls["list_tables"] += 1
+                self._listings[dataset_id] = None if names is None else set(names)
+                return self._listings[dataset_id]
+
+    def dataset_exists(self, project: str, dataset: str) -> bool:
+        """Whether a dataset exists"""
+        return self.listing(project, dataset) is not None
+
+    def table_exists(self, project: str, dataset: str, table_name: str) -> bool:
+        """Whether a table exists"""
+        return table_name in (self.listing(project, dataset) or ())
+
+    def get_table(self, project: str, dataset: str, table_name: str) -> Optional[Table]:
+        """The full metadata of a table. None if it doesn't exist"""
+        if not self.table_exists(project, dataset, table_name):
+            return None
+        table_id = f"{project}.{dataset}.{table_name}"
+        with self._lock:
+            if table_id in self._tables:
+                self.hits += 1
+                return self._tables[table_id]
+        table = bq_get_table(project, dataset, table_name, client=self.clients.get(project))
+        with self._lock:
+            self.calls["get_table"] += 1
+            if table is None:
+                self._listings[f"{project}.{dataset}"].discard(table_name)
+            else:
+                self._tables[table_id] = table
+        return table
+
+    def table_metadata(self, project: str, dataset: str, table_name: str) -> Optional[dict]:
+        """The table's last modified time and number of rows. None if it doesn't exist. See gcp.table_metadata"""
+        table = self.get_table(project, dataset, table_name)
+        return table_metadata(table) if table is not None else None
+
+    def table_layout(self, project: str, dataset: str, table_name: str) -> Optional[dict]:
+        """The table's type, partitioning and clustering. None if it doesn't exist. See gcp.table_layout"""
+        table = self.get_table(project, dataset, table_name)
+        return table_layout(table) if table is not None else None
+
+    def written(self, project: str, dataset: str, table_name: str) -> None:
+        """Records that the workflow has created or replaced a table, so its cached metadata is out of date"""
+        dataset_id = f"{project}.{dataset}"
+        with self._lock:
+            self._tables.pop(f"{dataset_id}.{table_name}", None)
+            if dataset_id in self._listings:
+                # A dataset that was missing when listed must have been created since
+                self._listings[dataset_id] = (self._listings[dataset_id] or set()) | {table_name}
+
+    def deleted(self, project: str, dataset: str, table_name: str) -> None:
+        """Records that the workflow has deleted a table"""
+        dataset_id = f"{project}.{dataset}"
+        with self._lock:
+            self._tables.pop(f"{dataset_id}.{table_name}", None)
+            if self._listings.get(dataset_id) is not None:
+                self._listings[dataset_id].discard(table_name)
+
+    def dataset_created(self, project: str, dataset: str) -> None:
+        """Records that a dataset exists, e.g. after the workflow has created it"""
+        dataset_id = f"{project}.{dataset}"
+        with self._lock:
+            if dataset_id in self._listings and self._listings[dataset_id] is None:
+                self._listings[dataset_id] = set()
+
+    def stats(self) -> dict:
+        """The counters of the cache. Lookups cached is the number of lookups answered without a metadata call"""
+        return dict(
+            datasets_listed=self.calls["list_tables"],
+            tables_fetched=self.calls["get_table"],
+            lookups_cached=self.hits,
+        )
+
+
+def schema_errors(table: Table, expected: Dict[str, Tuple[str, ...]]) -> List[str]:
+    """Compares the columns of a table to the columns it is expected to have
+
+    :param table: The table
+    :param expected: The types that each expected column may have, as {column: (type, ...)}. See INPUT_SCHEMAS
+    :return: A description of each column that is missing or has the wrong type. Empty if the schema is as expected
+    """
+    types = {field.name.lower(): field.field_type.upper() for field in table.schema or []}
+    errors = []
+    for column, allowed in expected.items():
+        field_type = types.get(column.lower())
+        if field_type is None:
+            errors.append(f"missing column {column} ({' or '.join(allowed)})")
+        elif TYPE_ALIASES.get(field_type, field_type) not in allowed:
+            errors.append(f"column {column} is {field_type}, expected {' or '.join(allowed)}")
+    return errors
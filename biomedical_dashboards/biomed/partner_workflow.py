@@ -1,181 +1,723 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Tuple
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+import asyncio
 import os
 
-import google
-
 from biomedical_dashboards.biomed.config import Partner, Context
 from biomedical_dashboards.biomed.gcp import (
-    bq_check_table_exists,
     bq_create_dataset,
-    bq_run_query,
+    bq_delete_table,
+    bq_run_query_job,
+    bq_run_query_job_async,
     bq_copy_table,
+    bq_copy_table_async,
 )
 from biomedical_dashboards.biomed.logs import bioprint
-from biomedical_dashboards.biomed.queries import query_alltrials, query_trials, query_pubs
+from biomedical_dashboards.biomed.manifest import query_fingerprint
+from biomedical_dashboards.biomed.metadata import INPUT_SCHEMAS, schema_errors
+from biomedical_dashboards.biomed.queries import (
+    COHORT_QUERIES,
+    PARTNER_QUERIES,
+    fingerprint_context,
+    partner_query_kwargs,
+    query_partner_script,
+    query_publish_latest,
+    render_partner_queries,
+    render_partner_query,
+)
+from biomedical_dashboards.biomed.scheduler import Task
+from biomedical_dashboards.biomed.telemetry import JobRecord
+
+if TYPE_CHECKING:
+    from google.cloud.bigquery.job import QueryJob
+
+# Queries whose output is a table, so an unchanged output can be reused by copying it to the new shard.
+# The alltrials output is a view, which is free to recreate.
+COPYABLE_QUERIES = ("trials", "pubs")
+
+# The tables that are published to the partner's 'latest' dataset at the end of the workflow
+PUBLISHED_TABLES = ("trials", "pubs")
 
 
 def partner_workflow(partner: Partner, context: Context) -> None:
-    """Workflow for a single partner. Does the following:
+    """Workflow for a single partner, run one stage at a time. See partner_tasks for the stages.
+
+    Expects the shared stages (see shared_workflow) to have already been run.
+    """
+    for task in partner_tasks(partner=partner, context=context):
+        task.func()
+
+
+def partner_tasks(partner: Partner, context: Context, deps: Iterable[str] = ()) -> List[Task]:
+    """Creates the tasks of the workflow for a single partner. The tasks are returned in an order they can be run in.
+    Does the following:
     - Checks that the static tables exist
     - Creates output datasets if they don't exist
     - Generates the queries and writes them to files
-    - Runs the queries
-    - Makes a copy of the created table, placing it in the "latest" dataset
+    - Runs the alltrials and trials queries, then the pubs query (which depends on alltrials). Queries whose
+      rendered SQL and inputs are unchanged since the last run are skipped, unless context.force is set. With the
+      script execution mode, the queries are run together as one script job instead. See run_partner_script. With the
+      cohort execution mode, the trials and pubs queries fill the partner's tables from the cohort's tables once the
+      cohort tasks have made them. See cohort_tasks
+    - Checks that the generated tables exist
+    - Publishes each created table to the "latest" dataset. By default each table is copied. With the clone and view
+      publish modes, every table is switched to this run's table in one script job. See publish_latest_tables
 
     If context.dryrun setting is enabled, will only create and output the queries.
+
+    Tasks that create something have a verify function that confirms, with metadata calls, that their output exists.
+    When resuming a run, completed tasks whose output is confirmed are not repeated.
+
+    :param partner: The partner to create the tasks for
+    :param context: The workflow context
+    :param deps: The names of the tasks outside of this partner's workflow that must finish before running queries
+    :return: The partner's tasks
     """
-    # Check/make datasets
-    if not context.dryrun:
-        check_static_tables_exist(partner=partner, context=context)
-        bioprint(partner, "All expected static tables exist")
-        try:
-            bq_create_dataset(project=context.project, dataset=partner.output_dataset, exists_ok=False)
-            bioprint(partner, f"Created dataset: {context.project}.{partner.output_dataset}")
-        except google.cloud.exceptions.Conflict:
-            bioprint(
-                partner,
-                f"Dataset already exists, no need to create: {context.project}.{partner.output_dataset}",
+    id = partner.institution_id
+    tasks = [
+        Task(
+            name=f"{id}:generate_queries",
+            func=partial(generate_queries, partner, context),
+            verify=partial(query_files_current, partner, context),
+            partner=id,
+        ),
+    ]
+    if context.dryrun:
+        return tasks
+
+    run = partial(run_query, partner=partner, context=context)
+    arun = partial(run_query_async, partner=partner, context=context)
+    latest = partial(update_latest_table, partner=partner, context=context)
+    alatest = partial(update_latest_table_async, partner=partner, context=context)
+    output_exists = partial(tables_exist, context, partner.output_dataset)
+    latest_exists = partial(tables_exist, context, partner.latest_dataset)
+    tasks += [
+        Task(
+            name=f"{id}:check_static_tables",
+            func=partial(check_static_tables_exist, partner, context),
+            coro=partial(check_static_tables_exist_async, partner, context),
+            partner=id,
+        ),
+        Task(
+            name=f"{id}:create_datasets",
+            func=partial(create_datasets, partner, context),
+            verify=partial(datasets_exist, context, [partner.output_dataset, partner.latest_dataset]),
+            deps=[f"{id}:check_static_tables"],
+            partner=id,
+        ),
+    ]
+    query_deps = [f"{id}:generate_queries", f"{id}:create_datasets", *deps]
+    if context.execution_mode == "script":
+        tasks.append(
+            Task(
+                name=f"{id}:script",
+                func=partial(run_partner_script, partner, context),
+                coro=partial(run_partner_script_async, partner, context),
+                verify=partial(output_exists, [getattr(context, f"generated_{q}_name") for q in PARTNER_QUERIES]),
+                deps=query_deps,
+                partner=id,
             )
-        try:
-            bq_create_dataset(project=context.project, dataset=partner.latest_dataset, exists_ok=False)
-            bioprint(partner, f"Created dataset: {context.project}.{partner.latest_dataset}")
-        except google.cloud.exceptions.Conflict:
-            bioprint(
-                partner,
-                f"Dataset already exists, no need to create: {context.project}.{partner.latest_dataset}",
+        )
+        generated_deps = [f"{id}:script"]
+    else:
+        # With the cohort execution mode, trials and pubs read the cohort's tables rather than the alltrials view
+        if context.execution_mode == "cohort":
+            trials_deps, pubs_deps = [*query_deps, "cohort:trials"], [*query_deps, "cohort:pubs"]
+        else:
+            trials_deps, pubs_deps = query_deps, [f"{id}:alltrials"]
+        tasks += [
+            Task(
+                name=f"{id}:alltrials",
+                func=partial(run, query_name="alltrials"),
+                coro=partial(arun, query_name="alltrials"),
+                verify=partial(output_exists, [context.generated_alltrials_name]),
+                deps=query_deps,
+                partner=id,
+            ),
+            Task(
+                name=f"{id}:trials",
+                func=partial(run, query_name="trials"),
+                coro=partial(arun, query_name="trials"),
+                verify=partial(output_exists, [context.generated_trials_name]),
+                deps=trials_deps,
+                partner=id,
+            ),
+            Task(
+                name=f"{id}:pubs",
+                func=partial(run, query_name="pubs"),
+                coro=partial(arun, query_name="pubs"),
+                verify=partial(output_exists, [context.generated_pubs_name]),
+                deps=pubs_deps,
+                partner=id,
+            ),
+        ]
+        generated_deps = [f"{id}:alltrials", f"{id}:trials", f"{id}:pubs"]
+    tasks.append(
+        Task(
+            name=f"{id}:check_generated_tables",
+            func=partial(check_generated_tables_exist, partner, context),
+            coro=partial(check_generated_tables_exist_async, partner, context),
+            deps=generated_deps,
+            partner=id,
+        )
+    )
+    if context.publish_mode == "copy":
+        tasks += [
+            Task(
+                name=f"{id}:latest_trials",
+                func=partial(latest, src_table_name=context.generated_trials_name, dest_table_name="trials"),
+                coro=partial(alatest, src_table_name=context.generated_trials_name, dest_table_name="trials"),
+                verify=partial(latest_exists, ["trials"]),
+                deps=[f"{id}:check_generated_tables"],
+                partner=id,
+            ),
+            Task(
+                name=f"{id}:latest_pubs",
+                func=partial(latest, src_table_name=context.generated_pubs_name, dest_table_name="pubs"),
+                coro=partial(alatest, src_table_name=context.generated_pubs_name, dest_table_name="pubs"),
+                verify=partial(latest_exists, ["pubs"]),
+                deps=[f"{id}:check_generated_tables"],
+                partner=id,
+            ),
+        ]
+    else:
+        tasks.append(
+            Task(
+                name=f"{id}:publish_latest",
+                func=partial(publish_latest_tables, partner, context),
+                verify=partial(latest_exists, PUBLISHED_TABLES),
+                deps=[f"{id}:check_generated_tables"],
+                partner=id,
             )
+        )
+    return tasks
 
-    # Query creation
-    generate_queries(partner=partner, context=context)
 
-    # Query run
-    if not context.dryrun:
-        run_queries(partner=partner, context=context)
-        check_generated_tables_exist(partner=partner, context=context)
-        update_latest_tables(partner=partner, context=context)
+def query_files_current(partner: Partner, context: Context) -> bool:
+    """Whether all of the partner's query files exist and match the queries rendered from the current config.
+    Used to confirm a checkpointed generate_queries task"""
+    queries = render_partner_queries([partner], context)[partner.institution_id]
+    for query_name, query in queries.items():
+        path = os.path.join(context.output_dir, getattr(partner, f"{query_name}_query_fname"))
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            if f.read() != query:
+                return False
+    return True
 
 
-def check_static_tables_exist(partner: Partner, context: Context):
-    """Checks that the static tables exist"""
+def tables_exist(context: Context, dataset: str, table_names: Iterable[str]) -> bool:
+    """Whether all of the tables exist in the dataset. Used to confirm checkpointed tasks"""
+    return all(context.metadata.table_exists(context.project, dataset, t) for t in table_names)
 
-    def _wrapped_check(project, dataset, table_name) -> Tuple[bool, str]:
-        """Wrapped function that also returns the table name"""
-        return (bq_check_table_exists(project, dataset, table_name), table_name)
 
-    table_names = [
-        partner.trials_aact_table_name,
-        partner.dois_table_name,
-        partner.oddpub_table_name,
-    ]
-    futures = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        for t in table_names:
-            futures.append(executor.submit(_wrapped_check, context.project, partner.static_dataset, t))
+def datasets_exist(context: Context, datasets: Iterable[str]) -> bool:
+    """Whether all of the datasets exist. Used to confirm checkpointed tasks"""
+    return all(context.metadata.dataset_exists(context.project, d) for d in datasets)
+
+
+def create_datasets(partner: Partner, context: Context) -> None:
+    """Creates the output and latest datasets if they don't exist"""
+    from google.api_core.exceptions import Conflict
+
+    try:
+        bq_create_dataset(
+            project=context.project, dataset=partner.output_dataset, exists_ok=False, client=context.client
+        )
+        bioprint(partner, f"Created dataset: {context.project}.{partner.output_dataset}")
+    except Conflict:
+        bioprint(
+            partner,
+            f"Dataset already exists, no need to create: {context.project}.{partner.output_dataset}",
+        )
+    context.metadata.dataset_created(context.project, partner.output_dataset)
+    try:
+        bq_create_dataset(
+            project=context.project, dataset=partner.latest_dataset, exists_ok=False, client=context.client
+        )
+        bioprint(partner, f"Created dataset: {context.project}.{partner.latest_dataset}")
+    except Conflict:
+        bioprint(
+            partner,
+            f"Dataset already exists, no need to create: {context.project}.{partner.latest_dataset}",
+        )
+    context.metadata.dataset_created(context.project, partner.latest_dataset)
 
+
+def check_static_tables_exist(partner: Partner, context: Context):
+    """Checks that the static tables exist and have the columns that the queries read, with usable types (see
+    INPUT_SCHEMAS), so that a bad upload fails here rather than part of the way through a query. The tables are looked
+    up in the run's metadata cache, which lists the partner's static dataset with a single call"""
     errors = []
-    for f in as_completed(futures):
-        result = f.result()
-        if result[0] == False:
-            errors.append(f"{context.project}.{partner.static_dataset}.{result[1]}")
+    for attr, columns in INPUT_SCHEMAS.items():
+        table_name = getattr(partner, attr)
+        table_id = f"{context.project}.{partner.static_dataset}.{table_name}"
+        table = context.metadata.get_table(context.project, partner.static_dataset, table_name)
+        if table is None:
+            errors.append(f"{table_id}: missing")
+            continue
+        errors += [f"{table_id}: {e}" for e in schema_errors(table, columns)]
     if errors:
         msg = "\n\t".join(errors)
-        raise RuntimeError(f"Expected table(s) missing:\n\t{msg}")
+        raise RuntimeError(f"Expected static table(s) missing or invalid:\n\t{msg}")
+    bioprint(partner, "All expected static tables exist with the expected columns")
+
+
+async def check_static_tables_exist_async(partner: Partner, context: Context):
+    """Awaitable version of check_static_tables_exist. The metadata calls, if any, are made in a thread"""
+    await asyncio.to_thread(check_static_tables_exist, partner, context)
 
 
 def generate_queries(partner: Partner, context: Context) -> None:
-    """Generates all of the queries for the partner and saves them to file"""
-    # Create queries
-    alltrials = query_alltrials(**partner.to_dict(), **context.to_dict())
-    trials = query_trials(**partner.to_dict(), **context.to_dict())
-    pubs = query_pubs(**partner.to_dict(), **context.to_dict())
-
-    # Save queries to file
-    path = os.path.join(context.output_dir, partner.alltrials_query_fname)
-    save_query(alltrials, path)
-    bioprint(partner, f"Query written to file: {path}")
-    path = os.path.join(context.output_dir, partner.trials_query_fname)
-    save_query(trials, path)
-    bioprint(partner, f"Query written to file: {path}")
-    path = os.path.join(context.output_dir, partner.pubs_query_fname)
-    save_query(pubs, path)
-    bioprint(partner, f"Query written to file: {path}")
+    """Generates all of the queries for the partner and saves them to file. Files whose content is unchanged are not
+    rewritten."""
+    queries = render_partner_queries([partner], context)[partner.institution_id]
+    for query_name, query in queries.items():
+        path = os.path.join(context.output_dir, getattr(partner, f"{query_name}_query_fname"))
+        if save_query(query, path):
+            bioprint(partner, f"Query written to file: {path}")
+        else:
+            bioprint(partner, f"Query unchanged, not rewritten: {path}")
 
 
 def check_generated_tables_exist(partner: Partner, context: Context):
     """Checks that the generated tables exist"""
+    table_names = [context.generated_alltrials_name, context.generated_trials_name, context.generated_pubs_name]
+    check_tables_exist(context, partner.output_dataset, table_names)
 
-    def _wrapped_check(project, dataset, table_name) -> Tuple[bool, str]:
-        """Wrapped function that also returns the table name"""
-        return (bq_check_table_exists(project, dataset, table_name), table_name)
 
-    table_names = [context.generated_alltrials_name, context.generated_trials_name, context.generated_pubs_name]
-    futures = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        for t in table_names:
-            futures.append(executor.submit(_wrapped_check, context.project, partner.output_dataset, t))
+async def check_generated_tables_exist_async(partner: Partner, context: Context):
+    """Awaitable version of check_generated_tables_exist. The metadata calls, if any, are made in a thread"""
+    await asyncio.to_thread(check_generated_tables_exist, partner, context)
 
-    errors = []
-    for f in as_completed(futures):
-        result = f.result()
-        if result[0] == False:
-            errors.append(f"{context.project}.{partner.static_dataset}.{result[1]}")
+
+def check_tables_exist(context: Context, dataset: str, table_names: List[str]) -> None:
+    """Checks that all of the tables exist in the dataset. Raises a RuntimeError listing any that are missing"""
+    errors = [
+        f"{context.project}.{dataset}.{t}"
+        for t in table_names
+        if not context.metadata.table_exists(context.project, dataset, t)
+    ]
     if errors:
         msg = "\n\t".join(errors)
         raise RuntimeError(f"Expected table(s) missing:\n\t{msg}")
 
 
-def run_queries(partner: Partner, context: Context) -> None:
-    """Reads the queries from file and runs them"""
-    for query_fname in [
-        partner.alltrials_query_fname,
-        partner.trials_query_fname,
-        partner.pubs_query_fname,
-    ]:
-        path = os.path.join(context.output_dir, query_fname)
-        with open(path) as f:
-            query = f.read()
-        bioprint(partner, f"Running query: {path}")
-        bq_run_query(context.project, query)
+def run_query(partner: Partner, context: Context, query_name: str) -> None:
+    """Reads a query from file and runs it, unless its output from a previous run can be reused
+
+    :param partner: The partner to run the query for
+    :param context: The workflow context
+    :param query_name: The name of the query. One of "alltrials", "trials", "pubs"
+    """
+    prepared = prepare_query(partner=partner, context=context, query_name=query_name)
+    if not prepared:
+        return
+    query, fingerprint = prepared
+    run_recorded_query(
+        context=context,
+        query=query,
+        institution_id=partner.institution_id,
+        template=query_name,
+        output_dataset=partner.output_dataset,
+        output_table_name=getattr(context, f"generated_{query_name}_name"),
+    )
+    record_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint)
 
 
-def update_latest_tables(partner: Partner, context: Context) -> None:
-    """Copies the tables created from this run to the 'latest' dataset"""
-    latest_dataset = f"{partner.institution_id}_data_latest"
-    try:
-        bq_create_dataset(project=context.project, dataset=latest_dataset, exists_ok=True)
-        bioprint(partner, f"Created dataset: {context.project}.{partner.output_dataset}")
-    except google.cloud.exceptions.Conflict:
-        bioprint(
-            partner,
-            f"Dataset already exists, no need to create: {context.project}.{partner.output_dataset}",
+async def run_query_async(partner: Partner, context: Context, query_name: str) -> None:
+    """Awaitable version of run_query. The query job is polled from the event loop rather than waited on in a thread"""
+    prepared = await asyncio.to_thread(prepare_query, partner=partner, context=context, query_name=query_name)
+    if not prepared:
+        return
+    query, fingerprint = prepared
+    output_table_name = getattr(context, f"generated_{query_name}_name")
+    job = await bq_run_query_job_async(
+        context.project,
+        query,
+        maximum_bytes_billed=context.max_bytes_per_query,
+        client=context.client,
+        poll_interval=context.job_poll_interval,
+    )
+    await asyncio.to_thread(
+        record_job,
+        job,
+        context=context,
+        institution_id=partner.institution_id,
+        template=query_name,
+        output_dataset=partner.output_dataset,
+        output_table_name=output_table_name,
+    )
+    record_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint)
+
+
+def run_partner_script(partner: Partner, context: Context) -> None:
+    """Runs the partner's queries together as one multi-statement script, in a single job. Each query is decided on as
+    run_query would, and only those that need to run are included in the script.
+
+    :param partner: The partner to run the script for
+    :param context: The workflow context
+    """
+    prepared = prepare_partner_script(partner=partner, context=context)
+    if not prepared:
+        return
+    query, fingerprints = prepared
+    run_recorded_query(
+        context=context,
+        query=query,
+        institution_id=partner.institution_id,
+        template="script",
+        output_dataset=partner.output_dataset,
+        output_table_name=getattr(context, f"generated_{list(fingerprints)[-1]}_name"),
+    )
+    for query_name, fingerprint in fingerprints.items():
+        record_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint)
+
+
+async def run_partner_script_async(partner: Partner, context: Context) -> None:
+    """Awaitable version of run_partner_script. The script job is polled from the event loop"""
+    prepared = await asyncio.to_thread(prepare_partner_script, partner=partner, context=context)
+    if not prepared:
+        return
+    query, fingerprints = prepared
+    job = await bq_run_query_job_async(
+        context.project,
+        query,
+        maximum_bytes_billed=context.max_bytes_per_query,
+        client=context.client,
+        poll_interval=context.job_poll_interval,
+    )
+    await asyncio.to_thread(
+        record_job,
+        job,
+        context=context,
+        institution_id=partner.institution_id,
+        template="script",
+        output_dataset=partner.output_dataset,
+        output_table_name=getattr(context, f"generated_{list(fingerprints)[-1]}_name"),
+    )
+    for query_name, fingerprint in fingerprints.items():
+        record_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint)
+
+
+def prepare_partner_script(partner: Partner, context: Context) -> Optional[Tuple[str, Dict[str, str]]]:
+    """Decides which of the partner's queries need to run (see reuse_query_output) and renders a script of them. The
+    script file written by generate_queries has every query, so may include queries that are reused here.
+
+    :return: The script and the fingerprints of the queries in it, by query name. None if every output was reused
+    """
+    fingerprints = {}
+    for query_name in PARTNER_QUERIES:
+        fingerprint = partner_query_fingerprint(partner=partner, context=context, query_name=query_name)
+        if not reuse_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint):
+            fingerprints[query_name] = fingerprint
+    if not fingerprints:
+        return None
+    kwargs = partner_query_kwargs(partner=partner, context=context)
+    bioprint(partner, f"Running script of queries: {', '.join(fingerprints)}")
+    return query_partner_script(**kwargs, queries=list(fingerprints)), fingerprints
+
+
+def prepare_query(partner: Partner, context: Context, query_name: str) -> Optional[Tuple[str, str]]:
+    """Reads a query from file and decides whether it needs to run. See reuse_query_output
+
+    :return: The query and its fingerprint if it needs to run. None if its output was reused
+    """
+    path = os.path.join(context.output_dir, getattr(partner, f"{query_name}_query_fname"))
+    with open(path) as f:
+        query = f.read()
+    fingerprint = partner_query_fingerprint(partner=partner, context=context, query_name=query_name)
+    if reuse_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint):
+        return None
+    bioprint(partner, f"Running query: {path}")
+    return query, fingerprint
+
+
+def record_query_output(partner: Partner, context: Context, query_name: str, fingerprint: str) -> None:
+    """Records the output of a query that has been run in the manifest, so that later runs can reuse it, and in the
+    run's metadata cache"""
+    context.metadata.written(context.project, partner.output_dataset, getattr(context, f"generated_{query_name}_name"))
+    context.manifest.record(
+        institution_id=partner.institution_id,
+        query_name=query_name,
+        fingerprint=fingerprint,
+        run_version=context.run_version,
+        table_name=getattr(context, f"generated_{query_name}_name"),
+    )
+
+
+def run_recorded_query(
+    *, context: Context, query: str, institution_id: str, template: str, output_dataset: str, output_table_name: str
+) -> None:
+    """Runs a query and records the finished job's timings and costs in the context's telemetry
+
+    :param context: The workflow context
+    :param query: The query to run
+    :param institution_id: The partner that the query is run for, or "shared" for the shared queries
+    :param template: The name of the query template, e.g. "pubs"
+    :param output_dataset: The dataset of the table that the query creates
+    :param output_table_name: The name of the table that the query creates. Its row count is recorded
+    """
+    job = bq_run_query_job(
+        context.project, query, maximum_bytes_billed=context.max_bytes_per_query, client=context.client
+    )
+    record_job(
+        job,
+        context=context,
+        institution_id=institution_id,
+        template=template,
+        output_dataset=output_dataset,
+        output_table_name=output_table_name,
+    )
+
+
+def record_job(
+    job: "QueryJob",
+    *,
+    context: Context,
+    institution_id: str,
+    template: str,
+    output_dataset: str,
+    output_table_name: str,
+) -> None:
+    """Records a finished query job's timings and costs in the context's telemetry. See run_recorded_query.
+    The job has replaced its output table, so the table's cached metadata is dropped before its row count is read"""
+    context.metadata.written(context.project, output_dataset, output_table_name)
+    output = context.metadata.table_metadata(context.project, output_dataset, output_table_name)
+    context.telemetry.record(
+        JobRecord.from_job(
+            job,
+            institution_id=institution_id,
+            template=template,
+            run_version=context.run_version,
+            workflow_hash=context.workflow_hash,
+            output_rows=output["num_rows"] if output else None,
+        )
+    )
+
+
+def query_dependencies(partner: Partner, context: Context, query_name: str) -> Tuple[List[str], List[str]]:
+    """The tables that a partner's query reads and the partner's queries that must run before it. With the cohort
+    execution mode, the trials and pubs queries read only the cohort's table
+
+    :return: The full table ids of the input tables, and the names of the upstream queries
+    """
+    static = f"{context.project}.{partner.static_dataset}"
+    if context.execution_mode == "cohort" and query_name in COHORT_QUERIES:
+        return [f"{context.project}.{context.shared_dataset}.{getattr(context, f'cohort_{query_name}_name')}"], []
+    if query_name == "alltrials":
+        return [f"{context.project}.{context.shared_dataset}.{context.shared_alltrials_name}"], []
+    if query_name == "trials":
+        return [
+            f"{static}.{partner.trials_aact_table_name}",
+            f"{static}.{partner.dois_table_name}",
+            f"{context.project}.{context.shared_dataset}.{context.shared_trial_index_name}",
+        ], []
+    if query_name == "pubs":
+        return [
+            f"{static}.{partner.dois_table_name}",
+            f"{static}.{partner.oddpub_table_name}",
+            f"{context.project}.{context.shared_dataset}.{context.shared_enriched_dois_name}",
+        ], ["alltrials"]
+    raise RuntimeError(f"Unknown query: {query_name}")
+
+
+def partner_query_fingerprint(partner: Partner, context: Context, query_name: str) -> str:
+    """Creates the fingerprint of a partner's query from its SQL rendered for fingerprinting (see fingerprint_context),
+    the workflow hash, the metadata of the tables it reads and the fingerprints of its upstream queries. See
+    query_fingerprint"""
+    tables, upstream = query_dependencies(partner=partner, context=context, query_name=query_name)
+    inputs = {}
+    for table_id in tables:
+        project, dataset, table_name = table_id.split(".")
+        inputs[table_id] = context.metadata.table_metadata(project, dataset, table_name)
+
+    return query_fingerprint(
+        query=render_partner_query(partner=partner, context=fingerprint_context(context), query_name=query_name),
+        workflow_hash=context.workflow_hash,
+        inputs=inputs,
+        upstream=[partner_query_fingerprint(partner=partner, context=context, query_name=u) for u in upstream],
+    )
+
+
+def reuse_query_output(partner: Partner, context: Context, query_name: str, fingerprint: str) -> bool:
+    """Decides whether a query needs to be run, by comparing its fingerprint to the one recorded in the manifest.
+    If the output of a previous run with the same fingerprint exists, it is reused. Outputs under the same run version
+    are left as they are. Outputs under another run version are copied to this run's shard.
+
+    Every decision is added to the manifest's report for this run.
+
+    :return: True if the output was reused and the query does not need to run. False otherwise.
+    """
+    id = partner.institution_id
+    table_name = getattr(context, f"generated_{query_name}_name")
+    previous = context.manifest.get(id, query_name)
+
+    if context.force:
+        reason = "forced"
+    elif not previous:
+        reason = "no previous run recorded"
+    elif previous["fingerprint"] != fingerprint:
+        reason = "query or inputs changed since the last run"
+    elif not context.metadata.table_exists(context.project, partner.output_dataset, previous["table_name"]):
+        reason = f"previous output missing: {partner.output_dataset}.{previous['table_name']}"
+    elif previous["table_name"] == table_name:
+        context.manifest.decide(
+            institution_id=id, query_name=query_name, action="skip", reason="unchanged and output already exists"
+        )
+        bioprint(partner, f"Skipping unchanged query: {query_name}")
+        return True
+    elif query_name in COPYABLE_QUERIES:
+        bq_copy_table(
+            project=context.project,
+            src_dataset=partner.output_dataset,
+            src_table_name=previous["table_name"],
+            dest_dataset=partner.output_dataset,
+            dest_table_name=table_name,
+            overwrite=True,
+            client=context.client,
+            check_source=False,
+        )
+        context.metadata.written(context.project, partner.output_dataset, table_name)
+        context.manifest.record(
+            institution_id=id,
+            query_name=query_name,
+            fingerprint=fingerprint,
+            run_version=context.run_version,
+            table_name=table_name,
+        )
+        context.manifest.decide(
+            institution_id=id,
+            query_name=query_name,
+            action="copy",
+            reason=f"unchanged, copied from {previous['table_name']}",
         )
+        bioprint(partner, f"Copied unchanged output {previous['table_name']} to {table_name}")
+        return True
+    else:
+        reason = "unchanged, but the output is a view so is recreated at no cost"
+
+    context.manifest.decide(institution_id=id, query_name=query_name, action="run", reason=reason)
+    return False
+
+
+def update_latest_table(partner: Partner, context: Context, src_table_name: str, dest_table_name: str) -> None:
+    """Copies a table created from this run to the 'latest' dataset. The dataset is created by create_datasets.
+    The copy keeps the partitioning and clustering of the table. See clear_latest_table"""
+    clear_latest_table(partner, context, src_table_name=src_table_name, dest_table_name=dest_table_name)
     bq_copy_table(
         project=context.project,
         src_dataset=partner.output_dataset,
-        src_table_name=context.generated_trials_name,
-        dest_dataset=latest_dataset,
-        dest_table_name="trials",
+        src_table_name=src_table_name,
+        dest_dataset=partner.latest_dataset,
+        dest_table_name=dest_table_name,
         overwrite=True,
+        client=context.client,
+        check_source=False,
     )
+    context.metadata.written(context.project, partner.latest_dataset, dest_table_name)
     bioprint(
-        partner, f"Copied table {partner.output_dataset}.{context.generated_trials_name} to {latest_dataset}.trials"
+        partner,
+        f"Copied table {partner.output_dataset}.{src_table_name} to {partner.latest_dataset}.{dest_table_name}",
     )
-    bq_copy_table(
+
+
+def publish_latest_tables(partner: Partner, context: Context) -> None:
+    """Publishes this run's tables to the 'latest' dataset as table clones or views (see Context.publish_mode).
+    Neither copies any data. Every table is switched in a single script job, so the dashboards don't see the tables
+    from two different runs for more than the moment between two statements, rather than for the length of a copy.
+
+    BigQuery transactions can't contain DDL, so this is as close to an atomic swap of several tables as it allows.
+    Any latest table of the wrong type (e.g. a table left by the copy mode when publishing views) is dropped by the
+    script just before it is replaced, so nothing is removed unless the script gets as far as replacing it.
+    """
+    table_type = "VIEW" if context.publish_mode == "view" else "TABLE"
+    drop = {}
+    for table in PUBLISHED_TABLES:
+        layout = context.metadata.table_layout(context.project, partner.latest_dataset, table)
+        if layout and layout["table_type"] != table_type:
+            drop[table] = "VIEW" if layout["table_type"] == "VIEW" else "TABLE"
+            bioprint(partner, f"Replacing {partner.latest_dataset}.{table} with a {table_type.lower()}")
+
+    query = query_publish_latest(
+        project=context.project,
+        institution_id=partner.institution_id,
+        run_version=context.run_version,
+        tables=PUBLISHED_TABLES,
+        publish_mode=context.publish_mode,
+        drop=drop,
+    )
+    run_recorded_query(
+        context=context,
+        query=query,
+        institution_id=partner.institution_id,
+        template=f"publish_latest_{context.publish_mode}",
+        output_dataset=partner.latest_dataset,
+        output_table_name=PUBLISHED_TABLES[-1],
+    )
+    for table in PUBLISHED_TABLES[:-1]:
+        context.metadata.written(context.project, partner.latest_dataset, table)
+    bioprint(
+        partner,
+        f"Published {', '.join(PUBLISHED_TABLES)} from run {context.run_version} to {partner.latest_dataset} "
+        f"as {context.publish_mode}s",
+    )
+
+
+def clear_latest_table(partner: Partner, context: Context, src_table_name: str, dest_table_name: str) -> None:
+    """Deletes a table in the 'latest' dataset if its partitioning or clustering differs from the table that is about to
+    be copied over it, or if it is a view. A copy over an existing table fails if the partitioning is incompatible,
+    whereas a copy to a new table always takes the layout of the source table."""
+    dest = context.metadata.table_layout(context.project, partner.latest_dataset, dest_table_name)
+    if dest is None:
+        return
+    src = context.metadata.table_layout(context.project, partner.output_dataset, src_table_name)
+    if src != dest:
+        bq_delete_table(context.project, partner.latest_dataset, dest_table_name, client=context.client)
+        context.metadata.deleted(context.project, partner.latest_dataset, dest_table_name)
+        bioprint(partner, f"Deleted {partner.latest_dataset}.{dest_table_name} to change its partitioning/clustering")
+
+
+async def update_latest_table_async(
+    partner: Partner, context: Context, src_table_name: str, dest_table_name: str
+) -> None:
+    """Awaitable version of update_latest_table. The copy job is polled from the event loop"""
+    await asyncio.to_thread(
+        clear_latest_table, partner, context, src_table_name=src_table_name, dest_table_name=dest_table_name
+    )
+    await bq_copy_table_async(
         project=context.project,
         src_dataset=partner.output_dataset,
-        src_table_name=context.generated_pubs_name,
-        dest_dataset=latest_dataset,
-        dest_table_name="pubs",
+        src_table_name=src_table_name,
+        dest_dataset=partner.latest_dataset,
+        dest_table_name=dest_table_name,
         overwrite=True,
+        client=context.client,
+        poll_interval=context.job_poll_interval,
+        check_source=False,
+    )
+    context.metadata.written(context.project, partner.latest_dataset, dest_table_name)
+    bioprint(
+        partner,
+        f"Copied table {partner.output_dataset}.{src_table_name} to {partner.latest_dataset}.{dest_table_name}",
     )
-    bioprint(partner, f"Copied table {partner.output_dataset}.{context.generated_pubs_name} to {latest_dataset}.pubs")
 
 
-def save_query(query: str, path: str) -> None:
+def save_query(query: str, path: str) -> bool:
+    """Saves a query to file, unless the file already has the same content. Leaving unchanged files untouched stops
+    anything watching the output directory from being triggered for no reason.
+
+    :return: True if the file was written, False if it was unchanged
+    """
     dir = os.path.dirname(path)
     if not os.path.exists(dir):
         raise RuntimeError(f"Directory does not exist: {dir}")
 
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == query:
+                return False
     with open(path, "w") as f:
         f.write(query)
+    return True
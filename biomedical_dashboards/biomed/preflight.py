@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import json
+import os
+
+from biomedical_dashboards.biomed.config import Config, Context, Partner, BYTE_UNITS
+from biomedical_dashboards.biomed.gcp import bq_estimate_query_bytes
+from biomedical_dashboards.biomed.queries import (
+    partner_query_kwargs,
+    query_alltrials,
+    query_pubs,
+    query_trials,
+    render_cohort_queries,
+)
+from biomedical_dashboards.biomed.shared_workflow import (
+    SHARED_QUERIES,
+    previous_alltrials_lineage,
+    render_shared_queries,
+    shared_table_current,
+)
+
+
+class CostEstimate:
+    """The estimated cost of a single query
+
+    :param institution_id: The partner that the query is for, or "shared" for the shared queries
+    :param query_name: The name of the query
+    :param bytes_processed: The estimated bytes processed. None if it could not be estimated
+    :param note: Any explanation of the estimate
+    """
+
+    def __init__(self, *, institution_id: str, query_name: str, bytes_processed: Optional[int], note: str = ""):
+        self.institution_id = institution_id
+        self.query_name = query_name
+        self.bytes_processed = bytes_processed
+        self.note = note
+
+    def to_dict(self) -> dict:
+        return dict(
+            institution_id=self.institution_id,
+            query_name=self.query_name,
+            bytes_processed=self.bytes_processed,
+            note=self.note,
+        )
+
+
+def preflight(config: Config) -> List[CostEstimate]:
+    """Estimates the cost of every query in the workflow with BigQuery dry run jobs, prints a table of the estimates
+    and writes them to file. Raises RuntimeError if any query fails to dry run, or if the per-query or per-run budget
+    would be exceeded.
+
+    :param config: The workflow configuration
+    :return: The estimates
+    """
+    context = config.context
+    estimates = estimate_costs(config)
+    print(format_estimates(estimates))
+    with open(os.path.join(context.output_dir, context.cost_estimate_fname), "w") as f:
+        json.dump([e.to_dict() for e in estimates], f, indent=2)
+
+    errors = check_budget(estimates, context)
+    if errors:
+        msg = "\n\t".join(errors)
+        raise RuntimeError(f"Pre-flight cost check failed. No queries were run:\n\t{msg}")
+    print("Pre-flight cost check passed")
+    return estimates
+
+
+def estimate_costs(config: Config) -> List[CostEstimate]:
+    """Estimates the bytes processed by every query in the workflow.
+
+    The pubs query reads the partner's alltrials view, which won't exist before the run. As the view is a filter of
+    the shared alltrials extract, the pubs query is estimated against the extract instead, which processes the same
+    bytes. It can't be estimated if the extract doesn't exist yet either, or before the shared enriched DOIs table that
+    it also reads exists. Likewise, the trials query can't be estimated before the shared Trial-ID index exists.
+
+    With the cohort execution mode, the cohort's trials and pubs queries are estimated (as institution_id "cohort")
+    instead of each partner's. Filling each partner's tables from the cohort's tables reads only the partner's rows,
+    and can't be estimated before the cohort's tables exist.
+
+    Queries that the incremental run would skip are still estimated, so the estimates are an upper bound.
+    """
+    context = config.context
+    shared_ids = {
+        q: f"{context.project}.{context.shared_dataset}.{getattr(context, f'shared_{q}_name')}" for q in SHARED_QUERIES
+    }
+    shared_exists = {
+        q: context.metadata.table_exists(context.project, context.shared_dataset, getattr(context, f"shared_{q}_name"))
+        for q in SHARED_QUERIES
+    }
+    # A shared table made by other templates is rebuilt. See shared_table_current
+    shared_reused = {q: shared_exists[q] and shared_table_current(context, q) for q in SHARED_QUERIES}
+
+    def _estimate(institution_id: str, query_name: str, query: str) -> CostEstimate:
+        try:
+            bytes_processed = bq_estimate_query_bytes(context.project, query, client=context.client)
+        except Exception as e:
+            return CostEstimate(
+                institution_id=institution_id, query_name=query_name, bytes_processed=None, note=f"ERROR: {e}"
+            )
+        return CostEstimate(institution_id=institution_id, query_name=query_name, bytes_processed=bytes_processed)
+
+    estimates = []
+    shared_queries = render_shared_queries(context)
+    # Only one of the alltrials queries runs. The incremental one reads the previous extract, so only it is estimated
+    # if the extract can be built incrementally
+    if "alltrials_delta" in shared_queries:
+        delta = shared_queries.pop("alltrials_delta")
+        if not shared_reused["alltrials"] and previous_alltrials_lineage(context):
+            shared_queries["alltrials"] = delta
+    for query_name, query in shared_queries.items():
+        if shared_reused[query_name]:
+            estimates.append(
+                CostEstimate(institution_id="shared", query_name=query_name, bytes_processed=0, note="exists, reused")
+            )
+        else:
+            estimates.append(_estimate("shared", query_name, query))
+
+    # The shared tables that each partner query reads
+    needs = dict(alltrials=["alltrials"], trials=["trial_index"], pubs=["alltrials", "enriched_dois"])
+    renders = dict(alltrials=query_alltrials, trials=query_trials, pubs=query_pubs)
+    cohort = context.execution_mode == "cohort"
+    partner_queries = ["alltrials"] if cohort else ["alltrials", "trials", "pubs"]
+
+    def _missing(institution_id: str, query_name: str) -> Optional[CostEstimate]:
+        missing = [shared_ids[q] for q in needs[query_name] if not shared_exists[q]]
+        if not missing:
+            return None
+        note = f"depends on shared table(s) that don't exist yet: {', '.join(missing)}"
+        return CostEstimate(institution_id=institution_id, query_name=query_name, bytes_processed=None, note=note)
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=context.max_concurrent_jobs) as executor:
+        if cohort:
+            for query_name, query in render_cohort_queries(config.partners, context).items():
+                missing = _missing("cohort", query_name)
+                if missing:
+                    estimates.append(missing)
+                    continue
+                futures.append(executor.submit(_estimate, "cohort", query_name, query))
+        for partner in config.partners:
+            kwargs = partner_query_kwargs(partner=partner, context=context)
+            for query_name in partner_queries:
+                missing = _missing(partner.institution_id, query_name)
+                if missing:
+                    estimates.append(missing)
+                    continue
+                query_kwargs = (
+                    kwargs if query_name == "alltrials" else {**kwargs, "alltrials_table": shared_ids["alltrials"]}
+                )
+                query = renders[query_name](**query_kwargs)
+                futures.append(executor.submit(_estimate, partner.institution_id, query_name, query))
+    estimates += [f.result() for f in futures]
+    return estimates
+
+
+def check_budget(estimates: List[CostEstimate], context: Context) -> List[str]:
+    """Checks the estimates against the context's budgets
+
+    :return: A description of each problem found. Empty if the estimates are within budget
+    """
+    errors = []
+    for e in estimates:
+        if e.note.startswith("ERROR"):
+            errors.append(f"{e.institution_id}.{e.query_name} failed to dry run: {e.note}")
+        elif context.max_bytes_per_query is not None and (e.bytes_processed or 0) > context.max_bytes_per_query:
+            errors.append(
+                f"{e.institution_id}.{e.query_name} would process {format_bytes(e.bytes_processed)}, "
+                f"over the per-query budget of {format_bytes(context.max_bytes_per_query)}"
+            )
+
+    total = sum(e.bytes_processed or 0 for e in estimates)
+    if context.max_bytes_per_run is not None and total > context.max_bytes_per_run:
+        errors.append(
+            f"The run would process {format_bytes(total)}, over the per-run budget of "
+            f"{format_bytes(context.max_bytes_per_run)}"
+        )
+    return errors
+
+
+def format_estimates(estimates: List[CostEstimate]) -> str:
+    """Formats the estimates as a table, one row per query"""
+    width = max([len(e.institution_id) for e in estimates] + [len("institution_id")])
+    lines = [f"{'institution_id':<{width}}  {'query':<10}  {'estimate':>12}  note"]
+    for e in estimates:
+        estimate = format_bytes(e.bytes_processed) if e.bytes_processed is not None else "unknown"
+        lines.append(f"{e.institution_id:<{width}}  {e.query_name:<10}  {estimate:>12}  {e.note}")
+    total = sum(e.bytes_processed or 0 for e in estimates)
+    unknown = sum(1 for e in estimates if e.bytes_processed is None)
+    lines.append(f"Estimated total: {format_bytes(total)} ({unknown} queries could not be estimated)")
+    return "\n".join(lines)
+
+
+def format_bytes(num_bytes: int) -> str:
+    """Formats a number of bytes with the largest sensible unit, e.g. 1.50 TB"""
+    for unit, size in reversed(BYTE_UNITS.items()):
+        if num_bytes >= size:
+            return f"{num_bytes / size:.2f} {unit}"
+    return f"{num_bytes} B"
@@ -0,0 +1,556 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import json
+import math
+import os
+import re
+
+from biomedical_dashboards.biomed.config import Config, Context
+from biomedical_dashboards.biomed.gcp import bq_get_query_plan
+from biomedical_dashboards.biomed.logs import sharedprint
+from biomedical_dashboards.biomed.telemetry import read_records
+
+# A rule line of a section header in the query templates: a comment line of dashes. The title is between two rules, e.g.
+# -----------------------------------------------------------------------
+# -- 3a: Link Pubmed data to main query - Clintrials
+# -----------------------------------------------------------------------
+SECTION_RULE = re.compile(r"^\s*(?:#\s*)?-{10,}\s*$")
+
+# A comment line. Its text is the title of a section when it follows a rule line
+COMMENT_LINE = re.compile(r"^\s*(?:--+|#+)\s*(.*?)\s*$")
+
+# A comment at the end of a line of SQL
+TRAILING_COMMENT = re.compile(r"(--|#).*$")
+
+# The definition of a named subquery, whose name is used as the name of the section that it is in
+CTE_DEFINITION = re.compile(r"^\s*(?:WITH\s+)?(\w+)\s+AS\s*\(", flags=re.IGNORECASE | re.MULTILINE)
+
+# A table, view or function created by a statement. Its name is used for a section without a named subquery
+CREATED_OBJECT = re.compile(
+    r"CREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP(?:ORARY)?\s+)?(?:TABLE|VIEW|FUNCTION)\s+`?([\w.-]+)`?", flags=re.IGNORECASE
+)
+
+# The words and quoted strings of a query or of a plan's steps, which stages are matched to sections by. Quotes in a
+# string are escaped with a backslash, e.g. the plan's 'the institution\'s trials'
+TOKEN = re.compile(r"'((?:[^'\\]|\\.)*)'|\"((?:[^\"\\]|\\.)*)\"|([A-Za-z_][A-Za-z0-9_]*)")
+
+# An escaped character in a quoted string
+ESCAPE = re.compile(r"\\(.)")
+
+# Words that are in too much SQL, or in every stage of a plan, to tell sections apart
+STOP_WORDS = {
+    "and",
+    "any",
+    "array",
+    "as",
+    "asc",
+    "by",
+    "case",
+    "cast",
+    "create",
+    "cross",
+    "desc",
+    "distinct",
+    "else",
+    "end",
+    "false",
+    "from",
+    "full",
+    "group",
+    "if",
+    "ifnull",
+    "in",
+    "inner",
+    "is",
+    "join",
+    "left",
+    "limit",
+    "not",
+    "null",
+    "on",
+    "or",
+    "order",
+    "outer",
+    "replace",
+    "right",
+    "select",
+    "string",
+    "struct",
+    "table",
+    "then",
+    "to",
+    "true",
+    "union",
+    "unnest",
+    "when",
+    "where",
+    "with",
+}
+
+# The section of stages that match no section and read from no stage that does
+UNATTRIBUTED = "(unattributed)"
+
+# The metrics of each stage of a query plan, by their key in the BigQuery REST API (ExplainQueryStage)
+STAGE_METRICS = dict(
+    slot_ms="slotMs",
+    wait_ms="waitMsAvg",
+    read_ms="readMsAvg",
+    compute_ms="computeMsAvg",
+    write_ms="writeMsAvg",
+    shuffle_bytes="shuffleOutputBytes",
+    shuffle_spilled_bytes="shuffleOutputBytesSpilled",
+    records_read="recordsRead",
+    records_written="recordsWritten",
+)
+
+# The metrics that the plan gives as the average of the stage's workers. They are multiplied by the number of workers
+# (the stage's completed parallel inputs) for an estimate of the stage's total
+AVERAGED_METRICS = ("wait_ms", "read_ms", "compute_ms", "write_ms")
+
+# A section has regressed if its slot time has grown by more than this fraction of the baseline's...
+REGRESSION_RATIO = 0.2
+
+# ...and by more than this many slot milliseconds, so that the noise in small sections isn't reported
+REGRESSION_MIN_SLOT_MS = 10_000
+
+
+class Section:
+    """A section of a query, from one section header of its template to the next
+
+    :param name: The name of the section: the first subquery that it defines or table, view or function that it
+    creates, or else its title. Unique within the query
+    :param title: The title in the section's header
+    :param sql: The SQL of the section, without comments
+    """
+
+    def __init__(self, *, name: str, title: str, sql: str):
+        self.name = name
+        self.title = title
+        self.sql = sql
+        self.tokens = tokenize(sql)
+
+
+def tokenize(text: str) -> set:
+    """The distinct words and quoted strings in some SQL or plan steps, in lower case, that stages are matched to
+    sections by. Stop words, words of fewer than 3 characters and the names of the plan's stage outputs are left out"""
+    tokens = set()
+    for match in TOKEN.finditer(text):
+        token = ESCAPE.sub(r"\1", next(g for g in match.groups() if g is not None)).lower()
+        if len(token) >= 3 and token not in STOP_WORDS and not token.startswith("__stage"):
+            tokens.add(token)
+    return tokens
+
+
+def parse_sections(query: str) -> List[Section]:
+    """Splits a query into the sections of its template, at each section header (see SECTION_RULE). The SQL before the
+    first header is a section of its own. Sections that hold only comments are left out
+
+    :param query: The query, as rendered from its template
+    :return: The sections, in the order that they appear
+    """
+    parts = [["(preamble)", []]]
+    lines = query.splitlines()
+    i = 0
+    while i < len(lines):
+        if SECTION_RULE.match(lines[i]):
+            # A header is a rule, one or more comment lines and another rule
+            end = i + 1
+            while end < len(lines) and COMMENT_LINE.match(lines[end]) and not SECTION_RULE.match(lines[end]):
+                end += 1
+            titles = [COMMENT_LINE.match(line).group(1) for line in lines[i + 1 : end]]
+            if end < len(lines) and SECTION_RULE.match(lines[end]) and any(titles):
+                parts.append([next(t for t in titles if t), []])
+                i = end + 1
+                continue
+        if not COMMENT_LINE.match(lines[i]):
+            parts[-1][1].append(TRAILING_COMMENT.sub("", lines[i]))
+        i += 1
+
+    sections = []
+    names = set()
+    for title, sql_lines in parts:
+        sql = "\n".join(sql_lines).strip()
+        if not tokenize(sql):
+            continue
+        definitions = [m for m in (CTE_DEFINITION.search(sql), CREATED_OBJECT.search(sql)) if m]
+        name = min(definitions, key=lambda m: m.start()).group(1).split(".")[-1] if definitions else title
+        unique_name, n = name, 1
+        while unique_name in names:
+            n += 1
+            unique_name = f"{name} ({n})"
+        names.add(unique_name)
+        sections.append(Section(name=unique_name, title=title, sql=sql))
+    return sections
+
+
+def stage_metrics(entry: dict) -> Dict[str, int]:
+    """The metrics of a stage of a query plan. See STAGE_METRICS
+
+    :param entry: The stage, as returned by the BigQuery REST API. Its integers may be strings
+    """
+    workers = int(entry.get("completedParallelInputs") or 0)
+    metrics = {}
+    for metric, key in STAGE_METRICS.items():
+        value = float(entry.get(key) or 0)
+        metrics[metric] = int(value * workers if metric in AVERAGED_METRICS else value)
+    return metrics
+
+
+def attribute_stages(sections: List[Section], query_plan: List[dict]) -> List[dict]:
+    """Attributes each stage of a query plan to the section of the query that it most likely runs.
+
+    The steps of a stage name the columns, tables, functions and constants that it works on, but not the subqueries
+    that they come from. So each stage is matched to the section with the most of the stage's words and quoted strings,
+    with each weighted by how few sections it appears in (its inverse document frequency). A stage that matches no
+    section, e.g. one that only joins or aggregates the output of other stages, is attributed to the section of the
+    input stage with the most slot time.
+
+    :param sections: The sections of the query. See parse_sections
+    :param query_plan: The stages of the query plan. See gcp.bq_get_query_plan
+    :return: The stages, as dict(statement, id, name, section, **metrics), in plan order
+    """
+    document_frequency = defaultdict(int)
+    for section in sections:
+        for token in section.tokens:
+            document_frequency[token] += 1
+    weight = {token: math.log((1 + len(sections)) / df) for token, df in document_frequency.items()}
+
+    stages = []
+    attributed: Dict[Tuple[int, str], dict] = {}
+    for entry in query_plan:
+        statement = entry.get("statement", 0)
+        steps = " ".join(s for step in entry.get("steps", []) for s in step.get("substeps", []))
+        tokens = tokenize(steps)
+        best, best_score = None, 0.0
+        for section in sections:
+            score = sum(weight[t] for t in tokens & section.tokens)
+            if score > best_score:
+                best, best_score = section.name, score
+        if best is None:
+            inputs = [attributed[(statement, i)] for i in entry.get("inputStages", []) if (statement, i) in attributed]
+            best = max(inputs, key=lambda s: s["slot_ms"])["section"] if inputs else UNATTRIBUTED
+        stage = dict(statement=statement, id=entry.get("id"), name=entry.get("name"), section=best)
+        stage.update(stage_metrics(entry))
+        attributed[(statement, str(entry.get("id")))] = stage
+        stages.append(stage)
+    return stages
+
+
+class JobProfile:
+    """The cost of each section of a finished query job, summed over the stages of its plan attributed to the section
+
+    :param institution_id: The partner that the job was run for, or "shared" for the shared queries
+    :param template: The name of the query template, e.g. "pubs"
+    :param job_id: The BigQuery job id
+    :param sections: The metrics of each section, as {section: {metric: value}}, with the number of stages as "stages".
+    See STAGE_METRICS
+    :param stages: The stages of the plan. See attribute_stages
+    """
+
+    def __init__(
+        self,
+        *,
+        institution_id: str,
+        template: str,
+        job_id: str,
+        sections: Dict[str, Dict[str, int]],
+        stages: Optional[List[dict]] = None,
+    ):
+        self.institution_id = institution_id
+        self.template = template
+        self.job_id = job_id
+        self.sections = sections
+        self.stages = stages or []
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.institution_id, self.template
+
+    @property
+    def slot_ms(self) -> int:
+        return sum(s["slot_ms"] for s in self.sections.values())
+
+    def hotspots(self, top: Optional[int] = None) -> List[Tuple[str, Dict[str, int]]]:
+        """The sections, most slot time first"""
+        ranked = sorted(self.sections.items(), key=lambda item: item[1]["slot_ms"], reverse=True)
+        return ranked[:top] if top else ranked
+
+    def to_dict(self) -> dict:
+        return dict(
+            institution_id=self.institution_id,
+            template=self.template,
+            job_id=self.job_id,
+            slot_ms=self.slot_ms,
+            sections=self.sections,
+            stages=self.stages,
+        )
+
+    @staticmethod
+    def from_dict(profile: dict):
+        return JobProfile(
+            institution_id=profile["institution_id"],
+            template=profile["template"],
+            job_id=profile["job_id"],
+            sections=profile["sections"],
+            stages=profile.get("stages"),
+        )
+
+
+def profile_plan(plan: dict) -> JobProfile:
+    """Profiles a job from its query plan
+
+    :param plan: The job's plan, as recorded by fetch_plans: dict(institution_id, template, job_id, query, query_plan)
+    :return: The profile
+    """
+    sections = parse_sections(plan["query"])
+    stages = attribute_stages(sections, plan["query_plan"])
+    totals = {}
+    for stage in stages:
+        section = totals.setdefault(stage["section"], dict(stages=0, **{m: 0 for m in STAGE_METRICS}))
+        section["stages"] += 1
+        for metric in STAGE_METRICS:
+            section[metric] += stage[metric]
+    return JobProfile(
+        institution_id=plan["institution_id"],
+        template=plan["template"],
+        job_id=plan["job_id"],
+        sections=totals,
+        stages=stages,
+    )
+
+
+def plans_dir(context: Context, run_version: str) -> str:
+    """The directory that the query plans of a run version's jobs are recorded in"""
+    return os.path.join(context.output_dir, f"plans_{run_version}")
+
+
+def profile_path(context: Context, run_version: str) -> str:
+    """The file that the profiles of a run version's jobs are stored in"""
+    return os.path.join(context.output_dir, f"profile_{run_version}.json")
+
+
+def fetch_plans(
+    context: Context,
+    run_version: str,
+    templates: Optional[List[str]] = None,
+    partners: Optional[List[str]] = None,
+) -> List[dict]:
+    """Fetches the query plans of a run version's query jobs, found in the run's telemetry, and records each to a file
+    in plans_dir. The recorded files can be profiled again later without connecting to GCP, see load_plans. Only the
+    last job of each partner and template is fetched, e.g. the one that succeeded after a retry
+
+    :param context: The workflow context
+    :param run_version: The run version whose jobs to fetch
+    :param templates: The templates to fetch the jobs of, e.g. pubs. All if not supplied
+    :param partners: The partners to fetch the jobs of, including "shared" for the shared queries. All if not supplied
+    :return: The plans, as dict(institution_id, template, run_version, job_id, query, query_plan)
+    """
+    latest = {}
+    for record in read_records(context.telemetry.path, run_version=run_version):
+        if templates and record.template not in templates:
+            continue
+        if partners and record.institution_id not in partners:
+            continue
+        if not record.job_id:
+            continue
+        latest[(record.institution_id, record.template)] = record
+    if not latest:
+        raise RuntimeError(
+            f"No query jobs of run version {run_version} found in the telemetry: {context.telemetry.path}"
+        )
+
+    def _fetch(record) -> dict:
+        plan = bq_get_query_plan(context.project, record.job_id, client=context.client)
+        return dict(institution_id=record.institution_id, template=record.template, run_version=run_version, **plan)
+
+    with ThreadPoolExecutor(max_workers=context.max_concurrent_jobs) as executor:
+        plans = list(executor.map(_fetch, latest.values()))
+
+    directory = plans_dir(context, run_version)
+    os.makedirs(directory, exist_ok=True)
+    for plan in plans:
+        with open(os.path.join(directory, f"{plan['institution_id']}_{plan['template']}.json"), "w") as f:
+            json.dump(plan, f, indent=2)
+    sharedprint(f"Query plans of {len(plans)} job(s) written to: {directory}")
+    return plans
+
+
+def load_plans(paths: List[str]) -> List[dict]:
+    """Loads recorded query plans. See fetch_plans
+
+    :param paths: The recorded plan files, or directories of them
+    :return: The plans
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json"))
+        else:
+            files.append(path)
+    plans = []
+    for file in files:
+        with open(file) as f:
+            plans.append(json.load(f))
+    return plans
+
+
+class SectionChange:
+    """The change in a section's slot time between a baseline profile and the current one
+
+    :param institution_id: The partner that the jobs were run for
+    :param template: The name of the query template
+    :param section: The name of the section
+    :param baseline_slot_ms: The section's slot time in the baseline profile. 0 if the section is new
+    :param current_slot_ms: The section's slot time in the current profile. 0 if the section is gone
+    """
+
+    def __init__(
+        self, *, institution_id: str, template: str, section: str, baseline_slot_ms: int, current_slot_ms: int
+    ):
+        self.institution_id = institution_id
+        self.template = template
+        self.section = section
+        self.baseline_slot_ms = baseline_slot_ms
+        self.current_slot_ms = current_slot_ms
+
+    @property
+    def change_ms(self) -> int:
+        return self.current_slot_ms - self.baseline_slot_ms
+
+    @property
+    def regressed(self) -> bool:
+        """Whether the section's slot time has grown by more than REGRESSION_RATIO and REGRESSION_MIN_SLOT_MS"""
+        return self.change_ms > REGRESSION_MIN_SLOT_MS and self.current_slot_ms > self.baseline_slot_ms * (
+            1 + REGRESSION_RATIO
+        )
+
+    def to_dict(self) -> dict:
+        return dict(
+            institution_id=self.institution_id,
+            template=self.template,
+            section=self.section,
+            baseline_slot_ms=self.baseline_slot_ms,
+            current_slot_ms=self.current_slot_ms,
+            change_ms=self.change_ms,
+            regressed=self.regressed,
+        )
+
+
+def diff_profiles(baseline: List[JobProfile], current: List[JobProfile]) -> List[SectionChange]:
+    """Compares the slot time of every section of the jobs profiled in both the baseline and the current profiles. Jobs
+    of a partner and template that are only in one of them are left out
+
+    :return: The change of each section, the largest growth first
+    """
+    baseline_by_key = {p.key: p for p in baseline}
+    changes = []
+    for profile in current:
+        previous = baseline_by_key.get(profile.key)
+        if previous is None:
+            continue
+        for section in sorted(set(previous.sections) | set(profile.sections)):
+            changes.append(
+                SectionChange(
+                    institution_id=profile.institution_id,
+                    template=profile.template,
+                    section=section,
+                    baseline_slot_ms=previous.sections.get(section, {}).get("slot_ms", 0),
+                    current_slot_ms=profile.sections.get(section, {}).get("slot_ms", 0),
+                )
+            )
+    return sorted(changes, key=lambda c: c.change_ms, reverse=True)
+
+
+def profile_run(
+    config: Config,
+    *,
+    run_version: Optional[str] = None,
+    templates: Optional[List[str]] = None,
+    partners: Optional[List[str]] = None,
+    plans: Optional[List[str]] = None,
+    baseline: Optional[str] = None,
+    top: int = 5,
+) -> Tuple[List[JobProfile], List[SectionChange]]:
+    """Profiles the query jobs of a run: attributes the slot time, shuffle and records of each stage of each job's query
+    plan to the section of the query template that it runs (see attribute_stages), prints the sections that cost the
+    most and stores the profiles in profile_path. With a baseline, the profiles are compared to the stored profiles of
+    the baseline run version, and the sections whose slot time has grown are reported.
+
+    :param config: The workflow configuration
+    :param run_version: The run version to profile. Defaults to the config's
+    :param templates: The templates to profile, e.g. pubs. All if not supplied
+    :param partners: The partners to profile, including "shared" for the shared queries. All if not supplied
+    :param plans: Recorded query plan files (or directories of them) to profile instead of fetching the run's jobs from
+    BigQuery. See fetch_plans
+    :param baseline: The run version to compare against. Its profiles must have been stored by an earlier profile_run
+    :param top: The number of sections of each job to print
+    :return: The profiles, and the changes from the baseline (empty without one)
+    """
+    context = config.context
+    run_version = str(run_version or context.run_version)
+    if plans:
+        recorded = [
+            p
+            for p in load_plans(plans)
+            if (not templates or p["template"] in templates) and (not partners or p["institution_id"] in partners)
+        ]
+    else:
+        recorded = fetch_plans(context, run_version, templates=templates, partners=partners)
+    profiles = [profile_plan(p) for p in recorded]
+
+    path = profile_path(context, run_version)
+    with open(path, "w") as f:
+        json.dump(dict(run_version=run_version, jobs=[p.to_dict() for p in profiles]), f, indent=2)
+    print(format_hotspots(profiles, top=top))
+    print(f"Profiles written to: {path}")
+
+    changes = []
+    if baseline:
+        baseline_path = profile_path(context, str(baseline))
+        if not os.path.exists(baseline_path):
+            raise RuntimeError(f"No stored profile for baseline run version {baseline}: {baseline_path}")
+        with open(baseline_path) as f:
+            baseline_profiles = [JobProfile.from_dict(p) for p in json.load(f)["jobs"]]
+        changes = diff_profiles(baseline_profiles, profiles)
+        print(format_changes(changes, baseline=str(baseline), run_version=run_version))
+    return profiles, changes
+
+
+def format_hotspots(profiles: List[JobProfile], top: int = 5) -> str:
+    """Formats the costliest sections of each job as a table, the costliest jobs first"""
+    lines = []
+    for profile in sorted(profiles, key=lambda p: p.slot_ms, reverse=True):
+        total = profile.slot_ms or 1
+        lines.append(
+            f"{profile.institution_id}.{profile.template} ({profile.job_id}): {profile.slot_ms / 1000:.1f} slot s"
+        )
+        lines.append(
+            f"\t{'section':<40} {'slot s':>9} {'share':>6} {'wait s':>9} {'compute s':>10} {'shuffle MB':>11} "
+            f"{'spilled MB':>11} {'rows read':>12} {'rows written':>13}"
+        )
+        for name, s in profile.hotspots(top):
+            lines.append(
+                f"\t{name[:40]:<40} {s['slot_ms'] / 1000:>9.1f} {s['slot_ms'] / total:>6.0%} "
+                f"{s['wait_ms'] / 1000:>9.1f} {s['compute_ms'] / 1000:>10.1f} {s['shuffle_bytes'] / 1024**2:>11.1f} "
+                f"{s['shuffle_spilled_bytes'] / 1024**2:>11.1f} {s['records_read']:>12} {s['records_written']:>13}"
+            )
+    return "\n".join(lines)
+
+
+def format_changes(changes: List[SectionChange], *, baseline: str, run_version: str) -> str:
+    """Formats the changes in slot time from the baseline as a table, with the regressions marked"""
+    regressions = [c for c in changes if c.regressed]
+    lines = [
+        f"Slot time by section, {baseline} -> {run_version}: {len(regressions)} regression(s)",
+        f"\t{'job':<30} {'section':<40} {'baseline s':>11} {'current s':>10} {'change s':>9}",
+    ]
+    for c in changes:
+        if not c.change_ms:
+            continue
+        job = f"{c.institution_id}.{c.template}"
+        lines.append(
+            f"\t{job[:30]:<30} {c.section[:40]:<40} {c.baseline_slot_ms / 1000:>11.1f} {c.current_slot_ms / 1000:>10.1f} "
+            f"{c.change_ms / 1000:>+9.1f}{'  REGRESSED' if c.regressed else ''}"
+        )
+    return "\n".join(lines)
@@ -1,25 +1,236 @@
-from importlib import resources
+from typing import Dict, List, Optional
+import copy
+import hashlib
+import os
 
-from jinja2 import Environment, BaseLoader, StrictUndefined
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, StrictUndefined
+
+from biomedical_dashboards.biomed.config import COHORT_CLUSTER_COLUMN, Context, Partner
+
+# The partner queries, in the order they run
+PARTNER_QUERIES = ("alltrials", "trials", "pubs")
+
+# The partner queries that the cohort execution mode runs once for every partner together
+COHORT_QUERIES = ("trials", "pubs")
+
+# The template of the shared alltrials extract. Its fingerprint is recorded with each extract, see template_fingerprint
+ALLTRIALS_SHARED_TEMPLATE = "dashboard_query0_alltrials_shared.sql.jinja2"
+
+# The template of the shared enriched DOIs table. Its fingerprint is recorded with each table, see template_fingerprint
+ENRICHED_DOIS_SHARED_TEMPLATE = "dashboard_query0_enriched_dois_shared.sql.jinja2"
+
+# The template of the shared Trial-ID index. Its fingerprint is recorded with each index, see template_fingerprint
+TRIAL_INDEX_SHARED_TEMPLATE = "dashboard_query0_trial_index_shared.sql.jinja2"
+
+# The run version that queries are rendered with to fingerprint them. The run version only names the output tables, so
+# the same query under any run version has the same fingerprint. See fingerprint_context
+FINGERPRINT_RUN_VERSION = "{run_version}"
+
+
+def create_environment(bytecode_cache_dir: Optional[str] = None) -> Environment:
+    """Creates the jinja environment for the query templates. Each template is compiled the first time it is used and
+    kept in the environment's cache, so it is only compiled once per process.
+
+    :param bytecode_cache_dir: If supplied, compiled templates are also cached in this directory, so that they are only
+    compiled once across processes
+    :return: The environment
+    """
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+    return Environment(
+        loader=PackageLoader("biomedical_dashboards", "queries"),
+        undefined=StrictUndefined,
+        auto_reload=False,  # The templates are package data, so they won't change while running
+        bytecode_cache=bytecode_cache,
+    )
+
+
+# The environment shared by all queries. Set BIOMED_TEMPLATE_CACHE to a directory to enable the on-disk bytecode cache
+ENVIRONMENT = create_environment(os.environ.get("BIOMED_TEMPLATE_CACHE"))
+
+
+def set_bytecode_cache(bytecode_cache_dir: Optional[str]) -> None:
+    """Replaces the shared environment with one that uses the given on-disk bytecode cache (or none)"""
+    global ENVIRONMENT
+    ENVIRONMENT = create_environment(bytecode_cache_dir)
+
+
+def render_template(template_name: str, **kwargs) -> str:
+    """Renders a query template from the shared environment
+
+    :param template_name: The file name of the template in biomedical_dashboards/queries
+    :return: The templated query
+    """
+    return ENVIRONMENT.get_template(template_name).render(**kwargs)
+
+
+def template_fingerprint(template_name: str) -> str:
+    """A fingerprint of a query template's source. Tables made by the same template from the same inputs have the same
+    rows, whatever the workflow hash
+
+    :param template_name: The file name of the template in biomedical_dashboards/queries
+    :return: The first 16 characters of the SHA-256 of the source
+    """
+    source, _, _ = ENVIRONMENT.loader.get_source(ENVIRONMENT, template_name)
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+def fingerprint_context(context: Context) -> Context:
+    """A copy of the context with FINGERPRINT_RUN_VERSION as its run version, to render queries with for their
+    fingerprints. The table names made from the run version follow it. The copy is shallow, so shares the context's
+    clients, caches and manifest"""
+    fingerprinted = copy.copy(context)
+    fingerprinted.run_version = FINGERPRINT_RUN_VERSION
+    return fingerprinted
+
+
+def partner_query_kwargs(partner: Partner, context: Context) -> dict:
+    """The keyword arguments that the partner's query templates are rendered with"""
+    return dict(
+        **partner.to_dict(),
+        **context.to_dict(),
+        alltrials_table=f"{context.project}.{partner.output_dataset}.{context.generated_alltrials_name}",
+        enriched_dois_table=f"{context.project}.{context.shared_dataset}.{context.shared_enriched_dois_name}",
+        trial_index_table=f"{context.project}.{context.shared_dataset}.{context.shared_trial_index_name}",
+        script=False,
+        cohort=False,
+    )
+
+
+def cohort_query_kwargs(partners: List[Partner], context: Context) -> dict:
+    """The keyword arguments that the cohort's trials and pubs queries are rendered with. The pubs query reads the
+    shared alltrials extract, filtering it to each partner's year cutoff itself, rather than each partner's view"""
+    # The cohort tables are clustered by partner first, so that filling each partner's table reads only its rows
+    table_options = {t: o.ddl(cluster_first=COHORT_CLUSTER_COLUMN) for t, o in context.table_options.items()}
+    return dict(
+        **{**context.to_dict(), "table_options": table_options},
+        partners=[p.to_dict() for p in partners],
+        alltrials_table=f"{context.project}.{context.shared_dataset}.{context.shared_alltrials_name}",
+        enriched_dois_table=f"{context.project}.{context.shared_dataset}.{context.shared_enriched_dois_name}",
+        trial_index_table=f"{context.project}.{context.shared_dataset}.{context.shared_trial_index_name}",
+        script=False,
+        cohort=True,
+    )
+
+
+def render_partner_queries(partners: List[Partner], context: Context) -> Dict[str, Dict[str, str]]:
+    """Renders all of the query templates for each of the partners
+
+    :param partners: The partners to render the queries for
+    :param context: The workflow context
+    :return: The queries as {institution_id: {query_name: query}}, where query_name is one of alltrials, trials, pubs.
+    With the script execution mode, there is also a "script" query that runs all three. With the cohort execution
+    mode, the trials and pubs queries fill the partner's tables from the cohort's tables. See render_cohort_queries
+    """
+    query_names = PARTNER_QUERIES + (("script",) if context.execution_mode == "script" else ())
+    return {
+        partner.institution_id: {
+            q: render_partner_query(partner=partner, context=context, query_name=q) for q in query_names
+        }
+        for partner in partners
+    }
+
+
+def render_partner_query(partner: Partner, context: Context, query_name: str) -> str:
+    """Renders one of a partner's queries. See render_partner_queries
+
+    :param partner: The partner to render the query for
+    :param context: The workflow context
+    :param query_name: One of PARTNER_QUERIES, or "script" for the script of all of them
+    :return: The query
+    """
+    kwargs = partner_query_kwargs(partner=partner, context=context)
+    if context.execution_mode == "cohort" and query_name in COHORT_QUERIES:
+        return query_cohort_fanout(
+            **kwargs, table=query_name, cohort_table=getattr(context, f"cohort_{query_name}_name")
+        )
+    if query_name == "alltrials":
+        return query_alltrials(**kwargs)
+    if query_name == "trials":
+        return query_trials(**kwargs)
+    if query_name == "pubs":
+        return query_pubs(**kwargs)
+    if query_name == "script":
+        return query_partner_script(**kwargs, queries=PARTNER_QUERIES)
+    raise RuntimeError(f"Unknown query: {query_name}")
+
+
+def render_cohort_queries(partners: List[Partner], context: Context) -> Dict[str, str]:
+    """Renders the trials and pubs queries for every partner together, for the cohort execution mode. Each creates the
+    table context.cohort_{query_name}_name in the shared dataset
+
+    :param partners: The partners of the cohort
+    :param context: The workflow context
+    :return: The queries as {query_name: query}. See COHORT_QUERIES
+    """
+    kwargs = cohort_query_kwargs(partners=partners, context=context)
+    return dict(trials=query_trials(**kwargs), pubs=query_pubs(**kwargs))
+
+
+def query_alltrials_shared(**kwargs) -> str:
+    """Creates the shared all_trials extract query from its template. Shared by all partners
+
+    The template expects the following as kwargs:
+    :param project: The project to write the extract to
+    :param doi_version: The doi table version as a string (YYYYMM) for sharding
+    :param workflow_hash: A string identifier for the version of the script used to make the query
+    :param shared_dataset: The dataset to write the extract to
+    :param shared_alltrials_name: The name of the extract table
+    :param shared_year_cutoff: The lowest publication year cutoff of all partners
+    :param incremental: Whether to build the extract from the previous DOI table version's extract, extracting only
+    the DOIs whose content hash is new or has changed
+    :param previous_alltrials_name: The name of the previous extract, in the shared dataset. Only read if incremental
+    :param sample_percent: If not None, only this percentage of DOIs (by a hash of the DOI) are extracted
+    :return: The templated query
+    """
+    return render_template(ALLTRIALS_SHARED_TEMPLATE, **kwargs)
+
+
+def query_enriched_dois_shared(**kwargs) -> str:
+    """Creates the shared enriched DOIs query from its template. Shared by all partners
+
+    The template expects the following as kwargs:
+    :param project: The project to write the table to
+    :param workflow_hash: A string identifier for the version of the script used to make the query
+    :param shared_dataset: The dataset to write the table to
+    :param shared_enriched_dois_name: The name of the table
+    :param doi_table: The full id of the Academic Observatory DOI table
+    :param unpaywall_table: The full id of the Unpaywall table
+    :return: The templated query
+    """
+    return render_template(ENRICHED_DOIS_SHARED_TEMPLATE, **kwargs)
+
+
+def query_trial_index_shared(**kwargs) -> str:
+    """Creates the shared Trial-ID index query from its template. Shared by all partners
+
+    The template expects the following as kwargs:
+    :param project: The project to write the index to
+    :param doi_version: The doi table version as a string (YYYYMM) for sharding
+    :param workflow_hash: A string identifier for the version of the script used to make the query
+    :param shared_dataset: The dataset containing the alltrials extract, and to write the index to
+    :param shared_alltrials_name: The name of the alltrials extract table
+    :param shared_trial_index_name: The name of the index table
+    :return: The templated query
+    """
+    return render_template(TRIAL_INDEX_SHARED_TEMPLATE, **kwargs)
 
 
 def query_alltrials(**kwargs) -> str:
-    """Creates the all_trials query from its template
+    """Creates the all_trials view query from its template
 
     The template expects the following as kwargs:
     :param run_version: The version as a string (YYYYMM) for sharding
-    :param doi_version: The doi table version as a string (YYYYMM) for sharding
     :param institution_id: The internal identifier of the institution
     :param workflow_hash: A string identifier for the version of the script used to make the query
     :param year_cutoff: An optional int/str that works as a cutoff for publication year
+    :param shared_dataset: The dataset containing the shared alltrials extract
+    :param shared_alltrials_name: The name of the shared alltrials extract table
     :return: The templated query
     """
-
-    with resources.open_text("biomedical_dashboards.queries", "dashboard_query1_alltrials.sql.jinja2") as f:
-        query_template = f.read()
-
-    query = Environment(loader=BaseLoader(), undefined=StrictUndefined).from_string(query_template).render(**kwargs)
-    return query
+    return render_template("dashboard_query1_alltrials.sql.jinja2", **kwargs)
 
 
 def query_trials(**kwargs) -> str:
@@ -32,13 +243,15 @@ def query_trials(**kwargs) -> str:
     :workflow_hash: A string identifier for the version of the script used to make the query
     :param trials_aact_table_name: The name of the static partner trials_aact table
     :param dois_table_name: The name of the static partner dois table
+    :param year_cutoff: An optional int/str that works as a cutoff for publication year
+    :param trial_index_table: The full id of the shared Trial-ID index. See query_trial_index_shared
+    :param script: Whether the query is part of a partner script, which declares the variables and functions instead
+    :param cohort: Whether to process every partner of the cohort together instead, into the cohort_trials_name table
+    of the shared dataset. The partner's own kwargs aren't needed. See cohort_query_kwargs
+    :param partners: The partners of the cohort, as dicts. Only read if cohort
     :return: The templated query
     """
-    with resources.open_text("biomedical_dashboards.queries", "dashboard_query2_trials.sql.jinja2") as f:
-        query_template = f.read()
-
-    query = Environment(loader=BaseLoader(), undefined=StrictUndefined).from_string(query_template).render(**kwargs)
-    return query
+    return render_template("dashboard_query2_trials.sql.jinja2", **kwargs)
 
 
 def query_pubs(**kwargs) -> str:
@@ -51,26 +264,85 @@ def query_pubs(**kwargs) -> str:
     :param workflow_hash: A string identifier for the version of the script used to make the query
     :param dois_table_name: The name of the static partner dois table
     :param oddpub_table_name: The name of the static partner oddpub table
+    :param enriched_dois_table: The full id of the shared enriched DOIs table. See query_enriched_dois_shared
+    :param alltrials_table: The full id of the partner's alltrials table. With cohort, the shared alltrials extract
+    :param script: Whether the query is part of a partner script, which declares the variables instead
+    :param cohort: Whether to process every partner of the cohort together instead, into the cohort_pubs_name table of
+    the shared dataset. The partner's own kwargs aren't needed. See cohort_query_kwargs
+    :param partners: The partners of the cohort, as dicts. Only read if cohort
     :return: The templated query
     """
-    with resources.open_text("biomedical_dashboards.queries", "dashboard_query3_pubs.sql.jinja2") as f:
-        query_template = f.read()
+    return render_template("dashboard_query3_pubs.sql.jinja2", **kwargs)
 
-    query = Environment(loader=BaseLoader(), undefined=StrictUndefined).from_string(query_template).render(**kwargs)
-    return query
+
+def query_pubs_legacy(**kwargs) -> str:
+    """Creates the legacy pubs query from its template. It joins the whole DOI table to Unpaywall and the alltrials
+    table before subsetting to the partner's DOIs, so is much more expensive. Its output is the same as query_pubs, and
+    it is kept to verify that. See verify.py
+
+    The template expects the kwargs of query_pubs, but reads the DOI and Unpaywall tables itself:
+    :param doi_table: The full id of the Academic Observatory DOI table
+    :param unpaywall_table: The full id of the Unpaywall table
+    :return: The templated query
+    """
+    return render_template("dashboard_query3_pubs_legacy.sql.jinja2", **kwargs)
+
+
+def query_partner_script(**kwargs) -> str:
+    """Creates the script that runs the partner's queries in a single job from its template. The variables and
+    functions are declared once. The queries read the same tables as when they run as separate jobs, so the script
+    scans no more than the jobs would.
+
+    The template expects the kwargs of query_alltrials, query_trials and query_pubs, and the following:
+    :param queries: The names of the queries to include, in PARTNER_QUERIES order. The alltrials view must exist if it
+    isn't included
+    :return: The templated query
+    """
+    return render_template("dashboard_partner_script.sql.jinja2", **kwargs)
+
+
+def query_cohort_fanout(**kwargs) -> str:
+    """Creates the query that fills one of the partner's tables with the partner's rows of the cohort's table. The
+    cohort's table is clustered by partner, so only the partner's rows are read
+
+    The template expects the following as kwargs:
+    :param project: The project containing the data
+    :param institution_id: The internal identifier of the institution
+    :param run_version: The version as a string (YYYYMM) for sharding
+    :param shared_dataset: The dataset containing the cohort's table
+    :param table: The name of the table (without shard). One of COHORT_QUERIES
+    :param cohort_table: The name of the cohort's table
+    :param table_options: The partitioning and clustering DDL of each table
+    :return: The templated query
+    """
+    return render_template("dashboard_cohort_fanout.sql.jinja2", **kwargs)
 
 
 def query_latest_view(**kwargs) -> str:
-    """Creates a latest table view
+    """Creates a latest table view of one run version's shard of a table. The publish_latest query makes its views
+    with the same template
 
     The template expects the following as kwargs:
     :param project: The project containing the data
     :param institution_id: The internal identifier of the institution
     :param table_name: The name of the table (without shard) to create a latest view of
+    :param run_version: The version of the table that the view reads
     :return: The templated query
     """
-    with resources.open_text("biomedical_dashboards.queries", "dashboard_view_latest.sql.jinja2") as f:
-        query_template = f.read()
+    return render_template("dashboard_view_latest.sql.jinja2", **kwargs)
+
+
+def query_publish_latest(**kwargs) -> str:
+    """Creates the query that publishes this run's tables to the latest dataset as clones or views, in one script
 
-    query = Environment(loader=BaseLoader(), undefined=StrictUndefined).from_string(query_template).render(**kwargs)
-    return query
+    The template expects the following as kwargs:
+    :param project: The project containing the data
+    :param institution_id: The internal identifier of the institution
+    :param run_version: The version of the tables to publish
+    :param tables: The names of the tables (without shard) to publish
+    :param publish_mode: One of clone, view
+    :param drop: The type (TABLE or VIEW) of each latest table that is of the other type to the one published, by
+    table name. Each is dropped in the script just before it is replaced
+    :return: The templated query
+    """
+    return render_template("dashboard_publish_latest.sql.jinja2", **kwargs)
@@ -0,0 +1,231 @@
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+import asyncio
+import random
+import threading
+import time
+
+T = TypeVar("T")
+
+# The kinds of BigQuery call that are rate limited separately. Metadata calls are the API calls that don't start a job
+# (e.g. getting a table or polling a job). Job calls submit a job, which counts towards the job quotas
+CALL_KINDS = ("metadata", "jobs")
+
+# The HTTP status codes of errors that are always transient: rate limiting and server errors
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# The reasons that BigQuery gives for client errors (e.g. a 403) that are transient. Any other reason is fatal, e.g.
+# quotaExceeded for a daily quota, or bytesBilledLimitExceeded
+RETRYABLE_REASONS = ("rateLimitExceeded", "jobRateLimitExceeded", "backendError", "internalError")
+
+
+def error_reasons(error: Exception) -> list:
+    """The reasons given by BigQuery for an error, e.g. ["rateLimitExceeded"]"""
+    return [e.get("reason") for e in getattr(error, "errors", None) or [] if isinstance(e, dict)]
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an error from a BigQuery call is transient, so the call may succeed if it is tried again.
+    Connection problems, rate limiting and server errors are retryable. Other errors, e.g. a missing table, a bad query
+    or an exhausted daily quota, are fatal."""
+    # Imported here so that the google libraries aren't loaded at startup. An error from them means they already are
+    from google.api_core.exceptions import ClientError, GoogleAPICallError
+
+    if isinstance(error, GoogleAPICallError) and error.code in RETRYABLE_STATUS_CODES:
+        return True
+    if isinstance(error, ClientError):
+        return any(reason in RETRYABLE_REASONS for reason in error_reasons(error))
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class RetryPolicy:
+    """How often and how long to wait before retrying a failed call. The waits back off exponentially, with full
+    jitter (each wait is random up to the backoff), so that many tasks throttled at once don't all retry at once.
+
+    :param max_attempts: The most times to try a call, including the first
+    :param initial_delay: The most seconds to wait before the first retry
+    :param max_delay: The most seconds to wait before any retry
+    :param multiplier: How much the most seconds to wait grows with each retry
+    :param seed: The seed for the jitter, so that waits can be repeated. Random if not supplied
+    """
+
+    def __init__(
+        self,
+        *,
+        max_attempts: int = 6,
+        initial_delay: float = 1.0,
+        max_delay: float = 60.0,
+        multiplier: float = 2.0,
+        seed: Optional[int] = None,
+    ):
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, attempt: int) -> float:
+        """The number of seconds to wait after a failed attempt. attempt is 1 after the first"""
+        backoff = min(self.max_delay, self.initial_delay * self.multiplier ** (attempt - 1))
+        with self._lock:
+            return self._random.uniform(0, backoff)
+
+
+class TokenBucket:
+    """Limits the rate of calls. Each call takes a token, and tokens are added at rate per second up to capacity, so
+    that bursts of up to capacity calls are allowed. Tokens are reserved before waiting, so callers are served in
+    order and a waiting caller doesn't hold a lock.
+
+    :param rate: The number of calls allowed per second
+    :param capacity: The most calls allowed at once after a quiet spell. Defaults to one second's worth
+    """
+
+    def __init__(self, *, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes a token, and returns the number of seconds to wait until it is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+
+class QuotaGuard:
+    """The retry and rate limiting policy of every BigQuery call, shared by the whole process. Calls are made through
+    call (or call_async), which waits for a token from the call kind's bucket, makes the call and retries it with
+    backoff if it fails with a retryable error (see is_retryable). Fatal errors, and retryable errors on the last
+    attempt, are raised.
+
+    The time spent waiting for tokens and backing off is counted, so that a run can report how much it was throttled.
+
+    :param retry: The retry policy. Defaults to RetryPolicy()
+    :param api_calls_per_second: The most metadata calls to make per second. Unlimited if None
+    :param jobs_per_second: The most jobs to submit per second. Unlimited if None
+    """
+
+    def __init__(
+        self,
+        *,
+        retry: Optional[RetryPolicy] = None,
+        api_calls_per_second: Optional[float] = None,
+        jobs_per_second: Optional[float] = None,
+    ):
+        self.retry = retry if retry else RetryPolicy()
+        self.buckets: Dict[str, Optional[TokenBucket]] = dict(
+            metadata=TokenBucket(rate=api_calls_per_second) if api_calls_per_second else None,
+            jobs=TokenBucket(rate=jobs_per_second) if jobs_per_second else None,
+        )
+        self.calls = Counter()
+        self.retries = Counter()  # By error reason, or error type if there is no reason
+        self.failures = Counter()  # Calls that failed after every attempt, by call kind
+        self.rate_limited_seconds = Counter()  # By call kind
+        self.backoff_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def call(self, kind: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """Makes a call, rate limited by the kind's bucket and retried if it fails with a retryable error
+
+        :param kind: The kind of call. One of CALL_KINDS
+        :param func: The function that makes the call. Must be safe to call again after a retryable error
+        :return: The result of the call
+        """
+        attempt = 1
+        while True:
+            time.sleep(self._take(kind))
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self._failed(kind, e, attempt)
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, kind: str, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Awaitable version of call. func is a coroutine function, and the waits don't hold a thread"""
+        attempt = 1
+        while True:
+            await asyncio.sleep(self._take(kind))
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._failed(kind, e, attempt)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _take(self, kind: str) -> float:
+        """Counts a call and takes a token for it. Returns the number of seconds to wait before making it"""
+        bucket = self.buckets[kind]
+        wait = bucket.reserve() if bucket else 0.0
+        with self._lock:
+            self.calls[kind] += 1
+            self.rate_limited_seconds[kind] += wait
+        return wait
+
+    def _failed(self, kind: str, error: Exception, attempt: int) -> float:
+        """Decides what to do about a failed call. Raises the error if it is fatal or this was the last attempt.
+        Otherwise returns the number of seconds to back off for"""
+        if not is_retryable(error):
+            raise error
+        if attempt >= self.retry.max_attempts:
+            with self._lock:
+                self.failures[kind] += 1
+            raise error
+        delay = self.retry.delay(attempt)
+        reasons = error_reasons(error) or [type(error).__name__]
+        with self._lock:
+            self.retries[reasons[0]] += 1
+            self.backoff_seconds += delay
+        return delay
+
+    @property
+    def throttled_seconds(self) -> float:
+        """The total seconds that calls waited for tokens or backed off"""
+        return sum(self.rate_limited_seconds.values()) + self.backoff_seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                calls=dict(self.calls),
+                retries=dict(self.retries),
+                failures=dict(self.failures),
+                rate_limited_seconds=dict(self.rate_limited_seconds),
+                backoff_seconds=self.backoff_seconds,
+            )
+
+    def report(self) -> str:
+        """A human-readable report of the calls made, retried and throttled"""
+        stats = self.stats()
+        calls = ", ".join(f"{k}: {v}" for k, v in sorted(stats["calls"].items()))
+        retries = ", ".join(f"{k}: {v}" for k, v in sorted(stats["retries"].items())) or "none"
+        limited = ", ".join(f"{k}: {v:.1f}s" for k, v in sorted(stats["rate_limited_seconds"].items()) if v)
+        lines = [
+            f"BigQuery calls: {sum(stats['calls'].values())} ({calls})",
+            f"\tRetried: {sum(stats['retries'].values())} ({retries})",
+            f"\tFailed after retrying: {sum(stats['failures'].values())}",
+            f"\tThrottled: {self.throttled_seconds:.1f}s ({limited or 'no rate limiting'}, backing off: "
+            f"{stats['backoff_seconds']:.1f}s)",
+        ]
+        return "\n".join(lines)
+
+
+# The guard of every BigQuery call in the process. Set from the config with set_quota_guard. Until then, calls are
+# retried but not rate limited
+QUOTA_GUARD = QuotaGuard()
+
+
+def quota_guard() -> QuotaGuard:
+    """The guard of every BigQuery call in the process"""
+    return QUOTA_GUARD
+
+
+def set_quota_guard(guard: QuotaGuard) -> None:
+    """Replaces the guard of every BigQuery call in the process"""
+    global QUOTA_GUARD
+    QUOTA_GUARD = guard
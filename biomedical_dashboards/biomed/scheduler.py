@@ -0,0 +1,285 @@
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+import asyncio
+import heapq
+import time
+import traceback
+
+from biomedical_dashboards.biomed.checkpoint import CheckpointStore
+
+
+class Task:
+    """A single unit of work in the workflow graph
+
+    :param name: The unique name of the task. By convention "<institution_id>:<stage>", or "shared:<stage>"
+    :param func: The function to run. Takes no arguments.
+    :param deps: The names of the tasks that must complete successfully before this task can start
+    :param partner: The institution_id of the partner that this task belongs to. None for shared tasks.
+    :param coro: An awaitable version of func, used by TaskGraph.run_async. Takes no arguments. If not supplied,
+    run_async runs func in a worker thread.
+    :param verify: A cheap check that the task's output still exists, used to confirm a task that a checkpoint says
+    was completed before skipping it. Takes no arguments and returns a bool. If not supplied, the checkpoint is trusted.
+    """
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        func: Callable[[], None],
+        deps: Iterable[str] = (),
+        partner: Optional[str] = None,
+        coro: Optional[Callable[[], Awaitable[None]]] = None,
+        verify: Optional[Callable[[], bool]] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.coro = coro
+        self.verify = verify
+        self.deps = list(deps)
+        self.partner = partner
+        self.status = "pending"  # One of: pending, running, done, failed, skipped
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """The time in seconds that the task took to run. Zero if it did not run"""
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class TaskGraph:
+    """A dependency graph of tasks. Ready tasks are dispatched to a shared pool of workers until all tasks are
+    finished. A task whose dependency fails is skipped, but unrelated tasks keep running.
+
+    :param checkpoint: If supplied, every task that completes is recorded in it, and tasks that it records as complete
+    (and whose output is verified) are not run again.
+    """
+
+    def __init__(self, checkpoint: Optional[CheckpointStore] = None):
+        self.tasks: Dict[str, Task] = {}
+        self.wall_time: float = 0.0
+        self.checkpoint = checkpoint
+
+    def add(self, task: Task) -> Task:
+        """Adds a task to the graph"""
+        if task.name in self.tasks:
+            raise RuntimeError(f"Task already exists in the graph: {task.name}")
+        self.tasks[task.name] = task
+        return task
+
+    def topological_order(self) -> List[Task]:
+        """Orders the tasks so that every task comes after all of its dependencies. Raises RuntimeError if a
+        dependency is missing from the graph or the graph contains a cycle."""
+        missing = [f"{t.name} -> {d}" for t in self.tasks.values() for d in t.deps if d not in self.tasks]
+        if missing:
+            msg = "\n\t".join(missing)
+            raise RuntimeError(f"Task dependencies missing from the graph:\n\t{msg}")
+
+        in_degree = {name: len(t.deps) for name, t in self.tasks.items()}
+        dependents = self._dependents()
+        queue = [name for name, degree in in_degree.items() if degree == 0]
+        order = []
+        while queue:
+            name = queue.pop(0)
+            order.append(self.tasks[name])
+            for d in dependents[name]:
+                in_degree[d] -= 1
+                if in_degree[d] == 0:
+                    queue.append(d)
+        if len(order) != len(self.tasks):
+            cycle = sorted(name for name, degree in in_degree.items() if degree > 0)
+            raise RuntimeError(f"Task graph contains a cycle between: {cycle}")
+        return order
+
+    def run(self, max_workers: int) -> None:
+        """Runs every task in the graph, never having more than max_workers tasks running at once.
+
+        Ready tasks are started in order of the length of the longest chain of tasks that depend on them, so the
+        tasks on the critical path get a worker first.
+
+        :param max_workers: The maximum number of tasks to run concurrently
+        """
+        order = self.topological_order()
+        dependents = self._dependents()
+        rank = self._ranks(order, dependents)
+        position = {t.name: i for i, t in enumerate(order)}
+        waiting_on = {t.name: set(t.deps) for t in order}
+        ready = []
+        for t in order:
+            if not t.deps:
+                heapq.heappush(ready, (-rank[t.name], position[t.name], t.name))
+
+        wall_start = time.monotonic()
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while ready or running:
+                while ready and len(running) < max_workers:
+                    _, _, name = heapq.heappop(ready)
+                    task = self.tasks[name]
+                    task.status = "running"
+                    running[executor.submit(self._run_task, task)] = task
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if task.status == "failed":
+                        self._skip_dependents(task, dependents)
+                        continue
+                    for d in dependents[task.name]:
+                        waiting_on[d].discard(task.name)
+                        if not waiting_on[d] and self.tasks[d].status == "pending":
+                            heapq.heappush(ready, (-rank[d], position[d], d))
+        self.wall_time = time.monotonic() - wall_start
+
+        # Anything left pending could not be reached
+        for t in self.tasks.values():
+            if t.status == "pending":
+                t.status = "skipped"
+
+    def run_async(self, max_concurrent: int, max_threads: int) -> None:
+        """Runs every task in the graph from a single asyncio event loop, never having more than max_concurrent tasks
+        running at once.
+
+        Tasks with a coro (e.g. queries, which submit a job then poll it) only use a thread for the moment of each API
+        call, so many more tasks can be in flight than there are threads. Tasks without one run in a worker thread.
+
+        :param max_concurrent: The maximum number of tasks to run concurrently
+        :param max_threads: The maximum number of worker threads for blocking calls
+        """
+        order = self.topological_order()
+        wall_start = time.monotonic()
+        asyncio.run(self._run_all_async(order, max_concurrent=max_concurrent, max_threads=max_threads))
+        self.wall_time = time.monotonic() - wall_start
+
+    async def _run_all_async(self, order: List[Task], max_concurrent: int, max_threads: int) -> None:
+        """Starts a coroutine for every task, each of which waits for its dependencies before running"""
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=max_threads)
+        loop.set_default_executor(executor)
+        semaphore = asyncio.Semaphore(max_concurrent)
+        finished = {t.name: asyncio.Event() for t in order}
+
+        async def _run(task: Task) -> None:
+            for d in task.deps:
+                await finished[d].wait()
+            failed = [d for d in task.deps if self.tasks[d].status != "done"]
+            if failed:
+                task.status = "skipped"
+                task.error = f"Skipped as upstream task failed: {failed[0]}"
+                finished[task.name].set()
+                return
+            async with semaphore:
+                task.status = "running"
+                task.start = time.monotonic()
+                try:
+                    if await loop.run_in_executor(None, self._resume, task):
+                        task.status = "done"
+                    else:
+                        if task.coro:
+                            await task.coro()
+                        else:
+                            await loop.run_in_executor(None, task.func)
+                        self._complete(task)
+                except Exception:
+                    task.status = "failed"
+                    task.error = traceback.format_exc()
+                finally:
+                    task.end = time.monotonic()
+                    finished[task.name].set()
+
+        try:
+            await asyncio.gather(*(_run(t) for t in order))
+        finally:
+            executor.shutdown(wait=True)
+
+    def errors(self) -> Dict[str, str]:
+        """The tracebacks of the failed tasks, keyed by task name"""
+        return {name: t.error for name, t in self.tasks.items() if t.status == "failed"}
+
+    def critical_path(self) -> List[Task]:
+        """The chain of dependent tasks with the longest total run time. This is the lower bound of the wall time
+        of the workflow, no matter how many workers are available."""
+        order = self.topological_order()
+        best: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+        for t in order:
+            prev = max(t.deps, key=lambda d: best[d], default=None)
+            best[t.name] = t.duration + (best[prev] if prev else 0.0)
+            previous[t.name] = prev
+        if not best:
+            return []
+        name = max(best, key=lambda n: best[n])
+        path = []
+        while name:
+            path.append(self.tasks[name])
+            name = previous[name]
+        return list(reversed(path))
+
+    def critical_path_report(self) -> str:
+        """A human-readable report of the critical path"""
+        path = self.critical_path()
+        total = sum(t.duration for t in path)
+        lines = [f"Workflow wall time: {self.wall_time:.1f}s. Critical path: {total:.1f}s over {len(path)} task(s)"]
+        for t in path:
+            lines.append(f"\t{t.duration:>8.1f}s  {t.name} ({t.status})")
+        return "\n".join(lines)
+
+    def _run_task(self, task: Task) -> None:
+        """Runs the task function, recording its timings and any error"""
+        task.start = time.monotonic()
+        try:
+            if self._resume(task):
+                task.status = "done"
+            else:
+                task.func()
+                self._complete(task)
+        except Exception:
+            task.status = "failed"
+            task.error = traceback.format_exc()
+        finally:
+            task.end = time.monotonic()
+
+    def _resume(self, task: Task) -> bool:
+        """Whether the task can be skipped, as the checkpoint records it as complete and its output is verified"""
+        if not self.checkpoint or not self.checkpoint.is_complete(task.name):
+            return False
+        if task.verify and not task.verify():
+            return False
+        self.checkpoint.resume(task.name)
+        return True
+
+    def _complete(self, task: Task) -> None:
+        """Marks the task as done and records it in the checkpoint"""
+        task.status = "done"
+        if self.checkpoint:
+            self.checkpoint.complete(task.name)
+
+    def _dependents(self) -> Dict[str, List[str]]:
+        """Maps each task name to the names of the tasks that depend on it"""
+        dependents = defaultdict(list)
+        for t in self.tasks.values():
+            for d in t.deps:
+                dependents[d].append(t.name)
+        return dependents
+
+    def _ranks(self, order: List[Task], dependents: Dict[str, List[str]]) -> Dict[str, int]:
+        """The length of the longest chain of tasks that depend on each task"""
+        rank = {}
+        for t in reversed(order):
+            rank[t.name] = 1 + max((rank[d] for d in dependents[t.name]), default=0)
+        return rank
+
+    def _skip_dependents(self, task: Task, dependents: Dict[str, List[str]]) -> None:
+        """Marks everything downstream of a failed task as skipped"""
+        stack = list(dependents[task.name])
+        while stack:
+            name = stack.pop()
+            if self.tasks[name].status != "pending":
+                continue
+            self.tasks[name].status = "skipped"
+            self.tasks[name].error = f"Skipped as upstream task failed: {task.name}"
+            stack.extend(dependents[name])
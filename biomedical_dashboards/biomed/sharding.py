@@ -0,0 +1,301 @@
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+import heapq
+import json
+import os
+
+from biomedical_dashboards.biomed.config import Config, Partner
+from biomedical_dashboards.biomed.scheduler import TaskGraph
+
+# The number of queries/partners to include in each list of the merged telemetry
+TOP = 5
+
+
+def assign_shards(partners: List[Partner], shard_count: int) -> List[List[Partner]]:
+    """Splits the partners into shards of about equal total shard_weight. Partners are taken heaviest first (ties by
+    institution_id) and each is given to the shard with the least weight so far (ties by lowest index). The assignment
+    only depends on the partners' ids and weights, so every process of a run assigns them the same way, whatever the
+    order of the config.
+
+    :param partners: The partners
+    :param shard_count: The number of shards
+    :return: The partners of each shard, by shard index
+    """
+    shards: List[List[Partner]] = [[] for _ in range(shard_count)]
+    loads = [(0.0, i) for i in range(shard_count)]
+    for partner in sorted(partners, key=lambda p: (-p.shard_weight, p.institution_id)):
+        load, i = heapq.heappop(loads)
+        shards[i].append(partner)
+        heapq.heappush(loads, (load + partner.shard_weight, i))
+    return shards
+
+
+def shard_config(config: Config, shard_index: int, shard_count: int) -> Config:
+    """The config of one shard of a run: the same context, with only the shard's partners. See assign_shards
+
+    :param config: The config of the whole run
+    :param shard_index: The index of the shard, from 0
+    :param shard_count: The number of shards
+    :return: The shard's config
+    """
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise RuntimeError(
+            f"Shard index must be from 0 to {shard_count - 1} of {shard_count} shards, got {shard_index}"
+        )
+    partners = assign_shards(config.partners, shard_count)[shard_index]
+    shard = Config(context=config.context, partners=partners)
+    # The shared extracts are made once for every partner, so keep the whole run's year cutoff
+    shard.context.shared_year_cutoff = config.min_year_cutoff
+    shard.context.shard_index = shard_index
+    shard.context.shard_count = shard_count
+    return shard
+
+
+def shard_fragment_fname(run_version: str, shard_index: int, shard_count: int) -> str:
+    """File name of the result of a shard of a run, which biomed merge combines with the other shards'"""
+    return f"shard_{run_version}_{shard_index}of{shard_count}.json"
+
+
+class ShardResult:
+    """The result of one shard of a sharded run, written to file for biomed merge
+
+    :param run_version: The run version
+    :param workflow_hash: The workflow hash of the code that ran the shard
+    :param shard_index: The index of the shard
+    :param shard_count: The number of shards in the run
+    :param partners: The institution_ids of the shard's partners
+    :param wall_seconds: The wall time of the shard's workflow
+    :param tasks: The status, run time and any error of each task, keyed by task name
+    :param telemetry: The summary of the shard's job telemetry. See Telemetry.summary
+    :param quota: The counts of the shard's BigQuery calls, retries and throttling. See QuotaGuard.stats
+    """
+
+    def __init__(
+        self,
+        *,
+        run_version: str,
+        workflow_hash: str,
+        shard_index: int,
+        shard_count: int,
+        partners: List[str],
+        wall_seconds: float,
+        tasks: Dict[str, dict],
+        telemetry: Optional[dict] = None,
+        quota: Optional[dict] = None,
+    ):
+        self.run_version = run_version
+        self.workflow_hash = workflow_hash
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.partners = partners
+        self.wall_seconds = wall_seconds
+        self.tasks = tasks
+        self.telemetry = telemetry or {}
+        self.quota = quota or {}
+
+    @property
+    def errors(self) -> Dict[str, str]:
+        """The errors of the tasks that failed or were skipped, keyed by task name"""
+        return {name: t["error"] for name, t in self.tasks.items() if t["status"] in ("failed", "skipped")}
+
+    @staticmethod
+    def from_graph(config: Config, graph: TaskGraph) -> "ShardResult":
+        """The result of a shard's run"""
+        context = config.context
+        return ShardResult(
+            run_version=str(context.run_version),
+            workflow_hash=context.workflow_hash,
+            shard_index=context.shard_index,
+            shard_count=context.shard_count,
+            partners=[p.institution_id for p in config.partners],
+            wall_seconds=graph.wall_time,
+            tasks={name: dict(status=t.status, seconds=t.duration, error=t.error) for name, t in graph.tasks.items()},
+            telemetry=context.telemetry.summary(top=TOP) if not context.dryrun else {},
+            quota=context.quota.stats(),
+        )
+
+    @staticmethod
+    def from_dict(result: dict) -> "ShardResult":
+        """Constructs a shard result from a dictionary, as written to file. Checks that it is complete"""
+        keys = ["run_version", "workflow_hash", "shard_index", "shard_count", "partners", "wall_seconds", "tasks"]
+        missing = [k for k in keys if k not in result]
+        if missing:
+            raise RuntimeError(f"Shard result missing attribute(s): {', '.join(missing)}")
+        return ShardResult(**{k: result.get(k) for k in keys + ["telemetry", "quota"]})
+
+    def to_dict(self) -> dict:
+        return dict(
+            run_version=self.run_version,
+            workflow_hash=self.workflow_hash,
+            shard_index=self.shard_index,
+            shard_count=self.shard_count,
+            partners=self.partners,
+            wall_seconds=self.wall_seconds,
+            tasks=self.tasks,
+            telemetry=self.telemetry,
+            quota=self.quota,
+        )
+
+
+def write_shard_result(config: Config, graph: TaskGraph) -> str:
+    """Writes the result of a shard's run to the output directory
+
+    :return: The path of the file written
+    """
+    context = config.context
+    result = ShardResult.from_graph(config, graph)
+    path = os.path.join(
+        context.output_dir, shard_fragment_fname(context.run_version, context.shard_index, context.shard_count)
+    )
+    with open(path, "w") as f:
+        json.dump(result.to_dict(), f, indent=2)
+    return path
+
+
+def load_shard_results(config: Config, shard_count: int, dirs: Optional[List[str]] = None) -> List[ShardResult]:
+    """Loads the result of every shard of the run, and checks that they make up the whole run: every shard has a
+    result, the results are of this run and the same code, and every partner was run by exactly one shard. Raises a
+    RuntimeError listing every problem found.
+
+    :param config: The config of the whole run
+    :param shard_count: The number of shards in the run
+    :param dirs: The directories to look for the results in. Each shard's result is taken from the first directory
+    that has it. Defaults to the output directory
+    :return: The results, by shard index
+    """
+    context = config.context
+    dirs = dirs or [context.output_dir]
+    errors: List[str] = []
+    results = []
+    for i in range(shard_count):
+        fname = shard_fragment_fname(context.run_version, i, shard_count)
+        paths = [os.path.join(d, fname) for d in dirs if os.path.exists(os.path.join(d, fname))]
+        if not paths:
+            errors.append(f"Shard {i} of {shard_count} has no result: {fname} not found in {', '.join(dirs)}")
+            continue
+        with open(paths[0]) as f:
+            try:
+                result = ShardResult.from_dict(json.load(f))
+            except (json.JSONDecodeError, RuntimeError) as e:
+                errors.append(f"Shard {i} of {shard_count} result could not be read from {paths[0]}: {e}")
+                continue
+        if result.run_version != str(context.run_version) or result.shard_count != shard_count:
+            errors.append(
+                f"Shard {i} result is of run {result.run_version} with {result.shard_count} shards, expected run "
+                f"{context.run_version} with {shard_count} shards: {paths[0]}"
+            )
+        results.append(result)
+
+    hashes = sorted({r.workflow_hash for r in results})
+    if len(hashes) > 1:
+        errors.append(f"Shards were run with different workflow hashes: {', '.join(hashes)}")
+    counts = Counter(p for r in results for p in r.partners)
+    duplicated = sorted(p for p, n in counts.items() if n > 1)
+    if duplicated:
+        errors.append(f"Partner(s) run by more than one shard: {', '.join(duplicated)}")
+    if len(results) == shard_count:
+        missing = sorted({p.institution_id for p in config.partners} - set(counts))
+        if missing:
+            errors.append(f"Partner(s) not run by any shard: {', '.join(missing)}")
+
+    if errors:
+        msg = "\n".join(errors)
+        raise RuntimeError(f"Encountered error(s) merging the shard results: \n{msg}")
+    return results
+
+
+def merge_shard_results(config: Config, results: List[ShardResult]) -> dict:
+    """Combines the shards' results into one report of the run
+
+    :param config: The config of the whole run
+    :param results: The result of every shard. See load_shard_results
+    :return: The run report
+    """
+    statuses = Counter(t["status"] for r in results for t in r.tasks.values())
+    errors = {name: error for r in results for name, error in r.errors.items()}
+    telemetry = [r.telemetry for r in results if r.telemetry]
+    billed = defaultdict(int)
+    for t in telemetry:
+        for p in t.get("most_expensive_partners", []):
+            billed[p["institution_id"]] += p["bytes_billed"]
+    quota = defaultdict(Counter)
+    for r in results:
+        for key in ["calls", "retries", "failures", "rate_limited_seconds"]:
+            quota[key].update(r.quota.get(key, {}))
+    return dict(
+        run_version=str(config.context.run_version),
+        workflow_hash=results[0].workflow_hash if results else config.context.workflow_hash,
+        shard_count=len(results),
+        partners=sum(len(r.partners) for r in results),
+        # The shards run in parallel, so the run took as long as the slowest shard
+        wall_seconds=max((r.wall_seconds for r in results), default=0.0),
+        shards=[
+            dict(
+                shard_index=r.shard_index,
+                partners=len(r.partners),
+                wall_seconds=r.wall_seconds,
+                failed_tasks=len(r.errors),
+            )
+            for r in results
+        ],
+        tasks=dict(statuses),
+        errors=errors,
+        telemetry=dict(
+            jobs=sum(t.get("jobs", 0) for t in telemetry),
+            total_slot_hours=sum(t.get("total_slot_hours", 0) for t in telemetry),
+            total_bytes_billed=sum(t.get("total_bytes_billed", 0) for t in telemetry),
+            slowest_queries=sorted(
+                (q for t in telemetry for q in t.get("slowest_queries", [])), key=lambda q: q["seconds"], reverse=True
+            )[:TOP],
+            most_expensive_partners=[
+                dict(institution_id=id, bytes_billed=b)
+                for id, b in sorted(billed.items(), key=lambda item: item[1], reverse=True)[:TOP]
+            ],
+        ),
+        quota={k: dict(v) for k, v in quota.items()},
+    )
+
+
+def merge_shards(config: Config, shard_count: int, dirs: Optional[List[str]] = None) -> dict:
+    """Merges the results of every shard of a sharded run into one run report, prints it and writes it to the output
+    directory. Raises a RuntimeError if any shard's result is missing or inconsistent (see load_shard_results), or,
+    after writing the report, if any task failed.
+
+    :param config: The config of the whole run
+    :param shard_count: The number of shards in the run
+    :param dirs: The directories to look for the shards' results in. Defaults to the output directory
+    :return: The run report
+    """
+    results = load_shard_results(config, shard_count, dirs)
+    report = merge_shard_results(config, results)
+    print(format_run_report(report))
+    path = os.path.join(config.context.output_dir, config.context.run_report_fname)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Run report written to file: {path}")
+
+    if report["errors"]:
+        raise RuntimeError(f"The following tasks failed or were skipped: {', '.join(sorted(report['errors']))}")
+    return report
+
+
+def format_run_report(report: dict) -> str:
+    """A human-readable version of the run report"""
+    tasks = ", ".join(f"{k}: {v}" for k, v in sorted(report["tasks"].items()))
+    lines = [
+        f"Run {report['run_version']}: {report['partners']} partners over {report['shard_count']} shards, "
+        f"{report['wall_seconds']:.1f}s for the slowest shard. Tasks: {tasks}",
+    ]
+    for s in report["shards"]:
+        lines.append(
+            f"\tShard {s['shard_index']}: {s['partners']:>4} partners  {s['wall_seconds']:>8.1f}s  "
+            f"{s['failed_tasks']} failed"
+        )
+    telemetry = report["telemetry"]
+    lines.append(
+        f"Job telemetry: {telemetry['jobs']} jobs, {telemetry['total_slot_hours']:.2f} slot hours, "
+        f"{telemetry['total_bytes_billed'] / 1024**4:.3f} TB billed"
+    )
+    for name in sorted(report["errors"]):
+        lines.append(f"\tFailed: {name}")
+    return "\n".join(lines)
@@ -0,0 +1,336 @@
+from functools import partial
+from typing import Dict, List, Optional
+import json
+import os
+
+from biomedical_dashboards.biomed.config import Config, Context
+from biomedical_dashboards.biomed.gcp import bq_create_dataset, bq_set_table_description
+from biomedical_dashboards.biomed.logs import sharedprint
+from biomedical_dashboards.biomed.partner_workflow import datasets_exist, run_recorded_query, save_query
+from biomedical_dashboards.biomed.queries import (
+    ALLTRIALS_SHARED_TEMPLATE,
+    ENRICHED_DOIS_SHARED_TEMPLATE,
+    TRIAL_INDEX_SHARED_TEMPLATE,
+    query_alltrials_shared,
+    query_enriched_dois_shared,
+    query_trial_index_shared,
+    template_fingerprint,
+)
+from biomedical_dashboards.biomed.scheduler import Task
+
+# The shared queries. Each creates the table context.shared_{name}_name from the file context.shared_{name}_query_fname
+SHARED_QUERIES = ("alltrials", "enriched_dois", "trial_index")
+
+# The shared queries that read the table of another shared query, so must run after it
+SHARED_QUERY_DEPS = dict(trial_index=["alltrials"])
+
+# The template of each shared query
+SHARED_TEMPLATES = dict(
+    alltrials=ALLTRIALS_SHARED_TEMPLATE,
+    enriched_dois=ENRICHED_DOIS_SHARED_TEMPLATE,
+    trial_index=TRIAL_INDEX_SHARED_TEMPLATE,
+)
+
+
+def shared_workflow(config: Config) -> None:
+    """Workflow for the stages shared by all partners, run one stage at a time. See shared_tasks for the stages."""
+    for task in shared_tasks(config):
+        task.func()
+
+
+def shared_tasks(config: Config) -> List[Task]:
+    """Creates the tasks for the stages shared by all partners. These must finish before any partner runs queries.
+    The tasks are returned in an order they can be run in. Does the following:
+    - Generates the shared queries and writes them to file
+    - Creates the shared dataset if it doesn't exist
+    - Runs the shared alltrials extract query, unless the extract for this DOI table version and year cutoff exists.
+    With a previous_doi_version, the extract is built incrementally from that version's extract where it can be
+    - Runs the shared enriched DOIs query, unless the table for this DOI table version exists and was made from the
+    current Unpaywall table
+    - Runs the shared Trial-ID index query once the extract exists, unless the index for the extract exists
+
+    A shared table that exists is only reused if it was made by the current templates, and the enriched DOIs table
+    only if it was made from the current Unpaywall table (see shared_table_current).
+
+    The extract is the expensive scan of the Academic Observatory DOI table. It is done once at the lowest year cutoff
+    of all partners, then each partner's alltrials query filters it down to their own cutoff.
+
+    The enriched DOIs table is the Academic Observatory joined to Unpaywall, with the per-DOI fields that the pubs
+    query needs. It is clustered by DOI, so each partner's pubs query reads only the blocks holding their own DOIs.
+
+    The Trial-ID index has the Trial-IDs that each DOI of the extract mentions, one row per Trial-ID, DOI and source.
+    It is clustered by Trial-ID, so each partner's trials query reads only the blocks holding their own trials.
+
+    If context.dryrun setting is enabled, will only create and output the queries.
+
+    :param config: The workflow configuration
+    :return: The shared tasks
+    """
+    context = config.context
+    tasks = [
+        Task(
+            name="shared:generate_queries",
+            func=partial(generate_shared_queries, context),
+            verify=partial(shared_query_files_current, context),
+        )
+    ]
+    if context.dryrun:
+        return tasks
+
+    tasks.append(
+        Task(
+            name="shared:create_dataset",
+            func=partial(create_shared_dataset, context),
+            verify=partial(datasets_exist, context, [context.shared_dataset]),
+        )
+    )
+    for query_name in SHARED_QUERIES:
+        tasks.append(
+            Task(
+                name=f"shared:{query_name}",
+                func=partial(run_shared_query, context, query_name),
+                deps=[
+                    "shared:generate_queries",
+                    "shared:create_dataset",
+                    *[f"shared:{q}" for q in SHARED_QUERY_DEPS.get(query_name, [])],
+                ],
+                verify=partial(shared_table_current, context, query_name),
+            )
+        )
+    return tasks
+
+
+def prepared_shared_tasks(config: Config) -> List[Task]:
+    """Creates the tasks that stand in for the shared stages in a shard of a sharded run. The shared stages are run
+    once for the whole run by biomed prepare, before any shard starts, so each shard only checks that the shared tables
+    exist and were made by the current templates. Nothing is checked in dryrun.
+
+    :param config: The workflow configuration
+    :return: The tasks
+    """
+    if config.context.dryrun:
+        return []
+    return [Task(name="shared:prepared", func=partial(check_shared_prepared, config.context))]
+
+
+def check_shared_prepared(context: Context) -> None:
+    """Raises a RuntimeError if any of the shared tables don't exist or weren't made by the current templates and
+    inputs. See shared_table_current"""
+    errors = []
+    for query_name in SHARED_QUERIES:
+        table_name = getattr(context, f"shared_{query_name}_name")
+        table_id = f"{context.project}.{context.shared_dataset}.{table_name}"
+        if not context.metadata.table_exists(context.project, context.shared_dataset, table_name):
+            errors.append(f"Shared table missing: {table_id}")
+        elif not shared_table_current(context, query_name):
+            errors.append(f"Shared table wasn't made by the current templates and inputs: {table_id}")
+    if errors:
+        raise RuntimeError("\n".join(errors) + "\nRun biomed prepare before starting the shards")
+    sharedprint(f"Shared tables exist: {', '.join(SHARED_QUERIES)}")
+
+
+def render_shared_queries(context: Context) -> Dict[str, str]:
+    """Renders the shared queries
+
+    :return: The queries as {query_name: query}. See SHARED_QUERIES. With a previous_doi_version, there is also an
+    "alltrials_delta" query that builds the alltrials extract incrementally from the previous version's extract
+    """
+    kwargs = dict(**context.to_dict(), incremental=False, sample_percent=None)
+    queries = dict(
+        alltrials=query_alltrials_shared(**kwargs),
+        enriched_dois=query_enriched_dois_shared(**kwargs),
+        trial_index=query_trial_index_shared(**kwargs),
+    )
+    if context.previous_doi_version:
+        queries["alltrials_delta"] = query_alltrials_shared(**{**kwargs, "incremental": True})
+    return queries
+
+
+def generate_shared_queries(context: Context) -> None:
+    """Generates the shared queries and saves them to file"""
+    for query_name, query in render_shared_queries(context).items():
+        path = os.path.join(context.output_dir, getattr(context, f"shared_{query_name}_query_fname"))
+        if save_query(query, path):
+            sharedprint(f"Query written to file: {path}")
+        else:
+            sharedprint(f"Query unchanged, not rewritten: {path}")
+
+
+def shared_query_files_current(context: Context) -> bool:
+    """Whether the shared query files exist and match the queries rendered from the current config"""
+    for query_name, query in render_shared_queries(context).items():
+        path = os.path.join(context.output_dir, getattr(context, f"shared_{query_name}_query_fname"))
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            if f.read() != query:
+                return False
+    return True
+
+
+def create_shared_dataset(context: Context) -> None:
+    """Creates the shared dataset if it doesn't exist"""
+    from google.api_core.exceptions import Conflict
+
+    try:
+        bq_create_dataset(
+            project=context.project, dataset=context.shared_dataset, exists_ok=False, client=context.client
+        )
+        sharedprint(f"Created dataset: {context.project}.{context.shared_dataset}")
+    except Conflict:
+        sharedprint(f"Dataset already exists, no need to create: {context.project}.{context.shared_dataset}")
+    context.metadata.dataset_created(context.project, context.shared_dataset)
+
+
+def run_shared_query(context: Context, query_name: str) -> None:
+    """Runs a shared query, only if its table for this version doesn't already exist or wasn't made by the current
+    templates and inputs (see shared_table_current). The alltrials extract is built incrementally if it can be (see
+    previous_alltrials_lineage). The table's lineage is recorded as its description
+
+    :param context: The workflow context
+    :param query_name: The name of the query. One of SHARED_QUERIES
+    """
+    table_name = getattr(context, f"shared_{query_name}_name")
+    table_id = f"{context.project}.{context.shared_dataset}.{table_name}"
+    if context.metadata.table_exists(context.project, context.shared_dataset, table_name):
+        if shared_table_current(context, query_name):
+            sharedprint(f"Shared table already exists, reusing: {table_id}")
+            return
+        sharedprint(f"Shared table wasn't made by the current templates and inputs, rebuilding: {table_id}")
+
+    template = query_name
+    if query_name == "alltrials":
+        previous = previous_alltrials_lineage(context)
+        if previous:
+            template = "alltrials_delta"
+        lineage = alltrials_lineage(context, previous)
+    else:
+        lineage = shared_table_lineage(context, query_name)
+
+    path = os.path.join(context.output_dir, getattr(context, f"shared_{template}_query_fname"))
+    with open(path) as f:
+        query = f.read()
+    sharedprint(f"Running query: {path}")
+    run_recorded_query(
+        context=context,
+        query=query,
+        institution_id="shared",
+        template=template,
+        output_dataset=context.shared_dataset,
+        output_table_name=table_name,
+    )
+    if not context.metadata.table_exists(context.project, context.shared_dataset, table_name):
+        raise RuntimeError(f"Expected table missing after shared query: {table_id}")
+    bq_set_table_description(
+        context.project, context.shared_dataset, table_name, json.dumps(lineage), client=context.client
+    )
+    context.metadata.written(context.project, context.shared_dataset, table_name)
+    if query_name == "alltrials":
+        sharedprint(f"Extract covers DOI table versions: {', '.join(lineage['doi_versions'])}")
+
+
+def shared_fingerprint(query_name: str) -> str:
+    """The fingerprint of the templates that make a shared table: its own query's, then those of the shared tables
+    that it reads (see SHARED_QUERY_DEPS), as the table's rows depend on theirs. See template_fingerprint
+
+    :param query_name: The name of the query. One of SHARED_QUERIES
+    :return: The fingerprint
+    """
+    names = [query_name, *SHARED_QUERY_DEPS.get(query_name, [])]
+    return "+".join(template_fingerprint(SHARED_TEMPLATES[q]) for q in names)
+
+
+def shared_table_lineage(context: Context, query_name: str) -> dict:
+    """The lineage of this run's shared table, recorded as the table's description (see alltrials_lineage for the
+    extract's):
+    template: The fingerprint of the templates that made the table. See shared_fingerprint
+    workflow_hash: The version of the workflow that made the table
+    unpaywall: The version of the Unpaywall table that the enriched DOIs table was made from. See unpaywall_version
+
+    :param context: The workflow context
+    :param query_name: The name of the query. One of SHARED_QUERIES
+    :return: The lineage
+    """
+    lineage = dict(template=shared_fingerprint(query_name), workflow_hash=context.workflow_hash)
+    if query_name == "enriched_dois":
+        lineage["unpaywall"] = unpaywall_version(context)
+    return lineage
+
+
+def unpaywall_version(context: Context) -> Optional[str]:
+    """The version of the Unpaywall table: its last modified time. Unpaywall isn't sharded by version, so a new
+    snapshot replaces the table under the same name. None if the table can't be found"""
+    project, dataset, table_name = context.unpaywall_table.split(".")
+    metadata = context.metadata.table_metadata(project, dataset, table_name)
+    return metadata["last_modified"] if metadata else None
+
+
+def recorded_lineage(context: Context, table_name: str) -> Optional[dict]:
+    """The lineage recorded as a shared table's description. None if the table doesn't exist or has no lineage"""
+    table = context.metadata.get_table(context.project, context.shared_dataset, table_name)
+    if table is None:
+        return None
+    try:
+        lineage = json.loads(table.description or "")
+    except ValueError:
+        return None
+    return lineage if isinstance(lineage, dict) else None
+
+
+def shared_table_current(context: Context, query_name: str) -> bool:
+    """Whether a shared query's table exists and was made by the current templates, so can be reused. The tables are
+    named by the DOI table version (and year cutoff) only, so a table made by an older version of a template, or from
+    a shared table that was, would otherwise be reused after the template changed. Likewise, the enriched DOIs table
+    must have been made from the current Unpaywall table (see unpaywall_version)
+
+    :param context: The workflow context
+    :param query_name: The name of the query. One of SHARED_QUERIES
+    :return: Whether the table can be reused
+    """
+    lineage = recorded_lineage(context, getattr(context, f"shared_{query_name}_name"))
+    if lineage is None or lineage.get("template") != shared_fingerprint(query_name):
+        return False
+    return query_name != "enriched_dois" or lineage.get("unpaywall") == unpaywall_version(context)
+
+
+def alltrials_lineage(context: Context, previous: Optional[dict] = None) -> dict:
+    """The lineage of this run's alltrials extract, recorded as the extract's description:
+    doi_versions: The DOI table versions that the extract's rows were carried over from, oldest first, ending with
+    this run's
+    full_build: The DOI table version of the last extract that was built in full
+    template: The fingerprint of the template that made the extract. Only an extract made by the same template can be
+    built from incrementally, as the rows that are carried over must be the same as extracting them again
+    workflow_hash: The version of the workflow that made the extract
+
+    :param context: The workflow context
+    :param previous: The lineage of the previous version's extract, if this extract is built from it incrementally
+    :return: The lineage
+    """
+    doi_version = str(context.doi_version)
+    return dict(
+        doi_versions=previous["doi_versions"] + [doi_version] if previous else [doi_version],
+        full_build=previous["full_build"] if previous else doi_version,
+        template=shared_fingerprint("alltrials"),
+        workflow_hash=context.workflow_hash,
+    )
+
+
+def previous_alltrials_lineage(context: Context) -> Optional[dict]:
+    """The lineage of the previous DOI table version's alltrials extract, if this run's extract can be built from it
+    incrementally. It can if context.previous_doi_version is set and that version's extract exists, at this run's year
+    cutoff, with a lineage showing that it was made by the current template.
+
+    :return: The lineage. None if the extract must be built in full, with the reason printed
+    """
+    if not context.previous_doi_version:
+        return None
+    previous_id = f"{context.project}.{context.shared_dataset}.{context.previous_alltrials_name}"
+    if not context.metadata.table_exists(context.project, context.shared_dataset, context.previous_alltrials_name):
+        sharedprint(f"Previous extract not found, extracting in full: {previous_id}")
+        return None
+    lineage = recorded_lineage(context, context.previous_alltrials_name)
+    if lineage is None or lineage.get("template") != shared_fingerprint("alltrials"):
+        sharedprint(f"Previous extract wasn't made by the current extract query, extracting in full: {previous_id}")
+        return None
+    sharedprint(f"Extracting incrementally from the previous extract: {previous_id}")
+    return lineage
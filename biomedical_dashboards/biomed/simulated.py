@@ -0,0 +1,339 @@
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+import heapq
+import random
+import re
+import threading
+import time
+
+from google.api_core.exceptions import Conflict, InternalServerError, NotFound, ServiceUnavailable, TooManyRequests
+from google.cloud.bigquery.schema import SchemaField
+
+from biomedical_dashboards.biomed.metadata import INPUT_SCHEMAS
+
+# Statements whose target is created by a query, e.g. CREATE OR REPLACE TABLE `project.dataset.table`
+CREATE_STATEMENT = re.compile(r"CREATE\s+OR\s+REPLACE\s+(TABLE|VIEW)\s+`([^`]+)`", flags=re.IGNORECASE)
+
+# Tables that the workflow reads but never writes. With inputs_exist, these exist without being added
+INPUT_TABLE = re.compile(r"^(academic-observatory\.|[^.]+\.[^.]+_from_partners\.)")
+
+
+class SimulatedBigQuery:
+    """An in-memory stand-in for BigQuery, for measuring the workflow's orchestration without running (or paying for)
+    any real jobs. Hands out clients that implement the parts of the bigquery Client that the workflow uses.
+
+    Jobs take job_latency seconds (give or take job_jitter) of real time once started. At most max_concurrent_jobs run
+    at once, and later jobs queue behind them, as with BigQuery's concurrent query limit. Submitting a job while
+    max_queued_jobs are already waiting fails with TooManyRequests, like an exceeded quota. API calls and jobs fail at
+    random with transient_error_rate, with the errors that BigQuery returns for transient problems.
+
+    Tables created by a query (CREATE OR REPLACE TABLE/VIEW) or a copy job appear when the job finishes. Every API
+    call is counted by method.
+
+    :param job_latency: The mean number of seconds that a job runs for
+    :param job_jitter: The most that a job's run time varies from the mean, in seconds
+    :param api_latency: The number of seconds that every API call takes
+    :param max_concurrent_jobs: The number of jobs that can run at once
+    :param max_queued_jobs: The number of jobs that can wait to run before new jobs are refused
+    :param transient_error_rate: The probability of each API call or job failing with a transient error
+    :param inputs_exist: Whether the partner input tables and Academic Observatory tables exist without being added
+    :param seed: The seed for the random latencies and errors, so that runs can be repeated
+    """
+
+    def __init__(
+        self,
+        *,
+        job_latency: float = 0.05,
+        job_jitter: float = 0.0,
+        api_latency: float = 0.0,
+        max_concurrent_jobs: int = 100,
+        max_queued_jobs: int = 1000,
+        transient_error_rate: float = 0.0,
+        inputs_exist: bool = True,
+        seed: int = 0,
+    ):
+        self.job_latency = job_latency
+        self.job_jitter = job_jitter
+        self.api_latency = api_latency
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.max_queued_jobs = max_queued_jobs
+        self.transient_error_rate = transient_error_rate
+        self.inputs_exist = inputs_exist
+        self.tables: Dict[str, SimulatedTable] = {}
+        self.datasets = set()
+        self.api_calls = Counter()
+        self.jobs_submitted = 0
+        self._slots: List[float] = []  # The times at which each running or queued job finishes
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def client(self, project: str, pool_size: int = 10) -> "SimulatedClient":
+        """Creates a client for the project. Has the signature of a BQClientPool client factory"""
+        return SimulatedClient(self, project)
+
+    def add_table(
+        self, table_id: str, num_rows: int = 1000, table_type: str = "TABLE", schema: Optional[list] = None
+    ) -> None:
+        """Adds a table, e.g. an input table, as if it had been created before the workflow ran"""
+        with self._lock:
+            self.tables[table_id] = SimulatedTable(table_id, num_rows=num_rows, table_type=table_type, schema=schema)
+            self.datasets.add(table_id.rsplit(".", 1)[0])
+
+    def add_inputs(self, project: str, partners: list, shared_inputs: Iterable[str] = ()) -> None:
+        """Adds the input tables of the partners that don't exist yet, with the columns that the workflow expects (see
+        metadata.INPUT_SCHEMAS), as if the partners had uploaded them. Does nothing unless inputs_exist
+
+        :param project: The project of the partners' datasets
+        :param partners: The partners
+        :param shared_inputs: The full ids of other input tables to add if they don't exist yet, e.g. the Unpaywall
+        table, whose metadata the workflow reads
+        """
+        if not self.inputs_exist:
+            return
+        for table_id in shared_inputs:
+            if table_id not in self.tables:
+                self.add_table(table_id)
+        for partner in partners:
+            for attr, columns in INPUT_SCHEMAS.items():
+                table_id = f"{project}.{partner.static_dataset}.{getattr(partner, attr)}"
+                if table_id not in self.tables:
+                    schema = [SchemaField(name, types[0]) for name, types in columns.items()]
+                    self.add_table(table_id, schema=schema)
+
+    def call(self, method: str) -> None:
+        """Counts an API call, waits for its latency and raises a transient error if one is due"""
+        with self._lock:
+            self.api_calls[method] += 1
+            failed = self._random.random() < self.transient_error_rate
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if failed:
+            raise ServiceUnavailable(f"Simulated transient error in {method}")
+
+    def list_tables(self, dataset_id: str) -> List["SimulatedTableListItem"]:
+        """The tables in a dataset. Input tables that only exist by inputs_exist aren't listed until they are read"""
+        with self._lock:
+            if dataset_id not in self.datasets and not (self.inputs_exist and INPUT_TABLE.match(f"{dataset_id}.")):
+                raise NotFound(f"Not found: Dataset {dataset_id}")
+            return [
+                SimulatedTableListItem(table_id, table.table_type)
+                for table_id, table in self.tables.items()
+                if table_id.rsplit(".", 1)[0] == dataset_id
+            ]
+
+    def get_table(self, table_id: str) -> "SimulatedTable":
+        with self._lock:
+            table = self.tables.get(table_id)
+            if table is None and self.inputs_exist and INPUT_TABLE.match(table_id):
+                table = self.tables[table_id] = SimulatedTable(table_id)
+        if table is None:
+            raise NotFound(f"Not found: Table {table_id}")
+        return table
+
+    def submit(self, *, project: str, kind: str, creates: Dict[str, str], bytes_processed: int) -> "SimulatedJob":
+        """Submits a job that creates the given tables ({table_id: table_type}) when it finishes. The job starts as
+        soon as one of the max_concurrent_jobs slots is free."""
+        with self._lock:
+            now = time.monotonic()
+            # Slots that have finished are free again
+            while self._slots and self._slots[0] <= now:
+                heapq.heappop(self._slots)
+            queued = max(0, len(self._slots) - self.max_concurrent_jobs)
+            if queued >= self.max_queued_jobs:
+                raise TooManyRequests("Simulated quota exceeded: too many queued jobs")
+            # The job starts when the earliest running job that it is queued behind finishes
+            ahead = len(self._slots) - self.max_concurrent_jobs + 1
+            start = now if ahead <= 0 else heapq.nsmallest(ahead, self._slots)[-1]
+            latency = max(0.0, self.job_latency + self._random.uniform(-self.job_jitter, self.job_jitter))
+            end = start + latency
+            heapq.heappush(self._slots, end)
+            failed = self._random.random() < self.transient_error_rate
+            self.jobs_submitted += 1
+            job_id = f"simulated_{kind}_{self.jobs_submitted}"
+        return SimulatedJob(
+            self,
+            job_id=job_id,
+            project=project,
+            submitted=now,
+            start=start,
+            end=end,
+            creates=creates,
+            bytes_processed=bytes_processed,
+            failed=failed,
+        )
+
+    def finish(self, job: "SimulatedJob") -> None:
+        """Creates the tables that a finished job creates"""
+        with self._lock:
+            for table_id, table_type in job.creates.items():
+                self.tables[table_id] = SimulatedTable(table_id, table_type=table_type)
+
+
+class SimulatedTable:
+    """The metadata of a table in the simulated backend. Has the attributes of a bigquery Table that the workflow uses"""
+
+    def __init__(self, table_id: str, num_rows: int = 1000, table_type: str = "TABLE", schema: Optional[list] = None):
+        self.table_id = table_id
+        self.num_rows = num_rows
+        self.table_type = table_type
+        self.schema = schema or []
+        self.description = None
+        self.modified = datetime.now(timezone.utc)
+        self.view_query = "SELECT 1" if table_type == "VIEW" else None
+        self.time_partitioning = None
+        self.range_partitioning = None
+        self.clustering_fields = None
+
+
+class SimulatedTableListItem:
+    """A table in the listing of a dataset. Has the attributes of a bigquery TableListItem that the workflow uses"""
+
+    def __init__(self, table_id: str, table_type: str = "TABLE"):
+        self.full_table_id = table_id
+        self.table_id = table_id.rsplit(".", 1)[1]
+        self.table_type = table_type
+
+
+class SimulatedJob:
+    """A job in the simulated backend. Has the methods and statistics of a bigquery job that the workflow uses"""
+
+    def __init__(
+        self,
+        backend: SimulatedBigQuery,
+        *,
+        job_id: str,
+        project: str,
+        submitted: float,
+        start: float,
+        end: float,
+        creates: Dict[str, str],
+        bytes_processed: int,
+        failed: bool = False,
+    ):
+        self.backend = backend
+        self.job_id = job_id
+        self.project = project
+        self.creates = creates
+        self.failed = failed
+        self._start = start
+        self._end = end
+        self._finished = False
+        self._lock = threading.Lock()
+        # Job statistics, as datetimes on the wall clock
+        offset = datetime.now(timezone.utc) - timedelta(seconds=time.monotonic())
+        self.created = offset + timedelta(seconds=submitted)
+        self.started = offset + timedelta(seconds=start)
+        self.ended = offset + timedelta(seconds=end)
+        self.slot_millis = int((end - start) * 1000)
+        self.total_bytes_processed = bytes_processed
+        self.total_bytes_billed = bytes_processed
+        self.cache_hit = False
+        self.error_result = None  # Set once a failed job has been seen to finish, as a reload of the job would
+
+    def done(self) -> bool:
+        """Whether the job has finished. Counted as an API call, as it is a job reload in BigQuery"""
+        self.backend.call("jobs.get")
+        if time.monotonic() < self._end:
+            return False
+        self._finish()
+        return True
+
+    def _finish(self) -> None:
+        if self.failed:
+            self.error_result = dict(reason="backendError", message=f"Simulated transient job failure: {self.job_id}")
+        with self._lock:
+            if self._finished or self.failed:
+                return
+            self._finished = True
+        self.backend.finish(self)
+
+    def result(self) -> list:
+        """Waits for the job to finish. Raises if the job failed"""
+        self.backend.call("jobs.getQueryResults")
+        remaining = self._end - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self._finish()
+        if self.failed:
+            raise InternalServerError(self.error_result["message"])
+        return []
+
+
+class SimulatedClient:
+    """A client of the simulated backend, for one project. Implements the methods of the bigquery Client that the
+    workflow uses. See SimulatedBigQuery"""
+
+    def __init__(self, backend: SimulatedBigQuery, project: str):
+        self.backend = backend
+        self.project = project
+
+    def get_table(self, table_id) -> SimulatedTable:
+        self.backend.call("tables.get")
+        return self.backend.get_table(str(table_id))
+
+    def list_tables(self, dataset, page_size: Optional[int] = None) -> List[SimulatedTableListItem]:
+        self.backend.call("tables.list")
+        return self.backend.list_tables(str(dataset))
+
+    def get_dataset(self, dataset_id) -> str:
+        self.backend.call("datasets.get")
+        dataset_id = str(dataset_id)
+        if dataset_id not in self.backend.datasets:
+            raise NotFound(f"Not found: Dataset {dataset_id}")
+        return dataset_id
+
+    def create_dataset(self, dataset, exists_ok: bool = False) -> None:
+        self.backend.call("datasets.insert")
+        dataset_id = getattr(dataset, "dataset_id", dataset)
+        dataset_id = dataset_id if "." in str(dataset_id) else f"{self.project}.{dataset_id}"
+        with self.backend._lock:
+            if dataset_id in self.backend.datasets and not exists_ok:
+                raise Conflict(f"Already Exists: Dataset {dataset_id}")
+            self.backend.datasets.add(dataset_id)
+
+    def create_table(self, table, exists_ok: bool = False) -> None:
+        self.backend.call("tables.insert")
+        table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        self.backend.add_table(table_id, table_type="VIEW" if table.view_query else "TABLE")
+
+    def update_table(self, table, fields: List[str]) -> SimulatedTable:
+        self.backend.call("tables.patch")
+        stored = self.backend.get_table(f"{table.project}.{table.dataset_id}.{table.table_id}")
+        for field in fields:
+            setattr(stored, field, getattr(table, field))
+        return stored
+
+    def delete_table(self, table, not_found_ok: bool = False) -> None:
+        self.backend.call("tables.delete")
+        table_id = getattr(table, "table_id", str(table))
+        with self.backend._lock:
+            if self.backend.tables.pop(table_id, None) is None and not not_found_ok:
+                raise NotFound(f"Not found: Table {table_id}")
+
+    def query(self, query: str, job_config=None) -> SimulatedJob:
+        self.backend.call("jobs.insert")
+        bytes_processed = len(query) * 10**6  # Stand in for the size of the data read
+        if job_config is not None and job_config.dry_run:
+            return SimulatedJob(
+                self.backend,
+                job_id="simulated_dry_run",
+                project=self.project,
+                submitted=time.monotonic(),
+                start=time.monotonic(),
+                end=time.monotonic(),
+                creates={},
+                bytes_processed=bytes_processed,
+            )
+        creates = {m.group(2): m.group(1).upper() for m in CREATE_STATEMENT.finditer(query)}
+        return self.backend.submit(project=self.project, kind="query", creates=creates, bytes_processed=bytes_processed)
+
+    def copy_table(self, sources, destination, job_config=None) -> SimulatedJob:
+        self.backend.call("jobs.insert")
+        self.backend.get_table(str(sources))
+        return self.backend.submit(
+            project=self.project, kind="copy", creates={str(destination): "TABLE"}, bytes_processed=0
+        )
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,172 @@
+from typing import List, Optional, Tuple
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+# The number of partners in the config that the startup is timed with
+STARTUP_PARTNERS = 100
+
+# The most seconds that a dryrun of the startup config may take, from starting the process to exiting
+STARTUP_BUDGET = 3.0
+
+# Modules that are slow to import and aren't needed to render the queries, so a dryrun must not import them
+SLOW_MODULES = ("google.cloud.bigquery", "google.api_core", "git")
+
+
+class StartupResult:
+    """The time taken by a dryrun of a synthetic config, in a fresh process, as a user runs the CLI
+
+    :param partners: The number of partners in the config
+    :param wall_seconds: The fastest of the timed runs, from starting the process to exiting
+    :param import_seconds: The time spent importing modules, from a run with -X importtime
+    :param slow_modules: The modules in SLOW_MODULES that the run imported
+    :param budget: The most seconds that a run may take
+    """
+
+    def __init__(
+        self,
+        *,
+        partners: int,
+        wall_seconds: float,
+        import_seconds: float,
+        slow_modules: List[str],
+        budget: float,
+    ):
+        self.partners = partners
+        self.wall_seconds = wall_seconds
+        self.import_seconds = import_seconds
+        self.slow_modules = slow_modules
+        self.budget = budget
+
+    @property
+    def passed(self) -> bool:
+        """Whether the run was within budget and imported none of the slow modules"""
+        return self.wall_seconds <= self.budget and not self.slow_modules
+
+    def to_dict(self) -> dict:
+        return dict(
+            partners=self.partners,
+            wall_seconds=self.wall_seconds,
+            import_seconds=self.import_seconds,
+            slow_modules=self.slow_modules,
+            budget=self.budget,
+            passed=self.passed,
+        )
+
+
+def startup_config(num_partners: int, output_dir: str) -> dict:
+    """The config of a dryrun with any number of made-up partners
+
+    :param num_partners: The number of partners
+    :param output_dir: The output directory of the run
+    :return: The config, as it would be loaded from yaml
+    """
+    context = dict(
+        dryrun=True,
+        project="startup-project",
+        output_dir=output_dir,
+        run_version="20250101",
+        doi_version="20241201",
+    )
+    partners = [
+        dict(
+            institution_id=f"partner{i:04d}",
+            dois_table_name="dois_20250101",
+            trials_aact_table_name="trials_aact_20250101",
+            oddpub_table_name="oddpub_20250101",
+            year_cutoff=2000 + i % 20,
+        )
+        for i in range(num_partners)
+    ]
+    return dict(context=context, partners=partners)
+
+
+def run_cli(config_path: str, importtime: bool = False) -> Tuple[float, str]:
+    """Runs the workflow for a config in a new python process
+
+    :param config_path: The config file
+    :param importtime: Whether to have python report the import time of every module, to stderr
+    :return: The wall time of the process, and its stderr
+    """
+    cmd = [sys.executable, *(["-X", "importtime"] if importtime else []), "-m", "biomedical_dashboards.biomed.main"]
+    start = time.monotonic()
+    proc = subprocess.run([*cmd, "run", config_path], capture_output=True, text=True)
+    wall_seconds = time.monotonic() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"The dryrun failed with exit code {proc.returncode}:\n{proc.stderr}")
+    return wall_seconds, proc.stderr
+
+
+def parse_importtime(stderr: str) -> Tuple[float, List[str]]:
+    """Parses the output of -X importtime
+
+    :param stderr: The output
+    :return: The total seconds spent importing, and the names of every module imported
+    """
+    total_us = 0
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "| imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.append(name.strip())
+        # Top level imports are not indented. Their cumulative time includes the modules they import
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+    return total_us / 1e6, modules
+
+
+def benchmark_startup(
+    num_partners: int = STARTUP_PARTNERS,
+    *,
+    budget: float = STARTUP_BUDGET,
+    repeats: int = 3,
+    output: Optional[str] = None,
+) -> StartupResult:
+    """Times a dryrun of a synthetic config in a fresh process, prints the result and optionally writes it to a JSON
+    file. The fastest of several runs is taken, as the slower runs are slowed by the machine rather than the workflow.
+
+    :param num_partners: The number of partners in the config
+    :param budget: The most seconds that a run may take
+    :param repeats: The number of timed runs
+    :param output: The file to write the result to. Optional
+    :return: The result
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump(startup_config(num_partners, os.path.join(tmp, "out")), f)
+
+        # The first run also warms the filesystem and bytecode caches, as a user's repeated runs would be
+        import_seconds, modules = parse_importtime(run_cli(config_path, importtime=True)[1])
+        wall_seconds = min(run_cli(config_path)[0] for _ in range(repeats))
+
+    slow_modules = [m for m in SLOW_MODULES if m in modules]
+    result = StartupResult(
+        partners=num_partners,
+        wall_seconds=wall_seconds,
+        import_seconds=import_seconds,
+        slow_modules=slow_modules,
+        budget=budget,
+    )
+    print(format_startup_result(result))
+    if output:
+        with open(output, "w") as f:
+            json.dump(result.to_dict(), f, indent=2)
+    return result
+
+
+def format_startup_result(result: StartupResult) -> str:
+    """Formats the result for printing"""
+    lines = [
+        f"Dryrun of {result.partners} partners: {result.wall_seconds:.2f}s (budget {result.budget:.2f}s), "
+        f"of which imports: {result.import_seconds:.2f}s",
+        f"\tSlow modules imported: {', '.join(result.slow_modules) or 'none'}",
+        f"\tResult: {'passed' if result.passed else 'FAILED'}",
+    ]
+    return "\n".join(lines)
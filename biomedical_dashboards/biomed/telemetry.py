@@ -0,0 +1,188 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import List, Optional
+import inspect
+import json
+import os
+import threading
+
+
+class JobRecord:
+    """The timings and costs of a single finished BigQuery job
+
+    :param job_id: The BigQuery job id
+    :param institution_id: The partner that the job was run for, or "shared" for the shared queries
+    :param template: The name of the query template, e.g. "pubs"
+    :param run_version: The run version of the workflow
+    :param workflow_hash: The workflow hash of the workflow
+    :param queue_seconds: Time between the job being created and starting
+    :param execution_seconds: Time between the job starting and ending
+    :param slot_ms: The slot milliseconds used by the job
+    :param bytes_processed: The bytes processed by the job
+    :param bytes_billed: The bytes billed for the job
+    :param cache_hit: Whether the results came from the query cache
+    :param output_rows: The number of rows in the job's output table
+    """
+
+    def __init__(
+        self,
+        *,
+        job_id: str,
+        institution_id: str,
+        template: str,
+        run_version: str,
+        workflow_hash: str,
+        queue_seconds: Optional[float],
+        execution_seconds: Optional[float],
+        slot_ms: Optional[int],
+        bytes_processed: Optional[int],
+        bytes_billed: Optional[int],
+        cache_hit: Optional[bool],
+        output_rows: Optional[int],
+    ):
+        self.job_id = job_id
+        self.institution_id = institution_id
+        self.template = template
+        self.run_version = run_version
+        self.workflow_hash = workflow_hash
+        self.queue_seconds = queue_seconds
+        self.execution_seconds = execution_seconds
+        self.slot_ms = slot_ms
+        self.bytes_processed = bytes_processed
+        self.bytes_billed = bytes_billed
+        self.cache_hit = cache_hit
+        self.output_rows = output_rows
+
+    @staticmethod
+    def from_job(job, *, institution_id: str, template: str, run_version: str, workflow_hash: str, output_rows=None):
+        """Creates a record from a finished bigquery QueryJob"""
+
+        def _seconds(start: Optional[datetime], end: Optional[datetime]) -> Optional[float]:
+            return (end - start).total_seconds() if start and end else None
+
+        return JobRecord(
+            job_id=job.job_id,
+            institution_id=institution_id,
+            template=template,
+            run_version=str(run_version),
+            workflow_hash=workflow_hash,
+            queue_seconds=_seconds(job.created, job.started),
+            execution_seconds=_seconds(job.started, job.ended),
+            slot_ms=job.slot_millis,
+            bytes_processed=job.total_bytes_processed,
+            bytes_billed=job.total_bytes_billed,
+            cache_hit=job.cache_hit,
+            output_rows=output_rows,
+        )
+
+    @staticmethod
+    def from_dict(record: dict):
+        """Creates a record from its to_dict form, e.g. a line of the telemetry file. Other keys are ignored"""
+        return JobRecord(**{k: record.get(k) for k in inspect.signature(JobRecord).parameters})
+
+    def to_dict(self) -> dict:
+        return dict(
+            job_id=self.job_id,
+            institution_id=self.institution_id,
+            template=self.template,
+            run_version=self.run_version,
+            workflow_hash=self.workflow_hash,
+            queue_seconds=self.queue_seconds,
+            execution_seconds=self.execution_seconds,
+            slot_ms=self.slot_ms,
+            bytes_processed=self.bytes_processed,
+            bytes_billed=self.bytes_billed,
+            cache_hit=self.cache_hit,
+            output_rows=self.output_rows,
+        )
+
+
+def read_records(path: str, run_version: Optional[str] = None) -> List[JobRecord]:
+    """Reads the records of a telemetry file, oldest first
+
+    :param path: The JSONL file written by Telemetry
+    :param run_version: If supplied, only the records of this run version are read
+    :return: The records. Empty if the file doesn't exist
+    """
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = JobRecord.from_dict(json.loads(line))
+                if run_version is None or record.run_version == str(run_version):
+                    records.append(record)
+    return records
+
+
+class Telemetry:
+    """Collects a JobRecord for each query job in the run. Each record is appended to a JSONL file as soon as it is
+    made, so the file builds up a history of every run that can be compared across run versions.
+
+    :param path: The JSONL file to append records to
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: List[JobRecord] = []
+        self._lock = threading.Lock()
+
+    def record(self, record: JobRecord) -> None:
+        """Adds a record and appends it to the JSONL file"""
+        line = dict(recorded=datetime.now(timezone.utc).isoformat(), **record.to_dict())
+        with self._lock:
+            self.records.append(record)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(line) + "\n")
+
+    def new_run(self) -> None:
+        """Starts the summary of a new run, e.g. for each run of a long-running process. The file is kept"""
+        with self._lock:
+            self.records = []
+
+    def summary(self, top: int = 5) -> dict:
+        """Summarises the jobs of this run: the slowest queries, the partners that were billed the most and the total
+        slot hours used
+
+        :param top: The number of queries/partners to include in each list
+        """
+        with self._lock:
+            records = list(self.records)
+        slowest = sorted(records, key=lambda r: (r.queue_seconds or 0) + (r.execution_seconds or 0), reverse=True)
+        billed = defaultdict(int)
+        for r in records:
+            billed[r.institution_id] += r.bytes_billed or 0
+        return dict(
+            jobs=len(records),
+            total_slot_hours=sum(r.slot_ms or 0 for r in records) / 3_600_000,
+            total_bytes_billed=sum(billed.values()),
+            slowest_queries=[
+                dict(
+                    institution_id=r.institution_id,
+                    template=r.template,
+                    job_id=r.job_id,
+                    seconds=(r.queue_seconds or 0) + (r.execution_seconds or 0),
+                )
+                for r in slowest[:top]
+            ],
+            most_expensive_partners=[
+                dict(institution_id=id, bytes_billed=b)
+                for id, b in sorted(billed.items(), key=lambda item: item[1], reverse=True)[:top]
+            ],
+        )
+
+    def summary_report(self, top: int = 5) -> str:
+        """A human-readable version of the summary"""
+        summary = self.summary(top=top)
+        lines = [
+            f"Job telemetry: {summary['jobs']} jobs, {summary['total_slot_hours']:.2f} slot hours, "
+            f"{summary['total_bytes_billed'] / 1024**4:.3f} TB billed",
+            "Slowest queries:",
+        ]
+        for q in summary["slowest_queries"]:
+            lines.append(f"\t{q['seconds']:>8.1f}s  {q['institution_id']}.{q['template']} ({q['job_id']})")
+        lines.append("Most expensive partners:")
+        for p in summary["most_expensive_partners"]:
+            lines.append(f"\t{p['bytes_billed'] / 1024**4:>8.3f} TB  {p['institution_id']}")
+        return "\n".join(lines)
@@ -0,0 +1,363 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import json
+import os
+
+from biomedical_dashboards.biomed.config import Config, Context, Partner
+from biomedical_dashboards.biomed.gcp import bq_delete_table, bq_estimate_query_bytes, bq_run_query, bq_run_query_job
+from biomedical_dashboards.biomed.logs import bioprint, sharedprint
+from biomedical_dashboards.biomed.queries import (
+    COHORT_QUERIES,
+    partner_query_kwargs,
+    query_alltrials_shared,
+    query_enriched_dois_shared,
+    query_pubs,
+    query_pubs_legacy,
+    query_trials,
+)
+from biomedical_dashboards.biomed.preflight import format_bytes
+from biomedical_dashboards.biomed.shared_workflow import render_shared_queries
+
+# The number of differing rows from each table to include in a comparison, to help find the cause
+SAMPLE_ROWS = 5
+
+# The default percentage of DOIs that an incremental alltrials extract is checked against a full extraction for
+ALLTRIALS_SAMPLE_PERCENT = 1
+
+
+class TableComparison:
+    """The result of comparing two tables as multisets of rows. Rows are compared by their JSON representation, so two
+    tables are equal if they have the same columns in the same order and every distinct row appears the same number of
+    times in each. Row order is ignored.
+
+    :param name: A name for the comparison, e.g. the partner whose tables were compared
+    :param table_a: The full id of the first table, e.g. the output of the legacy query
+    :param table_b: The full id of the second table
+    :param rows_a: The number of rows in table_a
+    :param rows_b: The number of rows in table_b
+    :param only_a: The number of rows in table_a that aren't matched by a row in table_b
+    :param only_b: The number of rows in table_b that aren't matched by a row in table_a
+    :param sample_a: Some of the rows that are only in table_a, as JSON strings
+    :param sample_b: Some of the rows that are only in table_b, as JSON strings
+    """
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        table_a: str,
+        table_b: str,
+        rows_a: int,
+        rows_b: int,
+        only_a: int,
+        only_b: int,
+        sample_a: Optional[List[str]] = None,
+        sample_b: Optional[List[str]] = None,
+    ):
+        self.name = name
+        self.table_a = table_a
+        self.table_b = table_b
+        self.rows_a = rows_a
+        self.rows_b = rows_b
+        self.only_a = only_a
+        self.only_b = only_b
+        self.sample_a = sample_a or []
+        self.sample_b = sample_b or []
+
+    @property
+    def equal(self) -> bool:
+        """Whether the tables have exactly the same rows"""
+        return self.only_a == 0 and self.only_b == 0
+
+    def to_dict(self) -> dict:
+        return dict(
+            name=self.name,
+            table_a=self.table_a,
+            table_b=self.table_b,
+            rows_a=self.rows_a,
+            rows_b=self.rows_b,
+            only_a=self.only_a,
+            only_b=self.only_b,
+            equal=self.equal,
+            sample_a=self.sample_a,
+            sample_b=self.sample_b,
+        )
+
+
+def compare_tables(name: str, context: Context, table_a: str, table_b: str) -> TableComparison:
+    """Compares two tables as multisets of rows, in a single query. See TableComparison
+
+    :param name: A name for the comparison
+    :param context: The workflow context
+    :param table_a: The full id of the first table
+    :param table_b: The full id of the second table
+    :return: The comparison
+    """
+    query = f"""
+WITH
+a AS (SELECT TO_JSON_STRING(t) AS row, COUNT(*) AS n FROM `{table_a}` AS t GROUP BY row),
+b AS (SELECT TO_JSON_STRING(t) AS row, COUNT(*) AS n FROM `{table_b}` AS t GROUP BY row),
+diff AS (
+  SELECT row, IFNULL(a.n, 0) - IFNULL(b.n, 0) AS n
+  FROM a FULL OUTER JOIN b USING (row)
+  WHERE IFNULL(a.n, 0) != IFNULL(b.n, 0)
+)
+SELECT
+  (SELECT IFNULL(SUM(n), 0) FROM a) AS rows_a,
+  (SELECT IFNULL(SUM(n), 0) FROM b) AS rows_b,
+  (SELECT IFNULL(SUM(n), 0) FROM diff WHERE n > 0) AS only_a,
+  (SELECT IFNULL(-SUM(n), 0) FROM diff WHERE n < 0) AS only_b,
+  ARRAY(SELECT row FROM diff WHERE n > 0 ORDER BY row LIMIT {SAMPLE_ROWS}) AS sample_a,
+  ARRAY(SELECT row FROM diff WHERE n < 0 ORDER BY row LIMIT {SAMPLE_ROWS}) AS sample_b
+"""
+    rows = list(
+        bq_run_query(context.project, query, maximum_bytes_billed=context.max_bytes_per_query, client=context.client)
+    )
+    if not rows:
+        # e.g. with backend: simulated, whose queries return no rows
+        raise RuntimeError(f"The comparison of {table_a} and {table_b} returned no rows")
+    result = rows[0]
+    return TableComparison(
+        name=name,
+        table_a=table_a,
+        table_b=table_b,
+        rows_a=result["rows_a"],
+        rows_b=result["rows_b"],
+        only_a=result["only_a"],
+        only_b=result["only_b"],
+        sample_a=list(result["sample_a"]),
+        sample_b=list(result["sample_b"]),
+    )
+
+
+def verify_pubs(config: Config, fixture_dataset: Optional[str] = None, keep: bool = False) -> List[TableComparison]:
+    """Runs the legacy and the current pubs query for every partner, and compares their outputs row for row. Prints
+    the comparisons and writes them to file.
+
+    The outputs are written to scratch tables in each partner's output dataset, which are deleted afterwards unless
+    keep is set. The current run's tables are not touched.
+
+    :param config: The workflow configuration
+    :param fixture_dataset: A dataset in the project with small fixture tables to read instead of the Academic
+    Observatory: doi, unpaywall and alltrials, with the schemas of the DOI table, the Unpaywall table and a partner's
+    alltrials view. The enriched DOIs table that the current query reads is made from them, as enriched_dois. If not
+    supplied, the real tables are read, and the shared enriched DOIs table and each partner's alltrials view for this
+    run must exist
+    :param keep: Whether to keep the scratch tables, e.g. to investigate a difference
+    :return: The comparisons, one per partner
+    """
+    context = config.context
+    if fixture_dataset:
+        query = query_enriched_dois_shared(
+            **{
+                **context.to_dict(),
+                "shared_dataset": fixture_dataset,
+                "shared_enriched_dois_name": "enriched_dois",
+                "doi_table": f"{context.project}.{fixture_dataset}.doi",
+                "unpaywall_table": f"{context.project}.{fixture_dataset}.unpaywall",
+            }
+        )
+        sharedprint(f"Making the enriched DOIs fixture: {context.project}.{fixture_dataset}.enriched_dois")
+        bq_run_query_job(
+            context.project, query, maximum_bytes_billed=context.max_bytes_per_query, client=context.client
+        )
+    with ThreadPoolExecutor(max_workers=context.max_concurrent_jobs) as executor:
+        results = list(executor.map(lambda p: verify_partner_pubs(p, context, fixture_dataset, keep), config.partners))
+
+    print(format_comparisons(results))
+    path = os.path.join(context.output_dir, f"verify_pubs_{context.run_version}.json")
+    with open(path, "w") as f:
+        json.dump([r.to_dict() for r in results], f, indent=2)
+    return results
+
+
+def verify_partner_pubs(
+    partner: Partner, context: Context, fixture_dataset: Optional[str] = None, keep: bool = False
+) -> TableComparison:
+    """Runs the legacy and the current pubs query for a partner and compares their outputs. See verify_pubs"""
+    kwargs = partner_query_kwargs(partner=partner, context=context)
+    if fixture_dataset:
+        kwargs.update(
+            doi_table=f"{context.project}.{fixture_dataset}.doi",
+            unpaywall_table=f"{context.project}.{fixture_dataset}.unpaywall",
+            alltrials_table=f"{context.project}.{fixture_dataset}.alltrials",
+            enriched_dois_table=f"{context.project}.{fixture_dataset}.enriched_dois",
+        )
+    # The output table of each query is pubs{run_version}, so the run version gives them their own scratch names
+    versions = dict(legacy=f"{context.run_version}_verify_legacy", current=f"{context.run_version}_verify")
+    tables = {k: f"{context.project}.{partner.output_dataset}.pubs{v}" for k, v in versions.items()}
+    bioprint(partner, f"Running the legacy and current pubs queries into {', '.join(tables.values())}")
+    for name, render in [("legacy", query_pubs_legacy), ("current", query_pubs)]:
+        query = render(**{**kwargs, "run_version": versions[name]})
+        bq_run_query_job(
+            context.project, query, maximum_bytes_billed=context.max_bytes_per_query, client=context.client
+        )
+
+    try:
+        return compare_tables(partner.institution_id, context, tables["legacy"], tables["current"])
+    finally:
+        if not keep:
+            for version in versions.values():
+                bq_delete_table(context.project, partner.output_dataset, f"pubs{version}", client=context.client)
+
+
+def verify_alltrials_delta(
+    config: Config, sample_percent: int = ALLTRIALS_SAMPLE_PERCENT, keep: bool = False
+) -> TableComparison:
+    """Checks that this run's shared alltrials extract, built incrementally from the previous DOI table version's
+    extract, has the same rows as extracting the DOI table in full, for a sample of the DOIs. Prints the comparison and
+    writes it to file, along with the bytes that building the extract in full and incrementally would process. See
+    alltrials_build_bytes
+
+    The sample is chosen by a hash of the lower-cased DOI, so each DOI is in the sample for both tables or neither,
+    along with every row that its extracted row is made from. The full extraction of the sample and the extract's rows
+    for the sample are written to scratch tables in the shared dataset, which are deleted afterwards unless keep is set.
+
+    :param config: The workflow configuration
+    :param sample_percent: The percentage of DOIs to compare, from 1 to 100
+    :param keep: Whether to keep the scratch tables, e.g. to investigate a difference
+    :return: The comparison
+    """
+    context = config.context
+    if not isinstance(sample_percent, int) or not 1 <= sample_percent <= 100:
+        raise RuntimeError(f"The sample percentage must be an integer from 1 to 100, got {sample_percent}")
+    table_name = context.shared_alltrials_name
+    table_id = f"{context.project}.{context.shared_dataset}.{table_name}"
+    table = context.metadata.get_table(context.project, context.shared_dataset, table_name)
+    if table is None:
+        raise RuntimeError(f"Shared alltrials extract missing: {table_id}. Run the workflow first")
+    if table.description:
+        sharedprint(f"Extract lineage: {table.description}")
+
+    names = dict(incremental=f"{table_name}_verify_sample", full=f"{table_name}_verify_full")
+    tables = {k: f"{context.project}.{context.shared_dataset}.{v}" for k, v in names.items()}
+    queries = dict(
+        incremental=f"""CREATE OR REPLACE TABLE `{tables["incremental"]}` AS
+SELECT * FROM `{table_id}`
+WHERE ABS(MOD(FARM_FINGERPRINT(LOWER(doi)), 100)) < {sample_percent}""",
+        full=query_alltrials_shared(
+            **{
+                **context.to_dict(),
+                "shared_alltrials_name": names["full"],
+                "incremental": False,
+                "sample_percent": sample_percent,
+            }
+        ),
+    )
+    sharedprint(f"Extracting {sample_percent}% of DOIs in full and from the extract into {', '.join(tables.values())}")
+    for query in queries.values():
+        bq_run_query_job(
+            context.project, query, maximum_bytes_billed=context.max_bytes_per_query, client=context.client
+        )
+
+    try:
+        result = compare_tables("alltrials", context, tables["incremental"], tables["full"])
+    finally:
+        if not keep:
+            for name in names.values():
+                bq_delete_table(context.project, context.shared_dataset, name, client=context.client)
+
+    build_bytes = alltrials_build_bytes(context)
+    print(format_comparisons([result]))
+    print("\n".join(f"Bytes processed by a {build} build: {format_bytes(b)}" for build, b in build_bytes.items()))
+    path = os.path.join(context.output_dir, f"verify_alltrials_{context.doi_version}.json")
+    with open(path, "w") as f:
+        json.dump(dict(**result.to_dict(), build_bytes=build_bytes), f, indent=2)
+    return result
+
+
+def alltrials_build_bytes(context: Context) -> dict:
+    """Estimates the bytes that building this run's alltrials extract would process with dry runs, in full and
+    incrementally from the previous DOI table version's extract, so the saving of the incremental build is measured.
+    The bytes billed by the build that actually ran are in the run's telemetry
+
+    :return: The estimates as {"full": bytes, "incremental": bytes}. Without a previous_doi_version, only "full"
+    """
+    queries = render_shared_queries(context)
+    builds = dict(full="alltrials", incremental="alltrials_delta")
+    return {
+        build: bq_estimate_query_bytes(context.project, queries[query_name], client=context.client)
+        for build, query_name in builds.items()
+        if query_name in queries
+    }
+
+
+def verify_cohort(config: Config, keep: bool = False) -> List[TableComparison]:
+    """Checks that each partner's trials and pubs tables from a run with the cohort execution mode have the same rows as
+    the partner's own trials and pubs queries make. Prints the comparisons and writes them to file.
+
+    The partner's own queries are run into scratch tables in each partner's output dataset, which are deleted
+    afterwards unless keep is set. They read the same shared tables and alltrials view as the run, which must exist.
+
+    :param config: The workflow configuration
+    :param keep: Whether to keep the scratch tables, e.g. to investigate a difference
+    :return: The comparisons, one per partner and query
+    """
+    context = config.context
+    missing = [
+        f"{context.project}.{p.output_dataset}.{getattr(context, f'generated_{q}_name')}"
+        for p in config.partners
+        for q in COHORT_QUERIES
+        if not context.metadata.table_exists(context.project, p.output_dataset, getattr(context, f"generated_{q}_name"))
+    ]
+    if missing:
+        msg = "\n\t".join(missing)
+        raise RuntimeError(f"Partner table(s) missing. Run the workflow with execution_mode: cohort first:\n\t{msg}")
+
+    with ThreadPoolExecutor(max_workers=context.max_concurrent_jobs) as executor:
+        results = sum(executor.map(lambda p: verify_partner_cohort(p, context, keep), config.partners), [])
+
+    print(format_comparisons(results))
+    path = os.path.join(context.output_dir, f"verify_cohort_{context.run_version}.json")
+    with open(path, "w") as f:
+        json.dump([r.to_dict() for r in results], f, indent=2)
+    return results
+
+
+def verify_partner_cohort(partner: Partner, context: Context, keep: bool = False) -> List[TableComparison]:
+    """Runs the partner's own trials and pubs queries and compares their outputs to the partner's tables filled from
+    the cohort's tables. See verify_cohort"""
+    kwargs = partner_query_kwargs(partner=partner, context=context)
+    # The output table of each query is {query_name}{run_version}, so the run version gives them their own scratch names
+    version = f"{context.run_version}_verify_partner"
+    renders = dict(trials=query_trials, pubs=query_pubs)
+    bioprint(partner, f"Running the partner's own {', '.join(COHORT_QUERIES)} queries into *{version} tables")
+    for query_name in COHORT_QUERIES:
+        query = renders[query_name](**{**kwargs, "run_version": version})
+        bq_run_query_job(
+            context.project, query, maximum_bytes_billed=context.max_bytes_per_query, client=context.client
+        )
+
+    try:
+        return [
+            compare_tables(
+                f"{partner.institution_id}.{q}",
+                context,
+                f"{context.project}.{partner.output_dataset}.{q}{version}",
+                f"{context.project}.{partner.output_dataset}.{getattr(context, f'generated_{q}_name')}",
+            )
+            for q in COHORT_QUERIES
+        ]
+    finally:
+        if not keep:
+            for query_name in COHORT_QUERIES:
+                bq_delete_table(
+                    context.project, partner.output_dataset, f"{query_name}{version}", client=context.client
+                )
+
+
+def format_comparisons(results: List[TableComparison]) -> str:
+    """Formats the comparisons as a table, one row per comparison, followed by samples of any differing rows"""
+    width = max([len(r.name) for r in results] + [len("name")])
+    lines = [f"{'name':<{width}}  {'rows a':>10}  {'rows b':>10}  {'only a':>8}  {'only b':>8}  result"]
+    for r in results:
+        result = "equal" if r.equal else "DIFFERENT"
+        lines.append(f"{r.name:<{width}}  {r.rows_a:>10}  {r.rows_b:>10}  {r.only_a:>8}  {r.only_b:>8}  {result}")
+    for r in results:
+        if r.equal:
+            continue
+        lines.append(f"Rows only in {r.table_a}:")
+        lines += [f"\t{row}" for row in r.sample_a]
+        lines.append(f"Rows only in {r.table_b}:")
+        lines += [f"\t{row}" for row in r.sample_b]
+    return "\n".join(lines)
@@ -0,0 +1,101 @@
+from typing import Optional
+import json
+import os
+import re
+
+# The environment variable that sets the workflow hash, e.g. when running from a copy of the code without its git repo
+WORKFLOW_HASH_ENV = "BIOMED_WORKFLOW_HASH"
+
+# The build metadata stamped into the package when the container image is built. See the Dockerfile
+BUILD_INFO_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "build_info.json")
+
+# A full SHA-1 or SHA-256 commit hash
+COMMIT_HASH = re.compile(r"^[0-9a-f]{40}([0-9a-f]{24})?$")
+
+
+def workflow_hash(path: Optional[str] = None) -> str:
+    """The commit hash of the workflow's code. It is written to every output table and identifies the workflow in the
+    run's checkpoint. Taken from the first of:
+    the BIOMED_WORKFLOW_HASH environment variable,
+    the build metadata stamped into the package (see BUILD_INFO_PATH),
+    the HEAD commit of the git repo containing path.
+
+    The git repo is read directly rather than with git or GitPython, which are slow to start and may not be installed.
+    Raises a RuntimeError if none of them give a hash.
+
+    :param path: The directory to look for the git repo from. Defaults to the working directory
+    :return: The commit hash
+    """
+    env_hash = os.environ.get(WORKFLOW_HASH_ENV, "").strip()
+    if env_hash:
+        return env_hash
+    build_hash = read_build_info().get("workflow_hash")
+    if build_hash:
+        return build_hash
+    git_hash = git_head_commit(path if path else os.getcwd())
+    if git_hash:
+        return git_hash
+    raise RuntimeError(
+        f"Could not find the workflow hash. Set {WORKFLOW_HASH_ENV}, build the package with a stamped "
+        f"{os.path.basename(BUILD_INFO_PATH)} or run from within the workflow's git repo"
+    )
+
+
+def read_build_info(path: str = BUILD_INFO_PATH) -> dict:
+    """Reads the build metadata stamped into the package. Empty if there is none"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_git_dir(path: str) -> Optional[str]:
+    """Finds the .git directory of the repo containing path, by searching path and its parents. A .git file (as in a
+    worktree or submodule) is followed to the directory it points to. None if path is not in a git repo"""
+    path = os.path.abspath(path)
+    while True:
+        git_path = os.path.join(path, ".git")
+        if os.path.isdir(git_path):
+            return git_path
+        if os.path.isfile(git_path):
+            with open(git_path) as f:
+                content = f.read().strip()
+            if content.startswith("gitdir:"):
+                return os.path.normpath(os.path.join(path, content[len("gitdir:") :].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def git_head_commit(path: str) -> Optional[str]:
+    """Reads the HEAD commit of the git repo containing path from its .git directory. HEAD is either a commit (when
+    detached) or a branch, whose commit is in a loose ref file or in packed-refs. None if path is not in a git repo or
+    HEAD has no commit"""
+    git_dir = find_git_dir(path)
+    if not git_dir:
+        return None
+    with open(os.path.join(git_dir, "HEAD")) as f:
+        head = f.read().strip()
+    if not head.startswith("ref:"):
+        return head if COMMIT_HASH.match(head) else None
+    ref = head[len("ref:") :].strip()
+
+    # A worktree's branches are kept in the main repo's .git directory
+    common_dir = git_dir
+    if os.path.exists(os.path.join(git_dir, "commondir")):
+        with open(os.path.join(git_dir, "commondir")) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    for ref_dir in dict.fromkeys([git_dir, common_dir]):
+        ref_path = os.path.join(ref_dir, ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path) as f:
+                return f.read().strip()
+    packed_refs = os.path.join(common_dir, "packed-refs")
+    if os.path.exists(packed_refs):
+        with open(packed_refs) as f:
+            for line in f:
+                parts = line.strip().split(" ")
+                if len(parts) == 2 and parts[1] == ref and COMMIT_HASH.match(parts[0]):
+                    return parts[0]
+    return None
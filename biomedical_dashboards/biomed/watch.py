@@ -0,0 +1,360 @@
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+import json
+import os
+import re
+import time
+
+from biomedical_dashboards.biomed.config import Config, Partner
+from biomedical_dashboards.biomed.logs import watchprint
+from biomedical_dashboards.biomed.metadata import INPUT_SCHEMAS, MetadataCache
+from biomedical_dashboards.biomed.retry import set_quota_guard
+from biomedical_dashboards.biomed.scheduler import TaskGraph
+
+# The name of a versioned input table, e.g. dois_20230217. Partners upload each new version of an input as a new table
+# with the same prefix
+VERSIONED_TABLE = re.compile(r"^(?P<prefix>.+?)_?(?P<version>\d{8})$")
+
+# The name of a shard of the Academic Observatory DOI table, e.g. doi20240512
+DOI_SHARD = re.compile(r"^doi(?P<version>\d{8})$")
+
+# The partner queries that read each partner input table, by the name of the Partner attribute naming the table
+INPUT_QUERIES = dict(
+    trials_aact_table_name=["trials"],
+    dois_table_name=["trials", "pubs"],
+    oddpub_table_name=["pubs"],
+)
+
+# The default number of seconds between polls
+POLL_INTERVAL = 300
+
+# The default number of seconds that the inputs must go unchanged before a rebuild starts, so that a burst of uploads
+# is rebuilt once
+QUIET_PERIOD = 900
+
+# The default longest number of seconds that a rebuild waits for the inputs to go quiet, from the first change seen
+MAX_DELAY = 3600
+
+
+class WatchPlan:
+    """What a rebuild must do to bring the tables up to date with the inputs
+
+    :param doi_version: The new DOI table version, if a newer shard of the DOI table has landed. Every partner is then
+    rebuilt, along with the shared stages
+    :param partners: The reasons that each partner must be rebuilt, by institution_id
+    :param queries: The partner queries whose inputs have changed, by institution_id. The incremental manifest decides
+    which queries actually run, so this is reported rather than enforced
+    :param waiting: The inputs that are missing, by institution_id. Those partners aren't rebuilt until they land
+    """
+
+    def __init__(
+        self,
+        *,
+        doi_version: Optional[str] = None,
+        partners: Optional[Dict[str, List[str]]] = None,
+        queries: Optional[Dict[str, List[str]]] = None,
+        waiting: Optional[Dict[str, List[str]]] = None,
+    ):
+        self.doi_version = doi_version
+        self.partners = partners or {}
+        self.queries = queries or {}
+        self.waiting = waiting or {}
+
+    @property
+    def empty(self) -> bool:
+        """Whether there is nothing to rebuild"""
+        return not self.doi_version and not self.partners
+
+
+def input_versions(names: List[str], configured: str) -> Optional[str]:
+    """Picks the latest version of an input table from the tables in its dataset. The versions of an input share the
+    configured table name's prefix, e.g. dois_20230301 is a later version of dois_20230217. A configured name without a
+    version is only ever itself
+
+    :param names: The names of the tables in the dataset
+    :param configured: The table name in the config
+    :return: The name of the latest version. None if no version exists
+    """
+    match = VERSIONED_TABLE.match(configured)
+    if not match:
+        return configured if configured in names else None
+    versions = {}
+    for name in names:
+        m = VERSIONED_TABLE.match(name)
+        if m and m.group("prefix") == match.group("prefix"):
+            versions[m.group("version")] = name
+    return versions[max(versions)] if versions else None
+
+
+def poll_inputs(config: Config) -> dict:
+    """Takes a snapshot of the inputs that the workflow reads, with one listing of each partner's static dataset and of
+    the DOI table's dataset, and the metadata of each partner's latest input tables. The metadata calls go through the
+    context's clients, so the simulated backend (see simulated.py) stands in for BigQuery when testing.
+
+    :param config: The workflow configuration
+    :return: The snapshot: the latest DOI table version as doi_version, and each partner's latest input tables as
+    partners: {institution_id: {attr: {table_name, last_modified, num_rows}}}. An input that doesn't exist is left out
+    """
+    context = config.context
+    metadata = MetadataCache(clients=context.clients)
+    doi_project, doi_dataset, _ = context.doi_table.split(".")
+    shards = [m.group("version") for m in map(DOI_SHARD.match, metadata.listing(doi_project, doi_dataset) or []) if m]
+    snapshot = dict(doi_version=max(shards, default=str(context.doi_version)), partners={})
+    for partner in config.partners:
+        names = sorted(metadata.listing(context.project, partner.static_dataset) or [])
+        inputs = {}
+        for attr in INPUT_SCHEMAS:
+            table_name = input_versions(names, getattr(partner, attr))
+            if table_name is None:
+                continue
+            table = metadata.table_metadata(context.project, partner.static_dataset, table_name)
+            if table is not None:
+                inputs[attr] = dict(table_name=table_name, **table)
+        snapshot["partners"][partner.institution_id] = inputs
+    return snapshot
+
+
+def baseline_snapshot(config: Config, snapshot: dict) -> dict:
+    """The snapshot of the inputs that the config was last built from, when the watch starts without a saved state.
+    Inputs whose latest table is the one named in the config count as built. Any other is rebuilt"""
+    partners = {}
+    for partner in config.partners:
+        current = snapshot["partners"].get(partner.institution_id, {})
+        partners[partner.institution_id] = {
+            attr: (
+                current[attr]
+                if attr in current and current[attr]["table_name"] == getattr(partner, attr)
+                else dict(table_name=getattr(partner, attr), last_modified=None, num_rows=None)
+            )
+            for attr in INPUT_SCHEMAS
+        }
+    doi_version = str(config.context.doi_version)
+    return dict(
+        doi_version=doi_version,
+        partners=partners,
+        partner_doi_versions={p.institution_id: doi_version for p in config.partners},
+    )
+
+
+def built_doi_version(built: dict, institution_id: str) -> str:
+    """The DOI table version that a partner's tables were last built from. The shared stages' version for a partner
+    without one of its own"""
+    return built.get("partner_doi_versions", {}).get(institution_id, built["doi_version"])
+
+
+def plan_rebuild(built: dict, current: dict) -> WatchPlan:
+    """Works out the smallest rebuild that brings the tables up to date with the inputs. A partner is rebuilt when any
+    of its input tables has a new version or has been modified since it was last built, or when its tables were built
+    from an older DOI table shard than the latest. The shared stages are rebuilt when there is a newer DOI table shard
+    than they were built from.
+
+    :param built: The snapshot of the inputs that the tables were last built from, with the DOI table version of the
+    shared stages as doi_version and of each partner as partner_doi_versions
+    :param current: The snapshot of the inputs now. See poll_inputs
+    :return: The plan
+    """
+    doi_version = current["doi_version"] if current["doi_version"] > built["doi_version"] else None
+    partners, queries, waiting = {}, {}, {}
+    for id, inputs in current["partners"].items():
+        missing = [attr for attr in INPUT_SCHEMAS if attr not in inputs]
+        if missing:
+            waiting[id] = missing
+            continue
+        reasons, changed = [], set()
+        previous = built["partners"].get(id, {})
+        for attr, table in inputs.items():
+            before = previous.get(attr)
+            if before is None or before["table_name"] != table["table_name"]:
+                reasons.append(f"new {attr}: {table['table_name']}")
+            elif before["last_modified"] != table["last_modified"] or before["num_rows"] != table["num_rows"]:
+                reasons.append(f"{attr} modified: {table['table_name']}")
+            else:
+                continue
+            changed.update(INPUT_QUERIES[attr])
+        if current["doi_version"] > built_doi_version(built, id):
+            reasons.append(f"new DOI table version: {current['doi_version']}")
+            changed.update(["alltrials", "trials", "pubs"])
+        if reasons:
+            partners[id] = reasons
+            queries[id] = sorted(changed)
+    return WatchPlan(doi_version=doi_version, partners=partners, queries=queries, waiting=waiting)
+
+
+def format_plan(plan: WatchPlan) -> str:
+    """Formats the plan, one line per partner"""
+    lines = []
+    if plan.doi_version:
+        lines.append(f"New DOI table version, rebuilding the shared stages: {plan.doi_version}")
+    for id, reasons in sorted(plan.partners.items()):
+        lines.append(f"\t{id} ({', '.join(plan.queries[id])}): {'; '.join(reasons)}")
+    for id, missing in sorted(plan.waiting.items()):
+        lines.append(f"\t{id}: waiting for input(s): {', '.join(missing)}")
+    return "\n".join(lines)
+
+
+class Watcher:
+    """Watches the workflow's inputs and rebuilds the partners whose inputs have changed. Each poll lists the partners'
+    static datasets and the DOI table's dataset (see poll_inputs). Changes are coalesced: a rebuild starts once the
+    inputs have gone unchanged for quiet_period seconds, or max_delay seconds after the first change was seen, so a
+    partner uploading its tables one at a time is rebuilt once.
+
+    Each rebuild runs the workflow for the partners that need it, with run_version set to the day of the rebuild. The
+    incremental manifest skips each query whose inputs are unchanged, so only the stages that read a changed input
+    run. With a new DOI table version, the shared stages are rebuilt (incrementally from the previous version's
+    extract, where they can be) and then every partner.
+
+    The snapshot of the inputs that were built from is saved to output_dir/watch_state.json after each rebuild, so a
+    restarted watch carries on where it left off. The workflow retries transient errors itself, so partners whose
+    rebuild failed (e.g. from a bad upload) aren't rebuilt again until their inputs change, or the watch is restarted.
+
+    :param config: The workflow configuration. Its context is updated with each rebuild's versions
+    :param run_workflow: Runs the workflow for a config and returns its task graph. See main.run_workflow
+    :param poll_interval: The number of seconds between polls
+    :param quiet_period: The number of seconds that the inputs must go unchanged before a rebuild starts
+    :param max_delay: The longest number of seconds that a rebuild waits for the inputs to go quiet
+    :param clock: Returns the time in seconds, for measuring the quiet period
+    :param sleep: Waits for a number of seconds between polls
+    :param today: Returns the run version of a rebuild started now
+    """
+
+    def __init__(
+        self,
+        *,
+        config: Config,
+        run_workflow: Callable[[Config], TaskGraph],
+        poll_interval: float = POLL_INTERVAL,
+        quiet_period: float = QUIET_PERIOD,
+        max_delay: float = MAX_DELAY,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        today: Callable[[], str] = lambda: datetime.now(timezone.utc).strftime("%Y%m%d"),
+    ):
+        self.config = config
+        self.run_workflow = run_workflow
+        self.poll_interval = poll_interval
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.today = today
+        self.builds = 0
+        self.built: Optional[dict] = None  # The snapshot of the inputs that were last built from
+        self._last_snapshot: Optional[dict] = None
+        self._first_change: Optional[float] = None  # When the pending changes were first seen
+        self._last_change: Optional[float] = None  # When the inputs last changed
+        self._failed: Optional[dict] = None  # The snapshot of the last rebuild that failed
+        set_quota_guard(config.context.quota)
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.built = json.load(f)
+            config.context.doi_version = self.built["doi_version"]
+            watchprint(f"Carrying on from the saved state: {self.state_path}")
+
+    @property
+    def state_path(self) -> str:
+        """The path of the saved snapshot of the inputs that were last built from"""
+        return os.path.join(self.config.context.output_dir, "watch_state.json")
+
+    def run(self, max_polls: Optional[int] = None, max_builds: Optional[int] = None) -> None:
+        """Polls the inputs and rebuilds as they change, until max_polls polls or max_builds rebuilds have been made.
+        Runs forever if neither is set"""
+        watchprint(f"Watching the inputs of {len(self.config.partners)} partner(s) and the DOI table")
+        polls = 0
+        while True:
+            self.step()
+            polls += 1
+            if (max_polls is not None and polls >= max_polls) or (max_builds is not None and self.builds >= max_builds):
+                return
+            self.sleep(self.poll_interval)
+
+    def step(self) -> Optional[TaskGraph]:
+        """Polls the inputs once and starts a rebuild if one is due
+
+        :return: The rebuild's task graph. None if nothing was rebuilt
+        """
+        snapshot = poll_inputs(self.config)
+        if self.built is None:
+            self.built = baseline_snapshot(self.config, snapshot)
+            self._save()
+        plan = plan_rebuild(self.built, snapshot)
+        now = self.clock()
+        if plan.empty or snapshot == self._failed:
+            self._first_change = self._last_change = None
+            self._last_snapshot = snapshot
+            return None
+
+        if snapshot != self._last_snapshot or self._last_change is None:
+            self._last_change = now
+        if self._first_change is None:
+            self._first_change = now
+            watchprint(f"Inputs changed:\n{format_plan(plan)}")
+        self._last_snapshot = snapshot
+        quiet = now - self._last_change >= self.quiet_period
+        overdue = now - self._first_change >= self.max_delay
+        if not quiet and not overdue:
+            watchprint(f"Waiting for the inputs to go quiet before rebuilding {len(plan.partners)} partner(s)")
+            return None
+        return self.rebuild(plan, snapshot)
+
+    def rebuild(self, plan: WatchPlan, snapshot: dict) -> TaskGraph:
+        """Runs the workflow for the partners of the plan, with their latest input tables. The saved state is moved on
+        for the partners that were rebuilt without errors, each with the DOI table version that it was built from, and
+        for the shared stages' DOI table version if they were rebuilt without errors. A partner that fails is rebuilt
+        from the new DOI table version once its inputs change, even if the shared stages' version has moved on
+
+        :param plan: The plan. See plan_rebuild
+        :param snapshot: The snapshot of the inputs that the plan was made from
+        :return: The rebuild's task graph
+        """
+        context = self.config.context
+        if plan.doi_version:
+            context.previous_doi_version = self.built["doi_version"]
+            context.doi_version = plan.doi_version
+        context.run_version = self.today()
+        context.metadata = MetadataCache(clients=context.clients)
+        context.manifest.new_run()
+        context.telemetry.new_run()
+        partners = [
+            partner_with_inputs(p, snapshot["partners"][p.institution_id])
+            for p in self.config.partners
+            if p.institution_id in plan.partners
+        ]
+        build = Config(context=context, partners=partners)
+        # The shared extracts are made once for every partner, so keep the whole config's year cutoff
+        build.context.shared_year_cutoff = self.config.min_year_cutoff
+        watchprint(f"Rebuilding run {context.run_version} for {len(partners)} partner(s):\n{format_plan(plan)}")
+
+        graph = self.run_workflow(build)
+        self.builds += 1
+        failed = {t.partner for t in graph.tasks.values() if t.status != "done"}
+        # Partners without a DOI table version of their own were built from the shared stages' version, which is about
+        # to move on
+        versions = self.built.setdefault("partner_doi_versions", {})
+        for partner in self.config.partners:
+            versions.setdefault(partner.institution_id, self.built["doi_version"])
+        for partner in partners:
+            if partner.institution_id not in failed:
+                self.built["partners"][partner.institution_id] = snapshot["partners"][partner.institution_id]
+                versions[partner.institution_id] = str(context.doi_version)
+        if plan.doi_version and None not in failed:
+            self.built["doi_version"] = plan.doi_version
+        self._save()
+
+        self._first_change = self._last_change = None
+        if failed:
+            errors = "\n".join(f"{name}: {error.strip().splitlines()[-1]}" for name, error in graph.errors().items())
+            watchprint(f"Rebuild failed, not retrying until the inputs change:\n{errors}")
+            self._failed = snapshot
+        else:
+            watchprint(f"Rebuilt run {context.run_version} for {len(partners)} partner(s)")
+            self._failed = None
+        return graph
+
+    def _save(self) -> None:
+        with open(self.state_path, "w") as f:
+            json.dump(self.built, f, indent=2)
+
+
+def partner_with_inputs(partner: Partner, inputs: dict) -> Partner:
+    """A copy of the partner that reads the input tables of a snapshot. See poll_inputs"""
+    return Partner.from_dict({**partner.to_dict(), **{attr: table["table_name"] for attr, table in inputs.items()}})
@@ -0,0 +1,47 @@
+import pytest
+
+from biomedical_dashboards.biomed.config import Config
+from biomedical_dashboards.biomed.retry import set_quota_guard
+
+
+@pytest.fixture
+def simulated_config(tmp_path):
+    """Makes a config for the simulated backend (see simulated.py) with two partners, writing to a temporary
+    directory. Context settings are overridden with keyword arguments"""
+
+    def _config(**context) -> Config:
+        config = Config.from_dict(
+            dict(
+                context={
+                    **dict(
+                        dryrun=False,
+                        backend="simulated",
+                        simulation=dict(job_latency=0.0),
+                        project="my-project",
+                        output_dir=str(tmp_path),
+                        run_version=20250310,
+                        doi_version=20240512,
+                    ),
+                    **context,
+                },
+                partners=[
+                    dict(
+                        institution_id="partner-a",
+                        dois_table_name="dois_20230217",
+                        oddpub_table_name="oddpub_20230217",
+                        trials_aact_table_name="trials_aact_20250221",
+                        year_cutoff=2020,
+                    ),
+                    dict(
+                        institution_id="partner-b",
+                        dois_table_name="dois_20230101",
+                        oddpub_table_name="oddpub_20230101",
+                        trials_aact_table_name="trials_aact_20250101",
+                    ),
+                ],
+            )
+        )
+        set_quota_guard(config.context.quota)
+        return config
+
+    return _config
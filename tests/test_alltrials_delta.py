@@ -0,0 +1,90 @@
+import re
+import sqlite3
+
+import pytest
+
+from biomedical_dashboards.biomed.shared_workflow import render_shared_queries
+
+# The previous extract's rows: (doi, pubmed_doi, content_hash). The Pubmed databanks of 10.1/x are read from the row of
+# 10.1/a, and those of 10.1/y from the row of 10.1/c
+PREVIOUS = [
+    ("10.1/a", "10.1/X", 1),
+    ("10.1/x", None, 2),
+    ("10.1/b", "10.1/b", 3),
+    ("10.1/c", "10.1/y", 4),
+    ("10.1/y", None, 5),
+]
+
+
+def cte(query: str, name: str) -> str:
+    """The text of a common table expression of a rendered query, from its name to its closing parenthesis"""
+    start = re.search(rf"^{name} AS \(", query, re.MULTILINE).start()
+    depth = 0
+    for i in range(query.index("(", start), len(query)):
+        depth += {"(": 1, ")": -1}.get(query[i], 0)
+        if depth == 0:
+            return query[start : i + 1]
+    raise ValueError(f"Unbalanced CTE: {name}")
+
+
+@pytest.fixture
+def delta_query(simulated_config) -> str:
+    context = simulated_config(doi_version=20240601, previous_doi_version=20240512).context
+    return render_shared_queries(context)["alltrials_delta"]
+
+
+def run_delta(query: str, current: list) -> tuple:
+    """Runs the incremental extract's change detection and carry-over filter over the previous extract's rows and the
+    current DOI table's rows (given as its content hashes). They use only portable SQL, so run in sqlite
+
+    :return: The changed DOIs, and the DOIs whose previous rows are carried over
+    """
+    previous_table = re.search(r"FROM (`[^`]+`) AS previous", query).group(1)
+    db = sqlite3.connect(":memory:")
+    db.execute(f"CREATE TABLE {previous_table} (doi, pubmed_doi, content_hash)")
+    db.executemany(f"INSERT INTO {previous_table} VALUES (?, ?, ?)", PREVIOUS)
+    db.execute("CREATE TABLE current_hashes (doi, pubmed_doi, content_hash)")
+    db.executemany("INSERT INTO current_hashes VALUES (?, ?, ?)", current)
+    ctes = f"WITH {cte(query, 'changed_rows')}, {cte(query, 'changed_dois')}"
+    changed = {r[0] for r in db.execute(f"{ctes} SELECT doi_key FROM changed_dois")}
+    carry_over = query[query.rindex("UNION ALL") :]
+    carry_over = carry_over[carry_over.index("FROM") : carry_over.rindex(")")]
+    carried = {r[0] for r in db.execute(f"{ctes} SELECT previous.doi {carry_over}")}
+    return changed, carried
+
+
+def test_unchanged_rows_are_carried_over(delta_query):
+    changed, carried = run_delta(delta_query, PREVIOUS)
+    assert (changed, carried) == (set(), {"10.1/a", "10.1/x", "10.1/b", "10.1/c", "10.1/y"})
+
+
+@pytest.mark.parametrize(
+    "current_a",
+    [
+        pytest.param([], id="deleted"),
+        # Below the year cutoff, so not among the current hashes
+        pytest.param([], id="below_cutoff"),
+        pytest.param([("10.1/a", "10.1/q", 6)], id="pubmed_doi_changed"),
+    ],
+)
+def test_doi_whose_pubmed_row_has_gone_is_extracted_again(delta_query, current_a):
+    current = [r for r in PREVIOUS if r[0] != "10.1/a"] + current_a
+    changed, carried = run_delta(delta_query, current)
+    # 10.1/x's own row is unchanged, but its Pubmed databanks came from 10.1/a's row
+    assert "10.1/x" in changed
+    assert "10.1/x" not in carried
+    assert carried == {"10.1/b", "10.1/c", "10.1/y"}
+
+
+def test_repointed_pubmed_doi_changes_both_dois(delta_query):
+    current = [r for r in PREVIOUS if r[0] != "10.1/c"] + [("10.1/c", "10.1/z", 7), ("10.1/z", None, 8)]
+    changed, carried = run_delta(delta_query, current)
+    assert changed == {"10.1/c", "10.1/y", "10.1/z"}
+    assert carried == {"10.1/a", "10.1/x", "10.1/b"}
+
+
+def test_extract_stores_each_rows_pubmed_doi(delta_query, simulated_config):
+    full = render_shared_queries(simulated_config().context)["alltrials"]
+    for query in [full, delta_query]:
+        assert "academic_observatory.pubmed.doi AS pubmed_doi" in cte(query, "main_select")
+        assert "enhanced_6.pubmed_doi" in query
@@ -0,0 +1,91 @@
+import pytest
+
+from biomedical_dashboards.biomed.checkpoint import CheckpointStore
+from biomedical_dashboards.biomed.scheduler import Task, TaskGraph
+
+
+class Outputs:
+    """The outputs of a run's tasks. Each task makes its output when it runs, and is verified by its output existing"""
+
+    def __init__(self, fail: set = ()):
+        self.made = set()
+        self.ran = []
+        self.fail = set(fail)
+
+    def graph(self, checkpoint: CheckpointStore) -> TaskGraph:
+        """A chain of tasks extract -> trials -> pubs"""
+        graph = TaskGraph(checkpoint=checkpoint)
+        for name, deps in [("extract", []), ("trials", ["extract"]), ("pubs", ["trials"])]:
+            graph.add(Task(name=name, func=self._func(name), deps=deps, verify=lambda name=name: name in self.made))
+        return graph
+
+    def _func(self, name: str):
+        def _run():
+            self.ran.append(name)
+            if name in self.fail:
+                raise RuntimeError(f"{name} failed")
+            self.made.add(name)
+
+        return _run
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / "checkpoint_20250310.jsonl")
+
+
+def fail_then_resume(path: str, workflow_hash: str = "abc", engine: str = "threads", lost: set = ()) -> Outputs:
+    """Runs the chain with pubs failing, then again with resume. The outputs in lost are deleted between the attempts
+
+    :return: The outputs of the resumed attempt
+    """
+    outputs = Outputs(fail={"pubs"})
+    outputs.graph(CheckpointStore(path, workflow_hash="abc")).run(max_workers=2)
+    assert outputs.ran == ["extract", "trials", "pubs"]
+
+    outputs.ran, outputs.fail = [], set()
+    outputs.made -= set(lost)
+    graph = outputs.graph(CheckpointStore(path, workflow_hash=workflow_hash, resume=True))
+    if engine == "threads":
+        graph.run(max_workers=2)
+    else:
+        graph.run_async(max_concurrent=2, max_threads=2)
+    assert {t.status for t in graph.tasks.values()} == {"done"}
+    return outputs
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_resume_skips_verified_tasks(path, engine):
+    outputs = fail_then_resume(path, engine=engine)
+    assert outputs.ran == ["pubs"]
+    checkpoint = CheckpointStore(path, workflow_hash="abc", resume=True)
+    assert sorted(checkpoint.completed) == ["extract", "pubs", "trials"]
+
+
+def test_resume_reruns_tasks_whose_output_has_gone(path):
+    outputs = fail_then_resume(path, lost={"trials"})
+    assert outputs.ran == ["trials", "pubs"]
+
+
+def test_checkpoint_of_another_workflow_version_is_discarded(path, capsys):
+    outputs = fail_then_resume(path, workflow_hash="def")
+    assert outputs.ran == ["extract", "trials", "pubs"]
+    assert "was written by workflow version abc, not def. Starting from the beginning" in capsys.readouterr().out
+    # The new attempt's checkpoint replaces the old one
+    assert CheckpointStore(path, workflow_hash="abc", resume=True).completed == {}
+    assert sorted(CheckpointStore(path, workflow_hash="def", resume=True).completed) == ["extract", "pubs", "trials"]
+
+
+def test_run_without_resume_starts_a_new_checkpoint(path):
+    Outputs().graph(CheckpointStore(path, workflow_hash="abc")).run(max_workers=2)
+    outputs = Outputs()
+    outputs.graph(CheckpointStore(path, workflow_hash="abc")).run(max_workers=2)
+    assert outputs.ran == ["extract", "trials", "pubs"]
+
+
+def test_unreadable_lines_are_skipped(path):
+    Outputs().graph(CheckpointStore(path, workflow_hash="abc")).run(max_workers=2)
+    with open(path, "a") as f:
+        f.write('{"task": "cut sho')
+    checkpoint = CheckpointStore(path, workflow_hash="abc", resume=True)
+    assert sorted(checkpoint.completed) == ["extract", "pubs", "trials"]
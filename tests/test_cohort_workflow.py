@@ -0,0 +1,66 @@
+import pytest
+
+from biomedical_dashboards.biomed.main import build_graph
+from biomedical_dashboards.biomed.queries import COHORT_QUERIES, render_cohort_queries, render_partner_queries
+
+
+@pytest.fixture
+def config(simulated_config):
+    return simulated_config(execution_mode="cohort")
+
+
+def test_cohort_queries_read_every_partners_tables(config):
+    context = config.context
+    queries = render_cohort_queries(config.partners, context)
+    assert list(queries) == list(COHORT_QUERIES)
+    for query_name, query in queries.items():
+        assert f"`my-project.{context.shared_dataset}.{getattr(context, f'cohort_{query_name}_name')}`" in query
+        for partner in config.partners:
+            assert f"'{partner.institution_id}'" in query
+            assert f"my-project.{partner.static_dataset}.{partner.dois_table_name}" in query
+
+
+def test_partner_queries_fill_from_the_cohorts_tables(config):
+    context = config.context
+    queries = render_partner_queries(config.partners, context)
+    for partner in config.partners:
+        for query_name in COHORT_QUERIES:
+            query = queries[partner.institution_id][query_name]
+            assert f"`my-project.{partner.output_dataset}.{query_name}{context.run_version}`" in query
+            assert f"`my-project.{context.shared_dataset}.{getattr(context, f'cohort_{query_name}_name')}`" in query
+        # Each partner keeps its own alltrials view, with its own year cutoff
+        assert f"> {partner.year_cutoff}" in queries[partner.institution_id]["alltrials"]
+
+
+def test_cohort_tasks_are_wired_between_the_partners(config):
+    graph = build_graph(config)
+    graph.topological_order()
+    static = {f"{p.institution_id}:check_static_tables" for p in config.partners}
+    for query_name in COHORT_QUERIES:
+        deps = set(graph.tasks[f"cohort:{query_name}"].deps)
+        assert static <= deps
+        assert "cohort:generate_queries" in deps
+        assert {name for name in graph.tasks if name.startswith("shared:")} <= deps
+        for partner in config.partners:
+            assert f"cohort:{query_name}" in graph.tasks[f"{partner.institution_id}:{query_name}"].deps
+    # The cohort's queries are run once, rather than by each partner
+    assert not [name for name, t in graph.tasks.items() if t.partner and name.startswith("cohort:")]
+
+
+def test_jobs_mode_has_no_cohort_tasks(simulated_config):
+    graph = build_graph(simulated_config())
+    assert not [name for name in graph.tasks if name.startswith("cohort:")]
+    for partner in ["partner-a", "partner-b"]:
+        assert graph.tasks[f"{partner}:pubs"].deps == [f"{partner}:alltrials"]
+
+
+def test_cohort_run_on_the_simulated_backend(config):
+    graph = build_graph(config)
+    graph.run(max_workers=4)
+    assert graph.errors() == {}
+    assert {t.status for t in graph.tasks.values()} == {"done"}
+    context = config.context
+    for query_name in COHORT_QUERIES:
+        assert context.metadata.table_exists(
+            context.project, context.shared_dataset, getattr(context, f"cohort_{query_name}_name")
+        )
@@ -0,0 +1,60 @@
+import pytest
+
+from biomedical_dashboards.biomed.config import Config
+
+
+@pytest.mark.parametrize(
+    "settings, error",
+    [
+        (dict(backend="spreadsheet"), "'backend' must be one of bigquery, simulated, got spreadsheet"),
+        (dict(simulation=dict(job_latency=0.0, speed=2)), "Unknown 'simulation' setting(s): speed"),
+        (dict(simulation=[1]), "'simulation' must be a mapping of settings, got [1]"),
+        (dict(engine="processes"), "'engine' must be one of threads, asyncio, got processes"),
+        (dict(max_threads=0), "'max_threads' must be a positive integer, got 0"),
+        (dict(max_concurrent_jobs=True), "'max_concurrent_jobs' must be a positive integer, got True"),
+        (dict(job_poll_interval=0), "'job_poll_interval' must be a positive number of seconds, got 0"),
+        (dict(max_retries=-1), "'max_retries' must be a non-negative integer, got -1"),
+        (dict(api_calls_per_second=0), "'api_calls_per_second' must be a positive number or null for unlimited"),
+        (dict(jobs_per_second="fast"), "'jobs_per_second' must be a positive number or null for unlimited"),
+        (dict(publish_mode="move"), "'publish_mode' must be one of"),
+        (dict(execution_mode="batch"), "'execution_mode' must be one of"),
+        (dict(max_bytes_per_query="lots"), "'max_bytes_per_query'"),
+        (dict(previous_doi_version=20240601), "'previous_doi_version' must be before doi_version (20240512)"),
+        (dict(table_options=dict(alltrials={})), "'table_options' must be for one of"),
+    ],
+)
+def test_config_rejects_bad_settings(simulated_config, settings, error):
+    with pytest.raises(RuntimeError, match="Encountered error\\(s\\) in config construction") as e:
+        simulated_config(**settings)
+    assert error in str(e.value)
+
+
+def test_config_reports_every_bad_setting(simulated_config):
+    with pytest.raises(RuntimeError) as e:
+        simulated_config(max_threads=0, max_retries=-1)
+    assert "'max_threads'" in str(e.value) and "'max_retries'" in str(e.value)
+
+
+def test_partner_rejects_bad_shard_weight(tmp_path):
+    with pytest.raises(RuntimeError, match="Partner shard_weight must be a positive number, got 0"):
+        Config.from_dict(
+            dict(
+                context=dict(
+                    dryrun=True,
+                    project="my-project",
+                    output_dir=str(tmp_path),
+                    run_version=20250310,
+                    doi_version=20240512,
+                ),
+                partners=[
+                    dict(
+                        institution_id="partner-a",
+                        dois_table_name="dois",
+                        oddpub_table_name="oddpub",
+                        trials_aact_table_name="trials_aact",
+                        year_cutoff=2020,
+                        shard_weight=0,
+                    )
+                ],
+            )
+        )
@@ -0,0 +1,90 @@
+import os
+
+import pyarrow
+import pyarrow.csv
+import pyarrow.parquet
+import pytest
+
+from biomedical_dashboards.biomed.export import LocalArrowSource, export_latest_tables, export_table
+
+# The number of rows in each fixture table, written as several row groups so that it is read as several streams
+ROWS = 1000
+
+
+@pytest.fixture
+def local_source(tmp_path):
+    """A LocalArrowSource holding the latest trials and pubs tables of the simulated config's partners. Each table has
+    a scalar doi and year, and a nested registries column"""
+    path = tmp_path / "tables"
+    path.mkdir()
+    table = pyarrow.table(
+        dict(
+            doi=[f"10.1000/{i}" for i in range(ROWS)],
+            year=[2000 + i % 25 for i in range(ROWS)],
+            registries=[[dict(id=f"NCT{i:08d}", registry="ClinicalTrials.gov")] for i in range(ROWS)],
+        )
+    )
+    for institution_id in ["partner-a", "partner-b"]:
+        for name in ["trials", "pubs"]:
+            file = path / f"my-project.{institution_id}_data_latest.{name}.parquet"
+            pyarrow.parquet.write_table(table, file, row_group_size=ROWS // 4)
+    return LocalArrowSource(path=str(path))
+
+
+def test_export_to_parquet(simulated_config, local_source, tmp_path):
+    dest = tmp_path / "export"
+    results = export_latest_tables(
+        simulated_config(), source=local_source, format="parquet", columns=["doi", "registries"], dest=str(dest)
+    )
+
+    assert sorted((r.institution_id, r.table) for r in results) == [
+        ("partner-a", "pubs"),
+        ("partner-a", "trials"),
+        ("partner-b", "pubs"),
+        ("partner-b", "trials"),
+    ]
+    for r in results:
+        assert (r.rows, r.streams) == (ROWS, 4)
+        exported = pyarrow.parquet.read_table(r.path)
+        assert exported.column_names == ["doi", "registries"]
+        assert exported.num_rows == ROWS
+        assert sorted(exported["doi"].to_pylist()) == sorted(f"10.1000/{i}" for i in range(ROWS))
+    assert sorted(os.listdir(dest)) == [
+        "partner-a_pubs.parquet",
+        "partner-a_trials.parquet",
+        "partner-b_pubs.parquet",
+        "partner-b_trials.parquet",
+    ]
+
+
+def test_export_to_csv(simulated_config, local_source, tmp_path):
+    results = export_latest_tables(
+        simulated_config(),
+        source=local_source,
+        tables=("trials",),
+        format="csv",
+        columns=["year", "doi"],
+        max_streams=2,
+        dest=str(tmp_path / "export"),
+    )
+
+    assert len(results) == 2
+    for r in results:
+        assert (r.rows, r.streams, r.path.endswith("_trials.csv")) == (ROWS, 2, True)
+        exported = pyarrow.csv.read_csv(r.path)
+        assert exported.column_names == ["year", "doi"]
+        assert exported.num_rows == ROWS
+
+
+def test_export_nested_column_to_csv_fails_cleanly(local_source, tmp_path):
+    path = tmp_path / "pubs.csv"
+    with pytest.raises(RuntimeError, match="CSV can't hold the nested column"):
+        export_table(
+            local_source,
+            project="my-project",
+            dataset="partner-a_data_latest",
+            table_name="pubs",
+            path=str(path),
+            format="csv",
+        )
+    assert list(tmp_path.glob("pubs.csv*")) == []
@@ -0,0 +1,113 @@
+from google.api_core.exceptions import InternalServerError, ServiceUnavailable
+from google.auth.credentials import AnonymousCredentials
+import pytest
+
+from biomedical_dashboards.biomed import retry
+from biomedical_dashboards.biomed.gcp import BQClientPool, bq_pooled_session, bq_run_query_job
+from biomedical_dashboards.biomed.retry import QuotaGuard, RetryPolicy, quota_guard, set_quota_guard
+
+
+class StubClient:
+    """Stands in for a bigquery client, recording how it was created and whether it was closed"""
+
+    def __init__(self, project: str, pool_size: int):
+        self.project = project
+        self.pool_size = pool_size
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_client_pool_reuses_one_client_per_project():
+    pool = BQClientPool(pool_size=25, client_factory=StubClient)
+    assert pool.stats() == dict(clients_created=0, connections_reused=0)
+
+    clients = [pool.get("project-a") for _ in range(3)] + [pool.get("project-b")]
+    assert clients[0] is clients[1] is clients[2]
+    assert clients[3] is not clients[0]
+    assert [c.project for c in clients] == ["project-a"] * 3 + ["project-b"]
+    assert all(c.pool_size == 25 for c in clients)
+    assert pool.stats() == dict(clients_created=2, connections_reused=2)
+
+
+def test_client_pool_close():
+    pool = BQClientPool(client_factory=StubClient)
+    client = pool.get("project-a")
+    pool.close()
+    assert client.closed
+
+    # A client is created again if asked for after closing
+    assert pool.get("project-a") is not client
+    assert pool.stats() == dict(clients_created=2, connections_reused=0)
+
+
+def test_pooled_session_holds_pool_size_connections():
+    session = bq_pooled_session(AnonymousCredentials(), pool_size=32)
+    adapter = session.get_adapter("https://bigquery.googleapis.com")
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 32
+
+
+class StubJob:
+    """Stands in for a query job. Polling it raises the errors in poll_errors first, then the job's own error if it
+    failed"""
+
+    def __init__(self, job_id: str, poll_errors: list, failed: bool):
+        self.job_id = job_id
+        self.poll_errors = poll_errors
+        self.failed = failed
+        self.error_result = None
+
+    def result(self):
+        if self.poll_errors:
+            raise self.poll_errors.pop(0)
+        if self.failed:
+            self.error_result = dict(reason="backendError", message="Job failed")
+            raise InternalServerError("Job failed")
+        return []
+
+
+class StubQueryClient:
+    """Stands in for a bigquery client, making a job per query submitted. The first failed_jobs jobs fail"""
+
+    def __init__(self, poll_errors: list = (), failed_jobs: int = 0):
+        self.jobs = []
+        self.poll_errors = list(poll_errors)
+        self.failed_jobs = failed_jobs
+
+    def query(self, query: str, job_config=None) -> StubJob:
+        job = StubJob(f"job_{len(self.jobs)}", self.poll_errors, len(self.jobs) < self.failed_jobs)
+        self.jobs.append(job)
+        return job
+
+
+@pytest.fixture
+def guard(monkeypatch):
+    """A quota guard that retries 3 times without waiting, replacing the process's guard for the test"""
+    monkeypatch.setattr(retry.time, "sleep", lambda seconds: None)
+    previous = quota_guard()
+    set_quota_guard(QuotaGuard(retry=RetryPolicy(max_attempts=3)))
+    yield quota_guard()
+    set_quota_guard(previous)
+
+
+def test_polling_errors_poll_the_same_job(guard):
+    client = StubQueryClient(poll_errors=[ServiceUnavailable("down"), ServiceUnavailable("down")])
+    job = bq_run_query_job("my-project", "SELECT 1", client=client)
+    assert [j.job_id for j in client.jobs] == [job.job_id] == ["job_0"]
+    assert guard.stats()["calls"] == dict(jobs=1, metadata=3)
+
+
+def test_failed_job_is_submitted_again(guard):
+    client = StubQueryClient(failed_jobs=1)
+    job = bq_run_query_job("my-project", "SELECT 1", client=client)
+    assert [j.job_id for j in client.jobs] == ["job_0", "job_1"]
+    assert job.job_id == "job_1"
+    assert guard.stats()["calls"] == dict(jobs=2, metadata=2)
+
+
+def test_polling_that_gives_up_does_not_submit_again(guard):
+    client = StubQueryClient(poll_errors=[ServiceUnavailable("down")] * 3)
+    with pytest.raises(RuntimeError, match="Gave up polling job job_0, which may still be running"):
+        bq_run_query_job("my-project", "SELECT 1", client=client)
+    assert len(client.jobs) == 1
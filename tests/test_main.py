@@ -0,0 +1,69 @@
+import pytest
+
+from biomedical_dashboards.biomed import main
+
+
+@pytest.fixture
+def auth(monkeypatch):
+    """Records the keyfiles that gcp_set_auth is called with"""
+    keyfiles = []
+    monkeypatch.setattr(main, "gcp_set_auth", keyfiles.append)
+    return keyfiles
+
+
+@pytest.fixture
+def closed(monkeypatch):
+    """Counts the times that a config's clients are closed"""
+    calls = []
+
+    def _closed(config):
+        monkeypatch.setattr(config.context.clients, "close", lambda: calls.append(1))
+        return calls
+
+    return _closed
+
+
+def test_simulated_backend_is_not_authenticated(simulated_config, auth, closed):
+    config = simulated_config()
+    calls = closed(config)
+    with main.backend_session(config, uses="The check runs queries"):
+        pass
+    assert (auth, calls) == ([], [1])
+
+
+def test_bigquery_backend_is_authenticated(simulated_config, auth, closed):
+    config = simulated_config()
+    config.context.backend = "bigquery"
+    calls = closed(config)
+    with main.backend_session(config, uses="The check runs queries"):
+        assert auth == [config.context.keyfile]
+    assert calls == [1]
+
+
+def test_dryrun_is_rejected_by_commands_that_use_bigquery(simulated_config, auth, closed):
+    config = simulated_config(dryrun=True)
+    calls = closed(config)
+    with pytest.raises(RuntimeError, match="The check runs queries, so can't be used with dryrun: True"):
+        with main.backend_session(config, uses="The check runs queries"):
+            pass
+    with main.backend_session(config):
+        pass
+    assert (auth, calls) == ([], [1])
+
+
+def test_clients_are_closed_when_the_command_fails(simulated_config, auth, closed, capsys):
+    config = simulated_config()
+    calls = closed(config)
+    with pytest.raises(ValueError):
+        with main.backend_session(config, uses="The check runs queries"):
+            raise ValueError("failed")
+    assert calls == [1]
+    assert config.context.quota.report() in capsys.readouterr().out
+
+
+def test_commands_that_dont_connect_are_left_alone(simulated_config, auth, closed):
+    config = simulated_config(dryrun=True)
+    calls = closed(config)
+    with main.backend_session(config, uses="The check runs queries", connect=False):
+        pass
+    assert (auth, calls) == ([], [])
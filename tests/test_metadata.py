@@ -0,0 +1,69 @@
+import pytest
+
+
+@pytest.fixture
+def context(simulated_config):
+    context = simulated_config().context
+    context.simulation.add_table("my-project.dataset.table_a", num_rows=10)
+    context.simulation.add_table("my-project.dataset.table_b", num_rows=20)
+    return context
+
+
+def calls(context) -> dict:
+    """The metadata calls made to the simulated backend"""
+    return {k: v for k, v in context.simulation.api_calls.items() if k in ("tables.list", "tables.get")}
+
+
+def test_dataset_is_listed_once(context):
+    cache = context.metadata
+    assert cache.table_exists("my-project", "dataset", "table_a")
+    assert cache.table_exists("my-project", "dataset", "table_b")
+    assert not cache.table_exists("my-project", "dataset", "table_c")
+    assert not cache.dataset_exists("my-project", "missing")
+    assert not cache.table_exists("my-project", "missing", "table_a")
+    assert calls(context) == {"tables.list": 2}
+    assert cache.stats() == dict(datasets_listed=2, tables_fetched=0, lookups_cached=3)
+
+
+def test_table_is_fetched_once(context):
+    cache = context.metadata
+    assert cache.table_metadata("my-project", "dataset", "table_a")["num_rows"] == 10
+    assert cache.table_layout("my-project", "dataset", "table_a")["table_type"] == "TABLE"
+    assert cache.get_table("my-project", "dataset", "table_c") is None
+    assert calls(context) == {"tables.list": 1, "tables.get": 1}
+
+
+def test_written_table_is_fetched_again(context):
+    cache = context.metadata
+    cache.table_metadata("my-project", "dataset", "table_a")
+    context.simulation.add_table("my-project.dataset.table_a", num_rows=30)
+    context.simulation.add_table("my-project.dataset.table_c", num_rows=40)
+    # Not seen until the workflow says it has written them
+    assert cache.table_metadata("my-project", "dataset", "table_a")["num_rows"] == 10
+    assert not cache.table_exists("my-project", "dataset", "table_c")
+
+    cache.written("my-project", "dataset", "table_a")
+    cache.written("my-project", "dataset", "table_c")
+    assert cache.table_metadata("my-project", "dataset", "table_a")["num_rows"] == 30
+    assert cache.table_metadata("my-project", "dataset", "table_c")["num_rows"] == 40
+    assert calls(context) == {"tables.list": 1, "tables.get": 3}
+
+
+def test_deleted_table_is_missing(context):
+    cache = context.metadata
+    cache.table_metadata("my-project", "dataset", "table_a")
+    cache.deleted("my-project", "dataset", "table_a")
+    assert not cache.table_exists("my-project", "dataset", "table_a")
+    assert cache.get_table("my-project", "dataset", "table_a") is None
+    assert calls(context) == {"tables.list": 1, "tables.get": 1}
+
+
+def test_created_dataset_exists(context):
+    cache = context.metadata
+    assert not cache.dataset_exists("my-project", "new")
+    cache.dataset_created("my-project", "new")
+    assert cache.dataset_exists("my-project", "new")
+    assert not cache.table_exists("my-project", "new", "table_a")
+    cache.written("my-project", "new", "table_a")
+    assert cache.table_exists("my-project", "new", "table_a")
+    assert calls(context) == {"tables.list": 1}
@@ -0,0 +1,113 @@
+import pytest
+
+from biomedical_dashboards.biomed import partner_workflow
+from biomedical_dashboards.biomed.partner_workflow import (
+    PUBLISHED_TABLES,
+    partner_query_fingerprint,
+    publish_latest_tables,
+    record_query_output,
+    reuse_query_output,
+)
+
+
+@pytest.fixture
+def config(simulated_config):
+    config = simulated_config()
+    config.context.simulation.add_inputs(config.context.project, config.partners)
+    return config
+
+
+def run(config, query_name: str, partner=None) -> str:
+    """Runs a partner's query as far as the manifest is concerned: decides whether to reuse its output and, if not,
+    creates the output table and records it
+
+    :return: The action decided on: "run", "skip" or "copy"
+    """
+    context, partner = config.context, partner or config.partners[0]
+    fingerprint = partner_query_fingerprint(partner=partner, context=context, query_name=query_name)
+    if not reuse_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint):
+        table_name = getattr(context, f"generated_{query_name}_name")
+        context.simulation.add_table(f"{context.project}.{partner.output_dataset}.{table_name}")
+        record_query_output(partner=partner, context=context, query_name=query_name, fingerprint=fingerprint)
+    return context.manifest.decisions[-1]["action"]
+
+
+def test_query_without_a_previous_run_is_run(config):
+    assert run(config, "trials") == "run"
+    assert config.context.manifest.decisions[-1]["reason"] == "no previous run recorded"
+
+
+def test_unchanged_query_is_skipped(config):
+    run(config, "trials")
+    assert run(config, "trials") == "skip"
+
+
+def test_unchanged_query_under_a_new_run_version_is_copied(config):
+    context = config.context
+    run(config, "trials")
+    run(config, "alltrials")
+    context.run_version = 20250410
+    assert run(config, "trials") == "copy"
+    assert f"{context.project}.{config.partners[0].output_dataset}.trials20250410" in context.simulation.tables
+    # The alltrials output is a view, so is made again rather than copied
+    assert run(config, "alltrials") == "run"
+    assert context.manifest.decisions[-1]["reason"] == "unchanged, but the output is a view so is recreated at no cost"
+
+
+def test_changed_inputs_are_run(config):
+    context, partner = config.context, config.partners[0]
+    run(config, "trials")
+    context.simulation.add_table(f"{context.project}.{partner.static_dataset}.{partner.dois_table_name}")
+    context.metadata.written(context.project, partner.static_dataset, partner.dois_table_name)
+    assert run(config, "trials") == "run"
+    assert context.manifest.decisions[-1]["reason"] == "query or inputs changed since the last run"
+
+
+def test_missing_previous_output_is_run(config):
+    context, partner = config.context, config.partners[0]
+    run(config, "trials")
+    del context.simulation.tables[f"{context.project}.{partner.output_dataset}.{context.generated_trials_name}"]
+    context.metadata.deleted(context.project, partner.output_dataset, context.generated_trials_name)
+    assert run(config, "trials") == "run"
+    assert context.manifest.decisions[-1]["reason"].startswith("previous output missing")
+
+
+def test_forced_query_is_run(config):
+    run(config, "trials")
+    config.context.force = True
+    assert run(config, "trials") == "run"
+
+
+def test_fingerprint_ignores_only_the_run_version(config):
+    context, partner = config.context, config.partners[0]
+    # The partner's year cutoff is the same number as the run version, and the alltrials query filters by it
+    context.run_version = 2020
+    before = partner_query_fingerprint(partner=partner, context=context, query_name="alltrials")
+    context.run_version = 2021
+    assert partner_query_fingerprint(partner=partner, context=context, query_name="alltrials") == before
+    partner.year_cutoff = 2021
+    assert partner_query_fingerprint(partner=partner, context=context, query_name="alltrials") != before
+
+
+def test_latest_table_of_the_other_type_is_replaced_by_the_publish_script(config, monkeypatch):
+    context, partner = config.context, config.partners[0]
+    context.publish_mode = "view"
+    latest = f"{context.project}.{partner.latest_dataset}"
+    for table in PUBLISHED_TABLES:
+        context.simulation.add_table(f"{context.project}.{partner.output_dataset}.{table}{context.run_version}")
+    context.simulation.add_table(f"{latest}.trials", table_type="TABLE")
+
+    # Nothing is deleted if the script fails
+    def _fail(**kwargs):
+        raise RuntimeError("Publish failed")
+
+    monkeypatch.setattr(partner_workflow, "run_recorded_query", _fail)
+    with pytest.raises(RuntimeError, match="Publish failed"):
+        publish_latest_tables(partner, context)
+    assert context.simulation.tables[f"{latest}.trials"].table_type == "TABLE"
+
+    monkeypatch.undo()
+    publish_latest_tables(partner, context)
+    assert [context.simulation.tables[f"{latest}.{t}"].table_type for t in PUBLISHED_TABLES] == ["VIEW"] * len(
+        PUBLISHED_TABLES
+    )
@@ -0,0 +1,77 @@
+import pytest
+
+from biomedical_dashboards.biomed.config import BYTE_UNITS
+from biomedical_dashboards.biomed.main import run_workflow
+from biomedical_dashboards.biomed.preflight import preflight
+from biomedical_dashboards.biomed.simulated import SimulatedClient, SimulatedJob
+
+# The bytes that every dry run estimates, so that the budgets below are easy to reason about
+ESTIMATE = 10 * BYTE_UNITS["GB"]
+
+
+class CannedDryRunClient(SimulatedClient):
+    """A simulated client whose dry runs estimate ESTIMATE bytes, and which records the config of every query job"""
+
+    job_configs = []
+
+    def query(self, query: str, job_config=None) -> SimulatedJob:
+        if job_config is not None and job_config.dry_run:
+            job = super().query(query, job_config=job_config)
+            job.total_bytes_processed = ESTIMATE
+            return job
+        self.job_configs.append(job_config)
+        return super().query(query, job_config=job_config)
+
+
+@pytest.fixture
+def budgeted_config(simulated_config):
+    """Makes a simulated config whose clients are CannedDryRunClients"""
+
+    def _config(**context):
+        config = simulated_config(**context)
+        backend = config.context.simulation
+        config.context.clients.client_factory = lambda project, pool_size: CannedDryRunClient(backend, project)
+        CannedDryRunClient.job_configs = []
+        return config
+
+    return _config
+
+
+def test_preflight_under_budget(budgeted_config):
+    config = budgeted_config(max_bytes_per_query="20 GB", max_bytes_per_run="100 GB")
+    estimates = preflight(config)
+
+    # Before the shared tables exist, only the shared queries can be estimated
+    estimated = [e for e in estimates if e.bytes_processed is not None]
+    assert sorted(e.query_name for e in estimated) == ["alltrials", "enriched_dois", "trial_index"]
+    assert all(e.bytes_processed == ESTIMATE for e in estimated)
+    assert all(e.institution_id in ["partner-a", "partner-b"] for e in estimates if e.bytes_processed is None)
+    assert (config.context.simulation.jobs_submitted, CannedDryRunClient.job_configs) == (0, [])
+
+
+def test_preflight_over_query_budget(budgeted_config):
+    config = budgeted_config(max_bytes_per_query="5 GB")
+    with pytest.raises(RuntimeError, match="shared.alltrials would process 10.00 GB, over the per-query budget of 5"):
+        preflight(config)
+
+
+def test_preflight_over_run_budget(budgeted_config):
+    config = budgeted_config(max_bytes_per_query="20 GB", max_bytes_per_run="25 GB")
+    with pytest.raises(RuntimeError, match="The run would process 30.00 GB, over the per-run budget of 25.00 GB"):
+        preflight(config)
+
+
+def test_over_budget_run_submits_no_jobs(budgeted_config):
+    config = budgeted_config(max_bytes_per_run="25 GB")
+    with pytest.raises(RuntimeError, match="Pre-flight cost check failed"):
+        run_workflow(config)
+    assert config.context.simulation.jobs_submitted == 0
+
+
+def test_query_jobs_capped_at_query_budget(budgeted_config):
+    config = budgeted_config(max_bytes_per_query="20 GB")
+    graph = run_workflow(config)
+
+    assert graph.errors() == {}
+    assert CannedDryRunClient.job_configs
+    assert all(c.maximum_bytes_billed == 20 * BYTE_UNITS["GB"] for c in CannedDryRunClient.job_configs)
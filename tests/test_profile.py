@@ -0,0 +1,95 @@
+import json
+import os
+
+from google.cloud.bigquery.job import QueryPlanEntry
+
+from biomedical_dashboards.biomed.gcp import query_plan_stage
+from biomedical_dashboards.biomed.profile import attribute_stages, parse_sections, profile_path, profile_run
+
+# Query plans of the trials query of two run versions, in the format recorded by fetch_plans. The later run's Trial-ID
+# index lookup (d_4_anysource_extract_flat) takes almost twice the slot time
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def plans(run_version: str) -> str:
+    return os.path.join(FIXTURES, f"plans_{run_version}")
+
+
+def test_sections_of_trials_query():
+    with open(os.path.join(plans("20250310"), "my-partner_trials.json")) as f:
+        query = json.load(f)["query"]
+    assert [s.name for s in parse_sections(query)] == [
+        "Biomedical Open Science Dashboard Processing - Process Clinical Trial data",
+        "function_cast_date",
+        "trials20250310",
+        "d_3_contributed_trials_data",
+        "d_4_anysource_extract_flat",
+        "d_6a_pubs_data_intersect_anysource",
+        "d_6b_pubs_data_intersect_anysource",
+        "STEP 7:",
+    ]
+
+
+def test_profile_attributes_stages_to_sections(simulated_config):
+    config = simulated_config()
+    profiles, changes = profile_run(config, run_version="20250310", plans=[plans("20250310")])
+
+    assert changes == []
+    [profile] = profiles
+    assert (profile.institution_id, profile.template, profile.job_id) == (
+        "my-partner",
+        "trials",
+        "bquxjob_2d9e41b7_1955e07c3f2",
+    )
+    assert [(s["id"], s["section"]) for s in profile.stages] == [
+        # Reads the partner's trials and computes the graph orders and pretty fields
+        ("0", "d_3_contributed_trials_data"),
+        # Reads the shared Trial-ID index
+        ("1", "d_4_anysource_extract_flat"),
+        # Reads the partner's DOIs, then joins them to the Trial-IDs (matched by its steps' trim)
+        ("2", "d_6a_pubs_data_intersect_anysource"),
+        ("3", "d_6a_pubs_data_intersect_anysource"),
+        # STRING_AGG of the DOIs of each trial
+        ("4", "d_6b_pubs_data_intersect_anysource"),
+        # The final join, matched by its string constants, and the output stage that reads from it
+        ("5", "STEP 7:"),
+        ("6", "STEP 7:"),
+    ]
+    assert {name: (s["stages"], s["slot_ms"]) for name, s in profile.sections.items()} == {
+        "d_3_contributed_trials_data": (1, 4200),
+        "d_4_anysource_extract_flat": (1, 95000),
+        "d_6a_pubs_data_intersect_anysource": (2, 10900),
+        "d_6b_pubs_data_intersect_anysource": (1, 2400),
+        "STEP 7:": (2, 6950),
+    }
+    # The averaged metrics are multiplied by the number of workers: 20 workers of 150 ms of compute
+    assert profile.sections["d_4_anysource_extract_flat"]["compute_ms"] == 3000
+    assert profile.sections["d_4_anysource_extract_flat"]["shuffle_bytes"] == 30_000_000
+    assert profile.hotspots(1)[0][0] == "d_4_anysource_extract_flat"
+
+    with open(profile_path(config.context, "20250310")) as f:
+        assert json.load(f)["jobs"][0]["slot_ms"] == 119450
+
+
+def test_profile_reports_regressed_sections(simulated_config):
+    config = simulated_config()
+    profile_run(config, run_version="20250217", plans=[plans("20250217")])
+    _, changes = profile_run(config, run_version="20250310", plans=[plans("20250310")], baseline="20250217")
+
+    assert [(c.section, c.change_ms, c.regressed) for c in changes] == [
+        ("d_4_anysource_extract_flat", 45000, True),
+        ("d_6a_pubs_data_intersect_anysource", 400, False),
+        ("d_3_contributed_trials_data", 200, False),
+        ("STEP 7:", 150, False),
+        ("d_6b_pubs_data_intersect_anysource", -100, False),
+    ]
+
+
+def test_plan_stages_read_from_job_query_plan():
+    with open(os.path.join(plans("20250310"), "my-partner_trials.json")) as f:
+        plan = json.load(f)
+    # The stages as the client library gives them in job.query_plan, then as bq_get_query_plan records them
+    stages = [query_plan_stage(QueryPlanEntry.from_api_repr(entry)) for entry in plan["query_plan"]]
+    assert [s["steps"] for s in stages] == [e["steps"] for e in plan["query_plan"]]
+    sections = parse_sections(plan["query"])
+    assert attribute_stages(sections, stages) == attribute_stages(sections, plan["query_plan"])
@@ -0,0 +1,51 @@
+from biomedical_dashboards.biomed.queries import query_latest_view, query_publish_latest
+
+
+def test_latest_view_reads_run_version_shard():
+    query = query_latest_view(
+        project="my-project", institution_id="my-partner", table_name="trials", run_version=20250310
+    )
+    assert "CREATE OR REPLACE VIEW `my-project.my-partner_data_latest.trials`" in query
+    assert "AS SELECT * FROM `my-project.my-partner_data.trials20250310`" in query
+    # Wildcard tables can't read the alltrials views, and a prefix would match other tables
+    assert "*`" not in query
+    assert "_TABLE_SUFFIX" not in query
+
+
+def test_publish_latest_views_use_latest_view_template():
+    kwargs = dict(project="my-project", institution_id="my-partner", run_version=20250310)
+    query = query_publish_latest(**kwargs, tables=["alltrials", "trials", "pubs"], publish_mode="view", drop={})
+    for table in ["alltrials", "trials", "pubs"]:
+        assert f"{query_latest_view(**kwargs, table_name=table)};" in query
+
+
+def test_publish_latest_clones():
+    query = query_publish_latest(
+        project="my-project",
+        institution_id="my-partner",
+        run_version=20250310,
+        tables=["pubs"],
+        publish_mode="clone",
+        drop={},
+    )
+    assert "CREATE OR REPLACE TABLE `my-project.my-partner_data_latest.pubs`" in query
+    assert "CLONE `my-project.my-partner_data.pubs20250310`;" in query
+    assert "VIEW" not in query
+    assert "DROP" not in query
+
+
+def test_publish_latest_drops_tables_of_the_other_type_just_before_replacing_them():
+    query = query_publish_latest(
+        project="my-project",
+        institution_id="my-partner",
+        run_version=20250310,
+        tables=["alltrials", "trials", "pubs"],
+        publish_mode="view",
+        drop=dict(trials="TABLE"),
+    )
+    statements = [line for line in query.splitlines() if line.startswith(("DROP", "CREATE"))]
+    assert statements[1:3] == [
+        "DROP TABLE IF EXISTS `my-project.my-partner_data_latest.trials`;",
+        "CREATE OR REPLACE VIEW `my-project.my-partner_data_latest.trials`",
+    ]
+    assert query.count("DROP") == 1
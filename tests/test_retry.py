@@ -0,0 +1,114 @@
+from google.api_core.exceptions import (
+    BadRequest,
+    Forbidden,
+    InternalServerError,
+    NotFound,
+    ServiceUnavailable,
+    TooManyRequests,
+)
+import pytest
+
+from biomedical_dashboards.biomed import retry
+from biomedical_dashboards.biomed.retry import QuotaGuard, RetryPolicy, TokenBucket, is_retryable
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Records the waits of the quota guard instead of waiting"""
+    waits = []
+    monkeypatch.setattr(retry.time, "sleep", waits.append)
+    return waits
+
+
+@pytest.mark.parametrize(
+    "error, retryable",
+    [
+        (TooManyRequests("slow down"), True),
+        (InternalServerError("oops"), True),
+        (ServiceUnavailable("down"), True),
+        (Forbidden("limited", errors=[dict(reason="rateLimitExceeded")]), True),
+        (Forbidden("limited", errors=[dict(reason="jobRateLimitExceeded")]), True),
+        (BadRequest("retry me", errors=[dict(reason="backendError")]), True),
+        (ConnectionError("reset"), True),
+        (TimeoutError("timed out"), True),
+        (BadRequest("Syntax error"), False),
+        (BadRequest("too big", errors=[dict(reason="bytesBilledLimitExceeded")]), False),
+        (Forbidden("daily quota", errors=[dict(reason="quotaExceeded")]), False),
+        (NotFound("Not found: Table"), False),
+        (ValueError("bug"), False),
+    ],
+)
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) == retryable
+
+
+def test_retry_policy_backoff_bounds():
+    policy = RetryPolicy(initial_delay=1.0, max_delay=10.0, multiplier=2.0, seed=0)
+    for attempt, backoff in [(1, 1.0), (2, 2.0), (3, 4.0), (4, 8.0), (5, 10.0), (20, 10.0)]:
+        delays = [policy.delay(attempt) for _ in range(200)]
+        assert all(0 <= d <= backoff for d in delays)
+        # Full jitter spreads the waits over the whole backoff
+        assert max(delays) > backoff * 0.9 and min(delays) < backoff * 0.1
+
+
+def test_retry_policy_is_repeatable_with_a_seed():
+    assert [RetryPolicy(seed=1).delay(3) for _ in range(2)] == [RetryPolicy(seed=1).delay(3)] * 2
+
+
+def test_token_bucket_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(retry.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=10, capacity=2)
+    # A burst of capacity calls goes straight away, then each call waits a tenth of a second more
+    assert [bucket.reserve() for _ in range(4)] == pytest.approx([0.0, 0.0, 0.1, 0.2])
+    # The tokens refill at the rate, up to the capacity
+    now[0] += 10
+    assert [bucket.reserve() for _ in range(3)] == pytest.approx([0.0, 0.0, 0.1])
+
+
+def test_quota_guard_retries_transient_errors_only(no_sleep):
+    guard = QuotaGuard(retry=RetryPolicy(max_attempts=3, seed=0))
+    errors = [ServiceUnavailable("down"), Forbidden("limited", errors=[dict(reason="rateLimitExceeded")])]
+
+    def _flaky():
+        if errors:
+            raise errors.pop(0)
+        return "done"
+
+    assert guard.call("jobs", _flaky) == "done"
+    with pytest.raises(NotFound):
+        guard.call("metadata", lambda: (_ for _ in ()).throw(NotFound("gone")))
+    assert guard.stats()["calls"] == dict(jobs=3, metadata=1)
+    assert guard.stats()["retries"] == dict(ServiceUnavailable=1, rateLimitExceeded=1)
+
+
+def test_quota_guard_report_counts_throttling(no_sleep, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(retry.time, "monotonic", lambda: now[0])
+    guard = QuotaGuard(retry=RetryPolicy(max_attempts=2, initial_delay=1.0, seed=0), jobs_per_second=10)
+
+    def _down():
+        raise ServiceUnavailable("down")
+
+    for _ in range(3):
+        guard.call("jobs", lambda: None)
+    with pytest.raises(ServiceUnavailable):
+        guard.call("jobs", _down)
+
+    stats = guard.stats()
+    assert stats["calls"] == dict(jobs=5)
+    assert stats["failures"] == dict(jobs=1)
+    # The bucket holds one second's worth (10 calls), so none of the 5 calls waited for a token
+    assert stats["rate_limited_seconds"] == dict(jobs=0.0)
+    assert guard.throttled_seconds == stats["backoff_seconds"] == pytest.approx(sum(no_sleep))
+    report = guard.report().splitlines()
+    assert report[0] == "BigQuery calls: 5 (jobs: 5)"
+    assert report[1] == "\tRetried: 1 (ServiceUnavailable: 1)"
+    assert report[2] == "\tFailed after retrying: 1"
+    assert report[3].startswith(f"\tThrottled: {guard.throttled_seconds:.1f}s (no rate limiting, backing off: ")
+
+    # Calls beyond the bucket's capacity wait for tokens, which is counted per call kind
+    for _ in range(10):
+        guard.call("jobs", lambda: None)
+    assert guard.stats()["rate_limited_seconds"]["jobs"] == pytest.approx(sum(0.1 * i for i in range(1, 6)))
+    assert "jobs: 1.5s" in guard.report()
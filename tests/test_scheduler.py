@@ -0,0 +1,98 @@
+import pytest
+
+from biomedical_dashboards.biomed.scheduler import Task, TaskGraph
+
+
+def make_graph(deps: dict, ran: list = None, fail: set = ()) -> TaskGraph:
+    """Makes a graph of tasks from their dependencies. Each task appends its name to ran when it runs, and the tasks in
+    fail raise"""
+    ran = [] if ran is None else ran
+    graph = TaskGraph()
+
+    def _func(name: str):
+        def _run():
+            ran.append(name)
+            if name in fail:
+                raise RuntimeError(f"{name} failed")
+
+        return _run
+
+    for name, task_deps in deps.items():
+        graph.add(Task(name=name, func=_func(name), deps=task_deps))
+    return graph
+
+
+def run(graph: TaskGraph, engine: str) -> None:
+    if engine == "threads":
+        graph.run(max_workers=1)
+    else:
+        graph.run_async(max_concurrent=1, max_threads=1)
+
+
+def test_duplicate_task_is_rejected():
+    graph = make_graph(dict(a=[]))
+    with pytest.raises(RuntimeError, match="Task already exists in the graph: a"):
+        graph.add(Task(name="a", func=lambda: None))
+
+
+def test_unknown_dependency_is_rejected():
+    graph = make_graph(dict(a=[], b=["a", "c"], d=["e"]))
+    with pytest.raises(RuntimeError, match="Task dependencies missing from the graph:\n\tb -> c\n\td -> e"):
+        graph.topological_order()
+
+
+def test_cycle_is_rejected():
+    graph = make_graph(dict(a=[], b=["a", "d"], c=["b"], d=["c"]))
+    with pytest.raises(RuntimeError, match=r"Task graph contains a cycle between: \['b', 'c', 'd'\]"):
+        graph.topological_order()
+    with pytest.raises(RuntimeError, match="cycle"):
+        graph.run(max_workers=2)
+
+
+def test_topological_order():
+    graph = make_graph(dict(pubs=["alltrials", "enriched"], alltrials=["extract"], enriched=[], extract=[]))
+    order = [t.name for t in graph.topological_order()]
+    assert sorted(order) == sorted(graph.tasks)
+    for t in graph.tasks.values():
+        assert all(order.index(d) < order.index(t.name) for d in t.deps)
+
+
+def test_tasks_on_the_longest_chain_start_first():
+    # short is ready first, but long heads a chain of three tasks. Ties go to the task first in topological order
+    ran = []
+    graph = make_graph(dict(short=[], long=[], long_2=["long"], long_3=["long_2"]), ran=ran)
+    graph.run(max_workers=1)
+    assert ran == ["long", "long_2", "short", "long_3"]
+    assert {t.status for t in graph.tasks.values()} == {"done"}
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_failed_task_skips_its_dependents_only(engine):
+    ran = []
+    graph = make_graph(dict(a=[], b=["a"], c=["b"], d=[], e=["d"]), ran=ran, fail={"a"})
+    run(graph, engine)
+    assert {n: t.status for n, t in graph.tasks.items()} == dict(
+        a="failed", b="skipped", c="skipped", d="done", e="done"
+    )
+    assert sorted(ran) == ["a", "d", "e"]
+    assert list(graph.errors()) == ["a"]
+    assert "RuntimeError: a failed" in graph.errors()["a"]
+    assert graph.tasks["b"].error == "Skipped as upstream task failed: a"
+    assert graph.tasks["c"].error.startswith("Skipped as upstream task failed")
+
+
+def test_critical_path_report():
+    graph = make_graph(dict(a=[], b=["a"], c=["a"], d=["b", "c"]))
+    for name, (start, end) in dict(a=(0, 1), b=(1, 2), c=(1, 4), d=(4, 5)).items():
+        graph.tasks[name].start, graph.tasks[name].end = start, end
+        graph.tasks[name].status = "done"
+    graph.wall_time = 5.5
+
+    assert [t.name for t in graph.critical_path()] == ["a", "c", "d"]
+    assert graph.critical_path_report().splitlines() == [
+        "Workflow wall time: 5.5s. Critical path: 5.0s over 3 task(s)",
+        "\t     1.0s  a (done)",
+        "\t     3.0s  c (done)",
+        "\t     1.0s  d (done)",
+    ]
+    assert TaskGraph().critical_path() == []
@@ -0,0 +1,124 @@
+import json
+import os
+import random
+
+import pytest
+
+from biomedical_dashboards.biomed.config import Partner
+from biomedical_dashboards.biomed.sharding import (
+    ShardResult,
+    assign_shards,
+    load_shard_results,
+    merge_shard_results,
+    shard_fragment_fname,
+)
+
+
+def make_partners(weights: list) -> list:
+    return [
+        Partner(
+            institution_id=f"partner-{i:02d}",
+            dois_table_name="dois",
+            trials_aact_table_name="trials_aact",
+            oddpub_table_name="oddpub",
+            year_cutoff=2020,
+            shard_weight=weight,
+        )
+        for i, weight in enumerate(weights)
+    ]
+
+
+def ids(shards: list) -> list:
+    return [[p.institution_id for p in shard] for shard in shards]
+
+
+def test_shards_are_assigned_the_same_whatever_the_order_of_the_config():
+    partners = make_partners([random.Random(0).uniform(0.5, 5) for _ in range(40)])
+    shuffled = list(partners)
+    random.Random(1).shuffle(shuffled)
+    assert ids(assign_shards(partners, 4)) == ids(assign_shards(shuffled, 4))
+
+
+def test_each_partner_is_in_exactly_one_shard():
+    partners = make_partners([1.0] * 10)
+    shards = assign_shards(partners, 3)
+    assert sorted(p for shard in ids(shards) for p in shard) == [p.institution_id for p in partners]
+    assert [len(shard) for shard in shards] == [4, 3, 3]
+    # More shards than partners leaves some empty
+    assert [len(shard) for shard in assign_shards(partners[:2], 3)] == [1, 1, 0]
+
+
+def test_shards_are_balanced_by_weight():
+    partners = make_partners([10, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+    shards = assign_shards(partners, 2)
+    # The heavy partner has a shard to itself, which the ten light ones balance
+    assert ids(shards)[0] == ["partner-00"]
+    assert [sum(p.shard_weight for p in shard) for shard in shards] == [10, 10]
+
+    weights = [random.Random(2).uniform(0.5, 5) for _ in range(100)]
+    loads = [sum(p.shard_weight for p in shard) for shard in assign_shards(make_partners(weights), 5)]
+    # Greedy assignment of the heaviest first is never more than the heaviest partner out
+    assert max(loads) - min(loads) <= max(weights)
+
+
+@pytest.fixture
+def config(simulated_config):
+    return simulated_config()
+
+
+def write_result(config, shard_index: int, shard_count: int, partners: list, **kwargs) -> None:
+    context = config.context
+    result = ShardResult(
+        **{
+            **dict(
+                run_version=str(context.run_version),
+                workflow_hash=context.workflow_hash,
+                shard_index=shard_index,
+                shard_count=shard_count,
+                partners=partners,
+                wall_seconds=10.0 * (shard_index + 1),
+                tasks={f"{p}_pubs": dict(status="done", seconds=1.0, error=None) for p in partners},
+            ),
+            **kwargs,
+        }
+    )
+    path = os.path.join(context.output_dir, shard_fragment_fname(context.run_version, shard_index, shard_count))
+    with open(path, "w") as f:
+        json.dump(result.to_dict(), f)
+
+
+def test_shard_results_are_merged(config):
+    write_result(config, 0, 2, ["partner-a"])
+    write_result(config, 1, 2, ["partner-b"])
+    report = merge_shard_results(config, load_shard_results(config, 2))
+    assert (report["shard_count"], report["partners"], report["wall_seconds"]) == (2, 2, 20.0)
+    assert (report["tasks"], report["errors"]) == (dict(done=2), {})
+
+
+def test_missing_shard_result_fails_the_merge(config):
+    write_result(config, 0, 2, ["partner-a"])
+    with pytest.raises(RuntimeError, match="Shard 1 of 2 has no result"):
+        load_shard_results(config, 2)
+
+
+def test_partner_in_two_shard_results_fails_the_merge(config):
+    write_result(config, 0, 2, ["partner-a", "partner-b"])
+    write_result(config, 1, 2, ["partner-b"])
+    with pytest.raises(RuntimeError, match="Partner\\(s\\) run by more than one shard: partner-b"):
+        load_shard_results(config, 2)
+
+
+def test_partner_in_no_shard_result_fails_the_merge(config):
+    write_result(config, 0, 2, ["partner-a"])
+    write_result(config, 1, 2, [])
+    with pytest.raises(RuntimeError, match="Partner\\(s\\) not run by any shard: partner-b"):
+        load_shard_results(config, 2)
+
+
+def test_shard_results_of_another_run_fail_the_merge(config):
+    write_result(config, 0, 2, ["partner-a"], workflow_hash="other")
+    write_result(config, 1, 2, ["partner-b"], run_version="20250210")
+    with pytest.raises(RuntimeError) as e:
+        load_shard_results(config, 2)
+    assert "Shards were run with different workflow hashes" in str(e.value)
+    assert "Shard 1 result is of run 20250210 with 2 shards" in str(e.value)
@@ -0,0 +1,129 @@
+from datetime import timedelta
+import json
+
+import pytest
+
+from biomedical_dashboards.biomed.gcp import bq_set_table_description
+from biomedical_dashboards.biomed.shared_workflow import (
+    SHARED_QUERIES,
+    check_shared_prepared,
+    create_shared_dataset,
+    generate_shared_queries,
+    run_shared_query,
+    shared_fingerprint,
+    shared_table_current,
+    unpaywall_version,
+)
+
+
+def build_shared_tables(context) -> int:
+    """Runs every shared query and returns the number of jobs submitted"""
+    before = context.simulation.jobs_submitted
+    for query_name in SHARED_QUERIES:
+        run_shared_query(context, query_name)
+    return context.simulation.jobs_submitted - before
+
+
+def replace_lineage(context, query_name: str, **lineage) -> None:
+    """Rewrites a shared table's recorded lineage, as if the table had been made by other templates"""
+    table_name = getattr(context, f"shared_{query_name}_name")
+    bq_set_table_description(
+        context.project, context.shared_dataset, table_name, json.dumps(lineage), client=context.client
+    )
+    context.metadata.written(context.project, context.shared_dataset, table_name)
+
+
+def replace_unpaywall(context) -> None:
+    """Replaces the Unpaywall table with a newer snapshot, as seen by a later run"""
+    project, dataset, table_name = context.unpaywall_table.split(".")
+    table = context.simulation.get_table(context.unpaywall_table)
+    table.modified += timedelta(days=7)
+    context.metadata.written(project, dataset, table_name)
+
+
+@pytest.fixture
+def context(simulated_config):
+    context = simulated_config().context
+    generate_shared_queries(context)
+    create_shared_dataset(context)
+    return context
+
+
+def test_shared_tables_record_their_templates(context):
+    assert build_shared_tables(context) == len(SHARED_QUERIES)
+    for query_name in SHARED_QUERIES:
+        table = context.metadata.get_table(
+            context.project, context.shared_dataset, getattr(context, f"shared_{query_name}_name")
+        )
+        lineage = json.loads(table.description)
+        assert (lineage["template"], lineage["workflow_hash"]) == (
+            shared_fingerprint(query_name),
+            context.workflow_hash,
+        )
+        assert shared_table_current(context, query_name)
+    # The index is made from the extract, so it is fingerprinted with the extract's template too
+    assert shared_fingerprint("trial_index").endswith("+" + shared_fingerprint("alltrials"))
+
+
+def test_current_shared_tables_are_reused(context):
+    build_shared_tables(context)
+    assert build_shared_tables(context) == 0
+    check_shared_prepared(context)
+
+
+def test_shared_table_made_by_other_templates_is_rebuilt(context):
+    build_shared_tables(context)
+    replace_lineage(context, "enriched_dois", template="0123456789abcdef", workflow_hash="old")
+    with pytest.raises(RuntimeError, match="wasn't made by the current templates"):
+        check_shared_prepared(context)
+
+    assert build_shared_tables(context) == 1
+    assert shared_table_current(context, "enriched_dois")
+    check_shared_prepared(context)
+
+
+def test_shared_table_without_lineage_is_rebuilt(context):
+    build_shared_tables(context)
+    table_name = context.shared_trial_index_name
+    context.simulation.tables[f"{context.project}.{context.shared_dataset}.{table_name}"].description = None
+    context.metadata.written(context.project, context.shared_dataset, table_name)
+
+    assert not shared_table_current(context, "trial_index")
+    assert build_shared_tables(context) == 1
+
+
+def test_index_made_from_an_older_extract_is_rebuilt(context):
+    build_shared_tables(context)
+    # As if both were made before the extract's template changed. The index's own template hasn't
+    lineage = json.loads(
+        context.metadata.get_table(context.project, context.shared_dataset, context.shared_alltrials_name).description
+    )
+    replace_lineage(context, "alltrials", **{**lineage, "template": "0123456789abcdef"})
+    index_template = shared_fingerprint("trial_index").split("+")[0]
+    replace_lineage(context, "trial_index", template=f"{index_template}+0123456789abcdef", workflow_hash="old")
+
+    assert build_shared_tables(context) == 2
+    assert all(shared_table_current(context, q) for q in SHARED_QUERIES)
+
+
+def test_enriched_dois_record_the_unpaywall_version(context):
+    build_shared_tables(context)
+    lineage = json.loads(
+        context.metadata.get_table(
+            context.project, context.shared_dataset, context.shared_enriched_dois_name
+        ).description
+    )
+    assert lineage["unpaywall"] == unpaywall_version(context) is not None
+
+
+def test_new_unpaywall_snapshot_rebuilds_the_enriched_dois(context):
+    build_shared_tables(context)
+    replace_unpaywall(context)
+    assert not shared_table_current(context, "enriched_dois")
+    assert all(shared_table_current(context, q) for q in SHARED_QUERIES if q != "enriched_dois")
+    with pytest.raises(RuntimeError, match="wasn't made by the current templates and inputs"):
+        check_shared_prepared(context)
+
+    assert build_shared_tables(context) == 1
+    assert shared_table_current(context, "enriched_dois")
+    assert build_shared_tables(context) == 0
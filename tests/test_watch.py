@@ -0,0 +1,227 @@
+from types import SimpleNamespace
+
+import pytest
+
+from biomedical_dashboards.biomed.watch import Watcher, plan_rebuild, poll_inputs
+
+
+class Clock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class StubWorkflow:
+    """Stands in for main.run_workflow. Records the partners and DOI table version of each build, and fails the tasks
+    of the partners in fail (None for the shared stages)"""
+
+    def __init__(self):
+        self.builds = []
+        self.fail = set()
+
+    def __call__(self, config):
+        ids = [p.institution_id for p in config.partners]
+        self.builds.append(dict(partners=ids, doi_version=str(config.context.doi_version)))
+        tasks = {"alltrials_shared": SimpleNamespace(status="failed" if None in self.fail else "done", partner=None)}
+        for id in ids:
+            tasks[f"{id}_pubs"] = SimpleNamespace(status="failed" if id in self.fail else "done", partner=id)
+        errors = {name: "Traceback\nRuntimeError: bad upload" for name, t in tasks.items() if t.status != "done"}
+        return SimpleNamespace(tasks=tasks, errors=lambda: errors)
+
+
+@pytest.fixture
+def watch(simulated_config):
+    """Makes a watcher over the simulated backend, with the configured input tables uploaded, a stub workflow and a
+    clock that moves by hand"""
+
+    def _watch(config=None, workflow=None, clock=None, **kwargs) -> Watcher:
+        config = config or simulated_config()
+        config.context.simulation.add_inputs(config.context.project, config.partners)
+        return Watcher(
+            config=config,
+            run_workflow=workflow or StubWorkflow(),
+            quiet_period=100,
+            max_delay=250,
+            clock=clock or Clock(),
+            sleep=lambda seconds: None,
+            today=lambda: "20250401",
+            **kwargs,
+        )
+
+    return _watch
+
+
+def upload(watcher: Watcher, table_id: str) -> None:
+    watcher.config.context.simulation.add_table(f"{watcher.config.context.project}.{table_id}")
+
+
+def land_doi_shard(watcher: Watcher, version: str) -> None:
+    dataset = watcher.config.context.doi_table.rsplit(".", 1)[0]
+    watcher.config.context.simulation.add_table(f"{dataset}.doi{version}")
+
+
+def test_unchanged_inputs_are_not_rebuilt(watch):
+    watcher = watch()
+    assert [watcher.step() for _ in range(3)] == [None, None, None]
+    assert watcher.builds == 0
+
+
+def test_quiet_period_coalesces_a_burst_of_uploads(watch):
+    workflow, clock = StubWorkflow(), Clock()
+    watcher = watch(workflow=workflow, clock=clock)
+    watcher.step()
+
+    upload(watcher, "partner-a_from_partners.dois_20230301")
+    clock.now = 10
+    assert watcher.step() is None
+    upload(watcher, "partner-a_from_partners.oddpub_20230301")
+    clock.now = 60
+    assert watcher.step() is None
+    # Quiet for 90 seconds, since the second upload
+    clock.now = 150
+    assert watcher.step() is None
+    clock.now = 160
+    assert watcher.step() is not None
+
+    assert workflow.builds == [dict(partners=["partner-a"], doi_version="20240512")]
+    built = watcher.built["partners"]["partner-a"]
+    assert (built["dois_table_name"]["table_name"], built["oddpub_table_name"]["table_name"]) == (
+        "dois_20230301",
+        "oddpub_20230301",
+    )
+    clock.now = 1000
+    assert watcher.step() is None
+    assert watcher.builds == 1
+
+
+def test_max_delay_rebuilds_inputs_that_never_go_quiet(watch):
+    workflow, clock = StubWorkflow(), Clock()
+    watcher = watch(workflow=workflow, clock=clock)
+    watcher.step()
+
+    for i, now in enumerate([0, 60, 120, 180, 240]):
+        upload(watcher, f"partner-b_from_partners.dois_2023030{i + 1}")
+        clock.now = now
+        assert watcher.step() is None
+    upload(watcher, "partner-b_from_partners.dois_20230306")
+    clock.now = 250
+    assert watcher.step() is not None
+    assert workflow.builds == [dict(partners=["partner-b"], doi_version="20240512")]
+    assert watcher.built["partners"]["partner-b"]["dois_table_name"]["table_name"] == "dois_20230306"
+
+
+def test_failed_rebuild_is_not_retried_until_the_inputs_change(watch):
+    workflow, clock = StubWorkflow(), Clock()
+    workflow.fail = {"partner-a"}
+    watcher = watch(workflow=workflow, clock=clock)
+    watcher.step()
+
+    upload(watcher, "partner-a_from_partners.dois_20230301")
+    watcher.step()
+    clock.now = 100
+    assert watcher.step() is not None
+    assert watcher.built["partners"]["partner-a"]["dois_table_name"]["table_name"] == "dois_20230217"
+
+    for clock.now in [200, 1000, 5000]:
+        assert watcher.step() is None
+    assert watcher.builds == 1
+
+    workflow.fail = set()
+    upload(watcher, "partner-a_from_partners.dois_20230302")
+    clock.now = 5010
+    assert watcher.step() is None
+    clock.now = 5110
+    assert watcher.step() is not None
+    assert watcher.built["partners"]["partner-a"]["dois_table_name"]["table_name"] == "dois_20230302"
+
+
+def test_new_doi_shard_rebuilds_every_partner(watch):
+    workflow, clock = StubWorkflow(), Clock()
+    watcher = watch(workflow=workflow, clock=clock)
+    watcher.step()
+
+    land_doi_shard(watcher, "20240601")
+    watcher.step()
+    clock.now = 100
+    assert watcher.step() is not None
+
+    assert workflow.builds == [dict(partners=["partner-a", "partner-b"], doi_version="20240601")]
+    assert str(watcher.config.context.previous_doi_version) == "20240512"
+    assert watcher.built["doi_version"] == "20240601"
+    assert watcher.built["partner_doi_versions"] == {"partner-a": "20240601", "partner-b": "20240601"}
+    clock.now = 1000
+    assert watcher.step() is None
+
+
+def test_partner_that_fails_a_doi_rebuild_is_rebuilt_against_the_new_shard(watch):
+    workflow, clock = StubWorkflow(), Clock()
+    workflow.fail = {"partner-b"}
+    watcher = watch(workflow=workflow, clock=clock)
+    watcher.step()
+
+    land_doi_shard(watcher, "20240601")
+    watcher.step()
+    clock.now = 100
+    watcher.step()
+    # The shared stages and partner-a moved on, partner-b didn't
+    assert watcher.built["doi_version"] == "20240601"
+    assert watcher.built["partner_doi_versions"] == {"partner-a": "20240601", "partner-b": "20240512"}
+
+    plan = plan_rebuild(watcher.built, poll_inputs(watcher.config))
+    assert (plan.doi_version, list(plan.partners)) == (None, ["partner-b"])
+    assert plan.partners["partner-b"] == ["new DOI table version: 20240601"]
+    assert plan.queries["partner-b"] == ["alltrials", "pubs", "trials"]
+
+    # Not retried until partner-b's inputs change
+    clock.now = 1000
+    assert watcher.step() is None
+    workflow.fail = set()
+    upload(watcher, "partner-b_from_partners.oddpub_20230301")
+    watcher.step()
+    clock.now = 1100
+    assert watcher.step() is not None
+
+    assert workflow.builds[-1] == dict(partners=["partner-b"], doi_version="20240601")
+    assert watcher.built["partner_doi_versions"] == {"partner-a": "20240601", "partner-b": "20240601"}
+    clock.now = 2000
+    assert watcher.step() is None
+
+
+def test_restarted_watch_rebuilds_a_partner_that_failed_a_doi_rebuild(watch, simulated_config):
+    config, workflow, clock = simulated_config(), StubWorkflow(), Clock()
+    workflow.fail = {"partner-b"}
+    watcher = watch(config=config, workflow=workflow, clock=clock)
+    watcher.step()
+    land_doi_shard(watcher, "20240601")
+    watcher.step()
+    clock.now = 100
+    watcher.step()
+
+    workflow.fail = set()
+    restarted = watch(config=config, workflow=workflow, clock=clock)
+    assert str(config.context.doi_version) == "20240601"
+    restarted.step()
+    clock.now = 200
+    assert restarted.step() is not None
+    assert workflow.builds[-1] == dict(partners=["partner-b"], doi_version="20240601")
+
+
+def test_doi_version_is_kept_while_the_shared_stages_fail(watch):
+    workflow, clock = StubWorkflow(), Clock()
+    workflow.fail = {None}
+    watcher = watch(workflow=workflow, clock=clock)
+    watcher.step()
+
+    land_doi_shard(watcher, "20240601")
+    watcher.step()
+    clock.now = 100
+    watcher.step()
+    assert watcher.built["doi_version"] == "20240512"
+
+    # The partners were built from the new shard, so only the shared stages are left to rebuild
+    plan = plan_rebuild(watcher.built, poll_inputs(watcher.config))
+    assert (plan.doi_version, plan.partners) == ("20240601", {})